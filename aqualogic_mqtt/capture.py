@@ -0,0 +1,90 @@
+import struct
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Raw panel byte stream captures. The file starts with a magic line, followed by
+# records of a little-endian header (microseconds since the previous record as
+# uint32, data length as uint16) and the raw bytes as read from the source. Bytes
+# read within a short interval of each other are grouped into one record, which
+# keeps byte-at-a-time reads from the serial port compact.
+CAPTURE_MAGIC = b"ALCAP1\n"
+_RECORD = struct.Struct("<IH")
+_MAX_DELTA_US = 0xffffffff
+_MAX_RECORD = 0xffff
+
+class CaptureWriter:
+    _file = None
+    _group_s = None
+    _last_record = None
+    _pending_start = None
+
+    def __init__(self, path:(str), group_ms:(float)=1):
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._group_s = group_ms / 1000
+        self._pending = bytearray()
+        self._lock = threading.Lock()
+        logger.info(f"Recording panel source to {path}")
+
+    def write(self, data):
+        now = time.monotonic()
+        with self._lock:
+            if self._file is None:
+                return
+            if self._pending and (now - self._pending_start > self._group_s
+                                  or len(self._pending) + len(data) > _MAX_RECORD):
+                self._flush_record()
+            if not self._pending:
+                self._pending_start = now
+            self._pending += data
+
+    def _flush_record(self):
+        if self._last_record is None:
+            self._last_record = self._pending_start
+        delta_us = int((self._pending_start - self._last_record) * 1e6)
+        # Gaps too long for one header are padded out with empty records
+        while delta_us > _MAX_DELTA_US:
+            self._file.write(_RECORD.pack(_MAX_DELTA_US, 0))
+            delta_us -= _MAX_DELTA_US
+        self._file.write(_RECORD.pack(delta_us, len(self._pending)))
+        self._file.write(self._pending)
+        self._last_record = self._pending_start
+        self._pending.clear()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._pending:
+                self._flush_record()
+            self._file.close()
+            self._file = None
+
+# Yields (seconds since start of capture, data) for each record in a capture file
+def read_capture(path:(str)):
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise RuntimeError(f"{path} is not a panel capture file!")
+        t = 0
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            delta_us, length = _RECORD.unpack(header)
+            t += delta_us / 1e6
+            data = f.read(length)
+            if length:
+                yield t, data
+
+# Paces records from a capture at their recorded timing divided by speed, or as
+# fast as possible if speed is 0. Yields (delay to wait before the record, data).
+def pace_capture(path:(str), speed:(float)=1.0, clock=time.monotonic):
+    start = clock()
+    for t, data in read_capture(path):
+        delay = 0
+        if speed > 0:
+            delay = start + t / speed - clock()
+        yield max(delay, 0), data
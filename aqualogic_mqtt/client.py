@@ -2,42 +2,126 @@ import threading
 import logging
 import sys
 import ssl
+import signal
 from time import sleep
 import os
 import argparse
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.reasoncodes import ReasonCode
-
-from aqualogic.core import AquaLogic
-from aqualogic.states import States
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 
 from .messages import Messages
+from .filters import SensorFilter
+from .display import DisplayParser
+from .sysmatch import SystemMessageMatcher
 from .panelmanager import PanelManager
+from .panelbridge import PanelBridge
+from .stream import REPLAY_PREFIX
+from .metrics import MetricsRegistry, Counter, Gauge
 
 logger = logging.getLogger("aqualogic_mqtt.client")
 
-# Monkey-patch broken serial method in Aqualogic
-def _patched_write_to_serial(self, data):
-    self._serial.write(data)
-    self._serial.flush()
-AquaLogic._write_to_serial = _patched_write_to_serial
+# Only --runtime asyncio needs asyncio, so rather than slowing down every start
+# it is imported (once) by loop_forever_async.
+asyncio = None
+
+# Drives paho from an asyncio event loop instead of its own thread, using paho's
+# external event loop callbacks: the socket is watched by the loop for reads
+# (and writes, only while paho has data queued), and loop_misc is called on a
+# timer for keepalive handling.
+#
+# paho calls these back from whichever thread opens the socket, which for a
+# reconnect is an executor thread (see Client._try_reconnect), so callbacks from
+# other threads are passed to the loop.
+class _AsyncioMqttHelper:
+    _loop = None
+    _client = None
+    _misc = None
+    _misc_interval = None
+
+    def __init__(self, loop, client, misc_interval):
+        self._loop = loop
+        self._client = client
+        self._misc_interval = misc_interval
+        self._loop_thread = threading.get_ident()
+        client.on_socket_open = lambda client, userdata, sock: self._call(self._open, sock)
+        client.on_socket_close = lambda client, userdata, sock: self._call(self._close, sock.fileno())
+        client.on_socket_register_write = lambda client, userdata, sock: self._call(self._register_write, sock)
+        client.on_socket_unregister_write = lambda client, userdata, sock: self._call(self._unregister_write, sock)
+        # The client is usually connected before the loop starts running
+        sock = client.socket()
+        if sock is not None:
+            self._open(sock)
+            if client.want_write():
+                self._register_write(sock)
+
+    def _call(self, fn, arg):
+        if threading.get_ident() == self._loop_thread:
+            fn(arg)
+        else:
+            self._loop.call_soon_threadsafe(fn, arg)
+
+    def _open(self, sock):
+        self._loop.add_reader(sock, self._client.loop_read)
+        if self._misc is None:
+            self._misc = self._loop.create_task(self._misc_loop())
+
+    # Takes the descriptor, as the socket may be closed by the time this runs
+    def _close(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+    def _register_write(self, sock):
+        self._loop.add_writer(sock, self._client.loop_write)
+
+    def _unregister_write(self, sock):
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while True:
+            self._client.loop_misc()
+            await asyncio.sleep(self._misc_interval)
+
+    def close(self):
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
 
 class Client:
-    _panel = None
     _paho_client = None
-    _panel_thread = None
-    _formatter = None
-    _pman = None
-    _disconnect_retries = 3
+    _bridges = None
     _disconnect_retry_wait_max = 30
     _disconnect_retry_wait = 1
-    _disconnect_retry_num = 0
+    _keepalive = 60
+    _loop = None
+    _stopping = False
+    _connected = False
+    _metrics = None
+    _topic_alias_limit = 32
+    _topic_alias_max = 0
+    _availability_topic = None
+    _protocol_num = 5
+    _reconnect_task = None
 
-    def __init__(self, formatter:Messages, panel_manager:PanelManager, client_id=None, transport='tcp', protocol_num=5):
-        self._formatter = formatter
-        self._pman = panel_manager
-        self._panel = AquaLogic(web_port=0)
+    # topic_alias_limit caps the MQTT 5 topic aliases used (fewer if the broker
+    # allows fewer); 0 disables them. availability_topic is the shared availability
+    # topic of several panels (see Messages.get_shared_availability_topic).
+    def __init__(self, client_id=None, transport='tcp', protocol_num=5, metrics:(MetricsRegistry)=None,
+                 topic_alias_limit:(int)=32, availability_topic=None):
+        self._bridges = []
+        self._availability_topic = availability_topic
+        self._protocol_num = protocol_num
+        self._metrics = metrics
+        self._topic_alias_limit = topic_alias_limit if protocol_num == 5 else 0
+        # Topic -> alias for this connection, and alias -> publish Properties
+        self._topic_aliases = {}
+        self._alias_properties = {}
+        # Last-value cache: topic -> (payload, retain) for messages published while
+        # disconnected, replayed (one message per topic) on reconnect.
+        self._lvc = {}
+        self._lvc_lock = threading.Lock()
 
         protocol = mqtt.MQTTv311 if protocol_num == 3 else mqtt.MQTTv5
         self._paho_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
@@ -47,21 +131,114 @@ class Client:
         self._paho_client.on_connect = self._on_connect
         self._paho_client.on_disconnect = self._on_disconnect
         self._paho_client.on_connect_fail = self._on_connect_fail
+        # In thread mode paho's network thread reconnects by itself with this backoff
+        self._paho_client.reconnect_delay_set(1, self._disconnect_retry_wait_max)
 
-    # Respond to panel events
-    def _panel_changed(self, panel):
-        logger.debug(f"_panel_changed called... Publishing to {self._formatter.get_state_topic()}...")
-        self._pman.observe_system_message(panel.check_system_msg)
-        msg = self._formatter.get_state_message(panel, self._pman)
-        logger.debug(msg)
-        self._paho_client.publish(self._formatter.get_state_topic(), msg)
+        self._published = Counter("mqtt_published", "Messages published to the MQTT broker")
+        self._disconnects = Counter("mqtt_disconnects", "Disconnections from the MQTT broker")
+        self._replayed = Counter("mqtt_lvc_replayed", "Messages held while disconnected and published on reconnect")
+        self._aliased = Counter("mqtt_aliased", "Messages published with a topic alias in place of the topic")
+        if metrics is not None:
+            metrics.register(self._published, self._disconnects, self._replayed, self._aliased,
+                Gauge("mqtt_connected", "Whether the MQTT broker is connected", fn=lambda: self._connected),
+                Gauge("mqtt_lvc_held", "Messages held while disconnected", fn=lambda: len(self._lvc)),
+                Gauge("mqtt_out_queue", "Packets waiting to be written to the MQTT broker", fn=self._get_out_queue_depth),
+                Gauge("mqtt_inflight", "QoS 1 and 2 messages awaiting acknowledgement from the MQTT broker",
+                      fn=lambda: len(self._paho_client._out_messages)))
+
+    # Creates a PanelBridge for a controller that will share this client's MQTT
+    # connection. The identifier of each formatter must be unique.
+    def add_panel(self, source:(str), formatter:Messages, panel_manager:PanelManager, **kwargs):
+        if formatter._identifier in [b.get_identifier() for b in self._bridges]:
+            raise RuntimeError(f"Identifier \"{formatter._identifier}\" is already in use by another panel!")
+        bridge = PanelBridge(source, formatter, panel_manager, self._publish,
+                             metrics=self._metrics, mqtt_stats=self.get_mqtt_stats, **kwargs)
+        self._bridges.append(bridge)
+        return bridge
+
+    # All publishing goes through here. While disconnected, messages are held in the
+    # last-value cache instead, where a newer message replaces an older one for the
+    # same topic (e.g. several state updates merge into the latest).
+    def _publish(self, topic, payload, retain=False):
+        with self._lvc_lock:
+            if not self._connected:
+                self._lvc[topic] = (payload, retain)
+                return
+            self._send(topic, payload, retain)
+
+    # Publishes, using an MQTT 5 topic alias when one is (or can be) assigned to the
+    # topic: the first message carries the topic and its alias, later ones only the
+    # alias. Aliases last for the connection. Called with the LVC lock held, which
+    # keeps the first message for an alias ahead of the rest.
+    def _send(self, topic, payload, retain):
+        alias = self._topic_aliases.get(topic)
+        if alias is not None:
+            self._paho_client.publish("", payload, retain=retain, properties=self._alias_properties[alias])
+            self._aliased.inc()
+        elif len(self._topic_aliases) < self._topic_alias_max:
+            alias = len(self._topic_aliases) + 1
+            self._topic_aliases[topic] = alias
+            if alias not in self._alias_properties:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.TopicAlias = alias
+                self._alias_properties[alias] = properties
+            self._paho_client.publish(topic, payload, retain=retain, properties=self._alias_properties[alias])
+        else:
+            self._paho_client.publish(topic, payload, retain=retain)
+        self._published.inc()
+
+    def _replay_lvc(self):
+        with self._lvc_lock:
+            self._connected = True
+            if self._lvc:
+                logger.info(f"Replaying {len(self._lvc)} message(s) held while disconnected")
+            for topic, (payload, retain) in self._lvc.items():
+                self._send(topic, payload, retain)
+                self._replayed.inc()
+            self._lvc.clear()
+
+    # paho has no public accessor for its outgoing packet queue
+    def _get_out_queue_depth(self):
+        return len(self._paho_client._out_packet)
+
+    def get_mqtt_stats(self):
+        return {
+            "connected": self._connected,
+            "published": self._published.get(),
+            "disconnects": self._disconnects.get(),
+            "replayed": self._replayed.get(),
+            "aliased": self._aliased.get(),
+            "held": len(self._lvc),
+            "queue": self._get_out_queue_depth()
+        }
 
     # Respond to MQTT events    
     def _on_message(self, client, userdata, msg):
         logger.debug(f"_on_message called for topic {msg.topic} with payload {msg.payload}")
-        new_messages = self._formatter.handle_message_on_topic(msg.topic, str(msg.payload.decode("utf-8")), self._panel)
-        for t, m in new_messages:
-            self._paho_client.publish(t, m)
+        payload = str(msg.payload.decode("utf-8"))
+        for bridge in self._bridges:
+            response = bridge.handle_request(msg.topic, payload)
+            if response is not None:
+                self._respond(msg, response)
+                continue
+            new_messages = bridge.handle_message(msg.topic, payload)
+            # Responses are discovery configuration, which is retained
+            for t, m in new_messages:
+                self._publish(t, m, retain=True)
+
+    # Publishes a response to a request, to the MQTT 5 response topic of the
+    # request and with its correlation data
+    def _respond(self, request, payload):
+        response_topic = getattr(request.properties, "ResponseTopic", None)
+        if not response_topic:
+            logger.warning(f"Request on {request.topic} has no response topic (MQTT 5 is required), ignoring")
+            return
+        properties = Properties(PacketTypes.PUBLISH)
+        correlation = getattr(request.properties, "CorrelationData", None)
+        if correlation is not None:
+            properties.CorrelationData = correlation
+        self._paho_client.publish(response_topic, payload, properties=properties)
+        self._published.inc()
 
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         logger.debug("_on_connect called")
@@ -72,51 +249,75 @@ class Client:
             #elif : #FIXME: elif what?
             #    logger.debug(f"Got unexpected reason_code when connecting MQTT: {reason_code.getName()}")
             #    logger.debug(reason_code)
-        self._disconnect_retry_num = 0
         self._disconnect_retry_wait = 1
+        with self._lvc_lock:
+            self._topic_aliases.clear()
+            broker_max = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+            self._topic_alias_max = min(self._topic_alias_limit, broker_max)
+        if self._topic_alias_max:
+            logger.debug(f"Using up to {self._topic_alias_max} MQTT topic aliases")
 
-        sub_topics = self._formatter.get_subscription_topics()
-        for topic in sub_topics:
-            self._paho_client.subscribe(topic)
-        logger.debug(f"Publishing to {self._formatter.get_discovery_topic()}...")
-        logger.debug(self._formatter.get_discovery_message())
-        self._paho_client.publish(self._formatter.get_discovery_topic(), self._formatter.get_discovery_message())
-        ...
+        for bridge in self._bridges:
+            formatter = bridge.get_formatter()
+            sub_topics = formatter.get_subscription_topics()
+            for topic in sub_topics:
+                self._paho_client.subscribe(topic)
+            for topic, message in formatter.get_discovery_messages():
+                logger.debug(f"Publishing to {topic}...")
+                logger.debug(message)
+                self._paho_client.publish(topic, message, retain=True)
+            bridge.publish_availability()
+        if self._availability_topic is not None:
+            self._paho_client.publish(self._availability_topic, "online", retain=True)
+        self._replay_lvc()
     
     def _on_connect_fail(self, userdata, reason_code):
         #TODO: Have not been able to reach here, needs testing!
         logger.debug("_on_connect_fail called")
 
+    # Never blocks: in thread mode paho's network thread reconnects by itself (see
+    # reconnect_delay_set), and in asyncio mode a reconnect is scheduled on the loop.
     def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        with self._lvc_lock:
+            self._connected = False
+        self._disconnects.inc()
         if isinstance(reason_code, ReasonCode):
             if reason_code.is_failure:
                 logger.error(f"MQTT Disconnected: {reason_code.getName()}!")
-                #NOTE: Paho documentation is confusing about loop_forever and reconnection. Will
-                # this ever be called when loop_forever "automatically handles reconnecting"? If not, it 
-                # seems this callback is really only hit on initial connect failures?
-                if self._disconnect_retry_num < self._disconnect_retries:
-                    self._disconnect_retry_num += 1
-                    self._disconnect_retry_wait = min(self._disconnect_retry_wait*2, self._disconnect_retry_wait_max)
-                    logger.info(f"Retrying ({self._disconnect_retry_num}) after {self._disconnect_retry_wait}s...")
-                    sleep(self._disconnect_retry_wait)
-                    self._paho_client.reconnect()
-                else:
-                    logger.critical("MQTT connection failed!")
-                    self._paho_client.disconnect()
-                    raise RuntimeError(reason_code)
             else:
                 logger.debug(f"MQTT Disconnected: {reason_code.getName()}")
         elif isinstance(reason_code, int):
             if reason_code > 0:
                 logger.error(f"MQTT Disconnected: {reason_code}")
+        if self._loop is not None and not self._stopping:
+            self._schedule_reconnect()
 
-    def panel_connect(self, source):
-        if ':' in source:
-            s_host, s_port = source.split(':')
-            self._panel.connect(s_host, int(s_port))
-        else:
-            self._panel.connect_serial(source)
-        ...
+    def _schedule_reconnect(self):
+        wait = self._disconnect_retry_wait
+        self._disconnect_retry_wait = min(self._disconnect_retry_wait*2, self._disconnect_retry_wait_max)
+        logger.info(f"Reconnecting MQTT after {wait}s...")
+        self._loop.call_later(wait, self._try_reconnect)
+
+    # paho's reconnect blocks for as long as the socket connect takes (up to its
+    # timeout while the broker is unreachable), so it runs on an executor thread
+    # rather than stalling the panels on the loop. The helper attaches the new
+    # socket to the loop once it is open.
+    def _try_reconnect(self):
+        if self._stopping:
+            return
+        self._reconnect_task = self._loop.create_task(self._reconnect_async())
+
+    async def _reconnect_async(self):
+        try:
+            await self._loop.run_in_executor(None, self._paho_client.reconnect)
+        except Exception as e:
+            logger.error(f"MQTT reconnect failed: {e}")
+            if not self._stopping:
+                self._schedule_reconnect()
+
+    def panel_connect(self):
+        for bridge in self._bridges:
+            bridge.panel_connect()
 
     def mqtt_username_pw_set(self, username:(str), password:(str)):
         return self._paho_client.username_pw_set(username=username, password=password)
@@ -124,6 +325,16 @@ class Client:
     def mqtt_tls_set(self, certfile=None, keyfile=None, cert_reqs=ssl.CERT_REQUIRED):
         return self._paho_client.tls_set(certfile=certfile, keyfile=keyfile, cert_reqs=cert_reqs)
     
+    # The topic the broker publishes "offline" to (retained) if the connection drops
+    # without a clean disconnect: the panel's own availability topic when there is
+    # only one panel, or else the shared availability topic.
+    def get_will_topic(self):
+        if self._availability_topic is not None:
+            return self._availability_topic
+        if len(self._bridges) == 1:
+            return self._bridges[0].get_formatter().get_availability_topic()
+        return None
+
     def mqtt_connect(self, dest:(str), port:(int)=1883, keepalive=60):
         host = dest
         if dest is not None:
@@ -132,25 +343,97 @@ class Client:
                 port = int(port)
             else:
                 host = dest
+        self._keepalive = keepalive
+        will_topic = self.get_will_topic()
+        if will_topic is not None:
+            self._paho_client.will_set(will_topic, "offline", retain=True)
         r = self._paho_client.connect(host, port, keepalive)
         logger.debug(f"Connected to {host}:{port} with result {r}")
 
+    # A clean disconnect doesn't publish the Last Will, so the panels are marked
+    # offline first: with MQTT 5 the broker is asked to publish the will anyway.
+    def _disconnect(self):
+        will_topic = self.get_will_topic()
+        if will_topic is None:
+            self._paho_client.disconnect()
+        elif self._protocol_num == 5:
+            self._paho_client.disconnect(reasoncode=ReasonCode(PacketTypes.DISCONNECT, "Disconnect with will message"))
+        else:
+            self._paho_client.publish(will_topic, "offline", retain=True)
+            self._paho_client.disconnect()
+
     def loop_forever(self):
+        active = list(self._bridges)
         try:
             self._paho_client.loop_start()
-            self._panel_thread = threading.Thread(target=self._panel.process, args=[self._panel_changed])
-            self._panel_thread.daemon = True # https://stackoverflow.com/a/50788759/489116 ?
-            self._panel_thread.start()
+            for bridge in active:
+                bridge.start()
             #self._paho_client.loop_forever()
             while True:
-                logger.debug(f"Update age: {self._pman.get_last_update_age()}")
-                if not self._pman.is_updating():
-                    logger.critical("Panel not updated in "+str(self._pman.get_last_update_age())+"s, exiting!")
+                # Each panel has its own watchdog: a stalled panel is dropped, and
+                # the process only exits once no panel is still updating.
+                for bridge in list(active):
+                    if bridge.is_finished():
+                        bridge.stop()
+                        active.remove(bridge)
+                    elif not bridge.check() and not bridge.handle_stall():
+                        logger.critical(f"Panel {bridge.get_identifier()} not updated in {bridge.get_last_update_age()}s, stopping it!")
+                        bridge.stop()
+                        active.remove(bridge)
+                if not active:
+                    if all(bridge.is_finished() for bridge in self._bridges):
+                        return
+                    logger.critical("No panels updating, exiting!")
                     raise RuntimeError("Panel stopped updating!")
                 sleep(1)
         finally:
+            for bridge in active:
+                bridge.stop()
             self._paho_client.loop_stop()
             pass
+
+    # Runs everything on a single asyncio event loop instead of loop_forever's
+    # threads: panel sources are read as streams, paho is driven by the loop, and
+    # each panel's watchdog is a timer rather than a once-a-second poll. SIGINT and
+    # SIGTERM shut down cleanly.
+    def loop_forever_async(self):
+        global asyncio
+        import asyncio
+        asyncio.run(self._loop_async())
+
+    async def _loop_async(self):
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        helper = _AsyncioMqttHelper(loop, self._paho_client, max(self._keepalive / 4, 1))
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        stop_task = asyncio.create_task(stop.wait())
+        tasks = { asyncio.create_task(bridge.run_async()): bridge for bridge in self._bridges }
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending | {stop_task}, return_when=asyncio.FIRST_COMPLETED)
+                if stop_task in done:
+                    logger.info("Stopping...")
+                    return
+                pending.discard(stop_task)
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.critical(f"Panel {tasks[task].get_identifier()} failed: {task.exception()}")
+            if all(bridge.is_finished() for bridge in self._bridges):
+                return
+            logger.critical("No panels updating, exiting!")
+            raise RuntimeError("Panel stopped updating!")
+        finally:
+            for task in list(tasks) + [stop_task]:
+                task.cancel()
+            await asyncio.gather(*tasks, stop_task, return_exceptions=True)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            self._stopping = True
+            self._disconnect()
+            helper.close()
         
         
 
@@ -169,11 +452,11 @@ if __name__ == "__main__":
     g_group.add_argument('-e', '--enable', nargs="+", action="extend",
         choices=[k for k in Messages.get_valid_entity_meta()], metavar='',
         help=f"enable one or more entities; valid options are: {', '.join([k+' ('+v+')' for k, v in Messages.get_valid_entity_meta().items()])}")
-    g_group.add_argument('-x', '--system-message-expiration', nargs=1, type=int, default=180, metavar="SECONDS",
+    g_group.add_argument('-x', '--system-message-expiration', type=int, default=180, metavar="SECONDS",
         help="seconds after which a Check System message previously seen is dropped from reporting")
     #TODO: metavar here is a bit of a kludge and the help text isn't 100% correct!
     g_group.add_argument('-sms', '--system-message-sensor', nargs="+", type=str, action="append", metavar=("STRING", "KEY [DEV_CLASS]"),
-        help="add a binary sensor that is ON when a given \"Check System\" message appears on the display, with the specified message STRING which will use the MQTT state KEY and optionally device class DEV_CLASS (default is \"problem\")--may be specified multiple times")
+        help="add a binary sensor that is ON when a given \"Check System\" message appears on the display, with the specified message STRING which will use the MQTT state KEY and optionally device class DEV_CLASS (default is \"problem\")--STRING may be a glob prefixed with \"glob:\" such as \"glob:Low Salt*\", or a regular expression prefixed with \"re:\"--may be specified multiple times")
     g_group.add_argument('-v', '--verbose', action="count", default=0,
         help="seconds after which a Check System message previously seen is dropped from reporting")
 
@@ -183,8 +466,20 @@ if __name__ == "__main__":
         help="serial device source (path)")
     source_group_mex.add_argument('-t', '--tcp', type=str, metavar="tcpserialhost:port",
         help="network serial adapter source in the format host:port")
-    source_group.add_argument('-T', '--source-timeout', nargs=1, type=int, default=10, metavar="SECONDS",
-        help="seconds after which the source connection is deemed to be lost if no updates have been seen--the program will exit if the timeout is reached")
+    source_group_mex.add_argument('-R', '--replay', type=str, metavar="FILE",
+        help="replay a capture file recorded with --record instead of connecting to a controller")
+    source_group_mex.add_argument('-P', '--panel', nargs=2, type=str, action="append", metavar=("IDENTIFIER", "SOURCE"),
+        help="add a pool controller with a unique IDENTIFIER, connected to SOURCE (a serial device path, host:port, or replay:FILE)--may be specified multiple times to bridge several controllers over one MQTT connection")
+    source_group.add_argument('-T', '--source-timeout', type=int, default=10, metavar="SECONDS",
+        help="seconds after which the source connection is deemed to be lost if no updates have been seen--the source is then reconnected")
+    source_group.add_argument('--record', type=str, metavar="FILE",
+        help="record the raw byte stream from the source to a capture file; with several panels, FILE must include \"{identifier}\"")
+    source_group.add_argument('--replay-speed', type=float, default=1.0, metavar="FACTOR",
+        help="speed at which --replay plays back the capture relative to real time (default is 1, 0 is as fast as possible)")
+    source_group.add_argument('--no-reconnect', action='store_true',
+        help="exit when the source timeout is reached instead of reconnecting the source")
+    source_group.add_argument('--reconnect-max-wait', type=int, default=60, metavar="SECONDS",
+        help="maximum seconds between source reconnection attempts (default is 60)")
     
     mqtt_group = parser.add_argument_group('MQTT destination options')
     mqtt_group.add_argument('-m', '--mqtt-dest', required=True, type=str, metavar="mqtthost:port",
@@ -197,12 +492,56 @@ if __name__ == "__main__":
         help="ignore certificate validation errors for the MQTT broker (dangerous!)")
     mqtt_group.add_argument('--mqtt-version', type=int, choices=[3,5], default=5, 
         help="MQTT protocol major version number (default is 5)")
+    mqtt_group.add_argument('--mqtt-topic-alias-max', type=int, default=32, metavar="N",
+        help="maximum number of MQTT 5 topic aliases to use, if the broker allows them (default is 32, 0 disables)")
     mqtt_group.add_argument('--mqtt-transport', type=str, choices=["tcp","websockets"], default="tcp",
         help="MQTT transport mode (default is tcp unless dest port is 9001 or 443)")
     
+    pub_group = parser.add_argument_group("publishing options")
+    pub_group.add_argument('--publish-mode', type=str, choices=["changes","always"], default="changes",
+        help="publish state only when it changes, or on every panel update (default is changes)")
+    pub_group.add_argument('--heartbeat', type=int, default=300, metavar="SECONDS",
+        help="seconds after which the full state is re-published even if unchanged, in changes mode (default is 300, 0 disables)")
+    pub_group.add_argument('--sensor-filter', nargs="+", type=str, action="append", metavar=("KEY", "OPTION"),
+        help="filter the values reported for sensor KEY, with one or more OPTIONs: deadband=N or deadband=N%% (ignore changes smaller than N, or N percent), min-interval=SECONDS (report changes at most this often), max-staleness=SECONDS (report a change within the deadband once it has lasted this long)--may be specified multiple times")
+    pub_group.add_argument('--topic-layout', type=str, choices=["json","entity"], default="json",
+        help="publish all state values as one JSON message, or each entity's plain value on its own topic, only when it changes (default is json)")
+    pub_group.add_argument('--retain-state', action='store_true',
+        help="publish state messages with the MQTT retain flag, so that new subscribers get the current state immediately")
+    pub_group.add_argument('--history-size', type=int, default=0, metavar="ROWS",
+        help="keep the last ROWS state changes in memory, and answer MQTT 5 requests for them on [prefix]/device/[identifier]/history/get (default is 0, disabled)")
+    pub_group.add_argument('--coalesce-window', type=int, default=100, metavar="MS",
+        help="milliseconds to wait for a burst of panel updates to settle before publishing (default is 100, 0 disables)")
+    pub_group.add_argument('--coalesce-max-latency', type=int, default=500, metavar="MS",
+        help="maximum milliseconds a panel update may be delayed by coalescing (default is 500)")
+
+    cmd_group = parser.add_argument_group("command options")
+    cmd_group.add_argument('--command-queue-size', type=int, default=16, metavar="N",
+        help="maximum number of distinct commands waiting to be sent to the panel (default is 16)")
+    cmd_group.add_argument('--optimistic', action='store_true',
+        help="publish the commanded state immediately, before the panel confirms it")
+    cmd_group.add_argument('--write-min-interval', type=int, default=0, metavar="MS",
+        help="minimum milliseconds between frames written to the panel; a frame due sooner waits for a later keep-alive (default is 0)")
+    cmd_group.add_argument('--write-retries', type=int, default=2, metavar="N",
+        help="times to retry a failed write to the panel before dropping the frame (default is 2)")
+
+    metrics_group = parser.add_argument_group("metrics options")
+    metrics_group.add_argument('--metrics-port', type=int, metavar="PORT",
+        help="serve runtime metrics in the Prometheus text format at http://HOST:PORT/metrics")
+    metrics_group.add_argument('--metrics-host', type=str, default="127.0.0.1", metavar="HOST",
+        help="address for the metrics endpoint to listen on (default is 127.0.0.1)")
+    metrics_group.add_argument('--diagnostics-interval', type=int, default=0, metavar="SECONDS",
+        help="add Home Assistant diagnostic sensors for the adapter itself (frame rate, publish rate, command latency, reconnects, MQTT queue), published every SECONDS (default is 0, disabled)")
+
+    rt_group = parser.add_argument_group("runtime options")
+    rt_group.add_argument('--runtime', type=str, choices=["threads","asyncio"], default="threads",
+        help="run panel sources and MQTT on separate threads, or on a single asyncio event loop (default is threads)")
+
     ha_group = parser.add_argument_group("Home Assistant options")
     ha_group.add_argument('-p', '--discover-prefix', default="homeassistant", type=str, 
         help="MQTT prefix path (default is \"homeassistant\")")
+    ha_group.add_argument('--discovery-layout', type=str, choices=["device","component"], default="device",
+        help="publish discovery as a single device document, or as one config topic per entity (default is device)")
         
     args = parser.parse_args()
 
@@ -217,32 +556,78 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.ERROR)
     
-    source = args.serial if args.serial is not None else args.tcp
+    if args.panel is not None:
+        panels = args.panel
+    elif args.replay is not None:
+        panels = [["aqualogic", REPLAY_PREFIX + args.replay]]
+    else:
+        panels = [["aqualogic", args.serial if args.serial is not None else args.tcp]]
+    if args.record is not None and len(panels) > 1 and "{identifier}" not in args.record:
+        parser.error("--record FILE must include \"{identifier}\" when several panels are configured")
     dest = args.mqtt_dest
+    for sms in args.system_message_sensor if args.system_message_sensor is not None else []:
+        try:
+            SystemMessageMatcher.compile_pattern(sms[0])
+        except ValueError as e:
+            parser.error(f"--system-message-sensor: {e}")
+    sensor_filter_specs = {}
+    for spec in args.sensor_filter if args.sensor_filter is not None else []:
+        if spec[0] not in Messages.get_sensor_dict():
+            parser.error(f"--sensor-filter KEY must be one of: {', '.join(Messages.get_sensor_dict())}")
+        if args.enable is None or spec[0] not in args.enable:
+            parser.error(f"--sensor-filter {spec[0]} needs the sensor to be enabled with -e {spec[0]}")
+        if len(spec) < 2:
+            parser.error(f"--sensor-filter {spec[0]} needs at least one OPTION")
+        try:
+            SensorFilter.parse(spec[1:])
+        except ValueError as e:
+            parser.error(f"--sensor-filter {spec[0]}: {e}")
+        sensor_filter_specs[spec[0]] = spec[1:]
+
+    metrics = MetricsRegistry() if args.metrics_port is not None else None
+    shared_availability_topic = None
+    if len(panels) > 1:
+        shared_availability_topic = Messages.get_shared_availability_topic(args.discover_prefix, [i for i, _ in panels])
+    mqtt_client = Client(client_id=args.mqtt_clientid, transport=args.mqtt_transport,
+                         protocol_num=args.mqtt_version, metrics=metrics,
+                         topic_alias_limit=args.mqtt_topic_alias_max, availability_topic=shared_availability_topic)
+    for identifier, source in panels:
+        formatter = Messages(identifier=identifier, discover_prefix=args.discover_prefix,
+                             enable=args.enable if args.enable is not None else [], 
+                             system_message_sensors=args.system_message_sensor if args.system_message_sensor is not None else [],
+                             diagnostics=args.diagnostics_interval > 0, topic_layout=args.topic_layout,
+                             sensor_filters={ k: SensorFilter.parse(v) for k, v in sensor_filter_specs.items() },
+                             discovery_layout=args.discovery_layout, history=args.history_size > 0,
+                             shared_availability_topic=shared_availability_topic)
+        pman = PanelManager(args.source_timeout, args.system_message_expiration,
+                            display_parser=DisplayParser() if formatter.has_display_sensors() else None)
+        mqtt_client.add_panel(source, formatter, pman,
+                              publish_mode=args.publish_mode, heartbeat_interval=args.heartbeat,
+                              coalesce_window=args.coalesce_window/1000, coalesce_max_latency=args.coalesce_max_latency/1000,
+                              command_queue_size=args.command_queue_size, optimistic=args.optimistic,
+                              retain_state=args.retain_state, reconnect=not args.no_reconnect, reconnect_wait_max=args.reconnect_max_wait,
+                              record=args.record.replace("{identifier}", identifier) if args.record is not None else None,
+                              replay_speed=args.replay_speed, diagnostics_interval=args.diagnostics_interval,
+                              write_min_interval=args.write_min_interval/1000, write_retries=args.write_retries,
+                              history_size=args.history_size)
 
-    pman = PanelManager(args.source_timeout, args.system_message_expiration)
-    # Monkey-patch PanelManager into _web so we can avoid running the web server without an error
-    AquaLogic._web = pman
-    
-    formatter = Messages(identifier="aqualogic", discover_prefix=args.discover_prefix,
-                         enable=args.enable if args.enable is not None else [], 
-                         system_message_sensors=args.system_message_sensor if args.system_message_sensor is not None else [])
-    
-    mqtt_client = Client(formatter=formatter, panel_manager=pman,
-                         client_id=args.mqtt_clientid, transport=args.mqtt_transport, 
-                         protocol_num=args.mqtt_version
-                         )
     if args.mqtt_username is not None:
         mqtt_password = args.mqtt_password if args.mqtt_password is not None else mqtt_password
         mqtt_client.mqtt_username_pw_set(args.mqtt_username, mqtt_password)
     #TODO Broker client cert
     if args.mqtt_insecure:
         mqtt_client.mqtt_tls_set(cert_reqs=ssl.CERT_NONE)
+    if metrics is not None:
+        metrics.serve(args.metrics_host, args.metrics_port)
     print("Connecting MQTT...")
     mqtt_client.mqtt_connect(dest=dest)
-    print("Connecting Controller...")
-    mqtt_client.panel_connect(source)
-    print("Starting loop...")
-    mqtt_client.loop_forever()
+    if args.runtime == "asyncio":
+        print("Starting asyncio loop...")
+        mqtt_client.loop_forever_async()
+    else:
+        print("Connecting Controller...")
+        mqtt_client.panel_connect()
+        print("Starting loop...")
+        mqtt_client.loop_forever()
 
     
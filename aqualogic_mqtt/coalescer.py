@@ -0,0 +1,113 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Collapses bursts of panel updates into a single emit. An emit happens once no
+# new update has been offered for `window` seconds, or at the latest `max_latency`
+# seconds after the first update of the burst, whichever comes first. The emit
+# callback is expected to read the latest panel state itself, so nothing is lost
+# by dropping the intermediate updates.
+#
+# The emit is driven either by a worker thread (start) or, when everything runs
+# on an asyncio event loop, by a loop timer (start_async); offer must then be
+# called from the loop's thread.
+class Coalescer:
+    _emit = None
+    _window = None
+    _max_latency = None
+    _thread = None
+    _loop = None
+    _timer = None
+    _first = None
+    _last = None
+    _stopped = False
+    _offered_count = 0
+    _emitted_count = 0
+
+    def __init__(self, emit, window:(float), max_latency:(float)):
+        self._emit = emit
+        self._window = window
+        self._max_latency = max(max_latency, window)
+        self._cond = threading.Condition()
+
+    def offer(self):
+        with self._cond:
+            now = time.monotonic()
+            if self._first is None:
+                self._first = now
+            self._last = now
+            self._offered_count += 1
+            if self._loop is not None:
+                if self._timer is None:
+                    self._timer = self._loop.call_at(self._loop.time() + self._window, self._fire)
+            else:
+                self._cond.notify()
+
+    def _deadline(self):
+        return min(self._last + self._window, self._first + self._max_latency)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and self._first is None:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                remaining = self._deadline() - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._first = self._last = None
+                self._emitted_count += 1
+            try:
+                self._emit()
+            except Exception:
+                logger.exception("Coalesced emit failed")
+
+    def _fire(self):
+        self._timer = None
+        if self._stopped or self._first is None:
+            return
+        remaining = self._deadline() - time.monotonic()
+        if remaining > 0:
+            self._timer = self._loop.call_at(self._loop.time() + remaining, self._fire)
+            return
+        self._first = self._last = None
+        self._emitted_count += 1
+        try:
+            self._emit()
+        except Exception:
+            logger.exception("Coalesced emit failed")
+
+    # Emits immediately if there is anything pending
+    def flush(self):
+        with self._cond:
+            if self._first is None:
+                return
+            self._first = self._last = None
+            self._emitted_count += 1
+        self._emit()
+
+    def start_async(self, loop):
+        self._loop = loop
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="coalescer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def get_stats(self):
+        return {
+            "offered": self._offered_count,
+            "emitted": self._emitted_count
+        }
@@ -0,0 +1,98 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# A bounded queue of panel commands serviced by its own worker thread, so that
+# MQTT callbacks never wait on the panel. Only the latest command for a given
+# state is kept: repeated or contradictory commands for the same entity that
+# arrive before the worker gets to them are collapsed in place.
+#
+# When running on an asyncio event loop (start_async) there is no worker thread;
+# the queue is drained by a callback scheduled on the loop instead, and set_state
+# must be called from the loop's thread.
+class CommandQueue:
+    _execute = None
+    _maxsize = None
+    _thread = None
+    _loop = None
+    _drain_scheduled = False
+    _stopped = False
+    _coalesced_count = 0
+    _dropped_count = 0
+
+    def __init__(self, execute, maxsize:(int)=16):
+        self._execute = execute
+        self._maxsize = maxsize
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+
+    # Same signature as AquaLogic.set_state, so this can be handed to
+    # Messages.handle_message_on_topic in its place. The execute callable is
+    # called as execute(state, enable, received).
+    def set_state(self, state, enable):
+        with self._cond:
+            if state in self._pending:
+                self._coalesced_count += 1
+                received = self._pending[state][1]
+            elif len(self._pending) >= self._maxsize:
+                self._dropped_count += 1
+                logger.warning(f"Command queue full, dropping command for {state}")
+                return False
+            else:
+                received = time.monotonic()
+            self._pending[state] = (enable, received)
+            if self._loop is not None:
+                if not self._drain_scheduled:
+                    self._drain_scheduled = True
+                    self._loop.call_soon(self._drain)
+            else:
+                self._cond.notify()
+        return True
+
+    def _drain(self):
+        self._drain_scheduled = False
+        while self._pending and not self._stopped:
+            state, (enable, received) = self._pending.popitem(last=False)
+            try:
+                self._execute(state, enable, received)
+            except Exception:
+                logger.exception(f"Command for {state} failed")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._pending:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                state, (enable, received) = self._pending.popitem(last=False)
+            try:
+                self._execute(state, enable, received)
+            except Exception:
+                logger.exception(f"Command for {state} failed")
+
+    def start_async(self, loop):
+        self._loop = loop
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="commands")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def get_depth(self):
+        return len(self._pending)
+
+    def get_stats(self):
+        return {
+            "depth": self.get_depth(),
+            "coalesced": self._coalesced_count,
+            "dropped": self._dropped_count
+        }
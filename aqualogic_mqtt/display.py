@@ -0,0 +1,100 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The panel cycles through the same handful of screens, so the result for each
+# distinct display text is cached; past this many (the clock screen alone shows
+# a new text every minute) the cache is simply started over.
+_CACHE_MAX = 256
+_NO_VALUES = {}
+
+def _number(s):
+    return float(s) if '.' in s else int(s)
+
+def _clock(m):
+    hour = int(m["hour"])
+    ampm = (m["ampm"] or "").upper()
+    if ampm == "P" and hour < 12:
+        hour += 12
+    elif ampm == "A" and hour == 12:
+        hour = 0
+    return { "time": f"{m['day']} {hour:02d}:{m['minute']}" }
+
+# Screens recognised, as (pattern, function of the match returning display
+# values). Patterns are matched against the display text with runs of whitespace
+# collapsed. Readings that AquaLogic already parses (temperatures, salt level,
+# chlorinator percentages, Check System) aren't repeated here.
+_SCREENS = [
+    # Pool Heater1 80°F, Spa Heater1 Set to 102°F
+    (re.compile(r"(?P<body>Pool|Spa) Heater ?\d? (?:Set ?[Pp]oint |Set [Tt]o )?(?P<temp>\d+)°[CF]"),
+     lambda m: { "sp_p" if m["body"] == "Pool" else "sp_s": int(m["temp"]) }),
+    # Heater1 Auto Control, Heater1 Manual Off
+    (re.compile(r"Heater ?1 (?P<state>\D.*)"),
+     lambda m: { "htr": m["state"] }),
+    # Instant Salt 3150 PPM, Average Salt Level 3100 PPM
+    (re.compile(r"(?P<kind>Instant|Average) Salt(?: Level)? (?P<value>\d+(?:\.\d+)?) ?(?:PPM|ppm|g/L)"),
+     lambda m: { "salt_i" if m["kind"] == "Instant" else "salt_a": _number(m["value"]) }),
+    # Cell Voltage 24.5V
+    (re.compile(r"Cell Voltage (?P<value>\d+(?:\.\d+)?) ?V"),
+     lambda m: { "cell_v": _number(m["value"]) }),
+    # Cell Current 5.1A
+    (re.compile(r"Cell Current (?P<value>\d+(?:\.\d+)?) ?A"),
+     lambda m: { "cell_a": _number(m["value"]) }),
+    # Chlorinator 24.5V 5.1A
+    (re.compile(r"(?:Cell|Chlorinator) (?P<volts>\d+(?:\.\d+)?) ?V (?P<amps>\d+(?:\.\d+)?) ?A"),
+     lambda m: { "cell_v": _number(m["volts"]), "cell_a": _number(m["amps"]) }),
+    # Cell Temp 80°F
+    (re.compile(r"Cell Temp(?:erature)? (?P<temp>\d+)°[CF]"),
+     lambda m: { "cell_t": int(m["temp"]) }),
+    # Wednesday 3:45P, Wednesday 15:45
+    (re.compile(r"(?P<day>Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday) "
+                r"(?P<hour>\d{1,2}):(?P<minute>\d{2}) ?(?:(?P<ampm>[AaPp])[Mm]?)?"),
+     _clock),
+]
+
+# Extracts values the panel only shows on its display (heater setpoints, heater
+# state, salt cell diagnostics, the panel clock) from the display text passed to
+# PanelManager.text_updated, keeping the latest value seen for each.
+class DisplayParser:
+    _parsed_count = 0
+
+    def __init__(self):
+        self._cache = {}
+        self._values = {}
+
+    # Returns the display values shown by text, an empty dict if none
+    def parse(self, text:(str)):
+        values = self._cache.get(text)
+        if values is None:
+            values = _NO_VALUES
+            normalized = ' '.join(text.split())
+            for pattern, extract in _SCREENS:
+                m = pattern.fullmatch(normalized)
+                if m is not None:
+                    try:
+                        values = extract(m)
+                    except ValueError:
+                        logger.debug(f"Unparseable display text: {normalized}")
+                    break
+            self._parsed_count += 1
+            if len(self._cache) >= _CACHE_MAX:
+                self._cache.clear()
+            self._cache[text] = values
+        return values
+
+    # Parses text and keeps its values. Returns True if any value changed.
+    def update(self, text:(str)):
+        changed = False
+        for key, value in self.parse(text).items():
+            if self._values.get(key) != value:
+                self._values[key] = value
+                changed = True
+        return changed
+
+    def get_values(self):
+        return self._values
+
+    # Display texts actually parsed, i.e. not found in the cache
+    def get_parsed_count(self):
+        return self._parsed_count
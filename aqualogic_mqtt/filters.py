@@ -0,0 +1,110 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Filters the value reported for a numeric sensor so that jitter between
+# adjacent readings doesn't turn into a publish each time:
+#
+# - deadband: a new reading is only reported once it differs from the value last
+#   reported by at least this much (or this percentage of it, if deadband_pct)
+# - min_interval: the reported value changes at most once per this many seconds
+# - max_staleness: a reading within the deadband is reported anyway once readings
+#   have differed from the reported value for this many seconds, so that small
+#   drifts aren't lost
+#
+# Non-numeric readings (including None) are always reported as they come.
+#
+# A filter is only applied when the state is serialized, so a held reading would
+# wait for the next publish; get_next_due tells the caller when to publish again
+# for the held reading to go out.
+class SensorFilter:
+    _deadband = 0
+    _deadband_pct = False
+    _min_interval = 0
+    _max_staleness = None
+    _reported = None
+    _reported_at = None
+    _held_since = None
+    _held_at = None
+    _held_count = 0
+
+    def __init__(self, deadband:(float)=0, deadband_pct:(bool)=False, min_interval:(float)=0, max_staleness:(float)=None):
+        self._deadband = deadband
+        self._deadband_pct = deadband_pct
+        self._min_interval = min_interval
+        self._max_staleness = max_staleness
+
+    def apply(self, value):
+        if value == self._reported and self._reported_at is not None:
+            self._held_since = None
+            return value
+        now = time.monotonic()
+        if self._reported_at is not None and self._should_hold(value, now):
+            if self._held_since is None:
+                self._held_since = now
+            self._held_at = now
+            self._held_count += 1
+            return self._reported
+        self._reported = value
+        self._reported_at = now
+        self._held_since = None
+        return value
+
+    def _should_hold(self, value, now):
+        reported = self._reported
+        if not isinstance(value, (int, float)) or not isinstance(reported, (int, float)):
+            return False
+        if now - self._reported_at < self._min_interval:
+            return True
+        # Readings have differed from the reported value for long enough
+        if (self._max_staleness is not None and self._held_since is not None
+                and now - self._held_since >= self._max_staleness):
+            return False
+        band = abs(reported) * self._deadband / 100 if self._deadband_pct else self._deadband
+        return abs(value - reported) < band
+
+    # The monotonic time at which the reading last held back may be reported if it
+    # is applied again: when min_interval runs out, or max_staleness is reached,
+    # whichever is first and came after it was held. None if no reading is held,
+    # or if it is held until the reading changes (within the deadband, without
+    # max_staleness).
+    def get_next_due(self):
+        if self._held_since is None:
+            return None
+        due = []
+        if self._min_interval:
+            due.append(self._reported_at + self._min_interval)
+        if self._max_staleness is not None:
+            due.append(self._held_since + self._max_staleness)
+        due = [t for t in due if t > self._held_at]
+        return min(due) if due else None
+
+    # The value last reported by apply
+    def get_reported(self):
+        return self._reported
+
+    def get_held_count(self):
+        return self._held_count
+
+    # Parses option strings of the form deadband=N, deadband=N%, min-interval=S and
+    # max-staleness=S into a SensorFilter. Raises ValueError for anything else.
+    @staticmethod
+    def parse(options:(list)):
+        kwargs = {}
+        for option in options:
+            name, sep, value = option.partition('=')
+            if not sep:
+                raise ValueError(f"expected NAME=VALUE, got \"{option}\"")
+            if name not in ("deadband", "min-interval", "max-staleness"):
+                raise ValueError(f"unknown filter option \"{name}\"")
+            try:
+                number = float(value.rstrip('%') if name == "deadband" else value)
+            except ValueError:
+                raise ValueError(f"invalid value for {name}: \"{value}\"")
+            if name == "deadband":
+                kwargs["deadband"] = number
+                kwargs["deadband_pct"] = value.endswith('%')
+            else:
+                kwargs[name.replace('-', '_')] = number
+        return SensorFilter(**kwargs)
@@ -0,0 +1,140 @@
+import time
+import math
+import threading
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Column kinds, with the array type each is stored as and the value standing in
+# for unknown (None)
+BOOL = "bool"
+NUMBER = "number"
+TEXT = "text"
+_TYPECODES = { BOOL: 'b', NUMBER: 'd', TEXT: 'i' }
+_UNKNOWN = { BOOL: -1, NUMBER: math.nan, TEXT: -1 }
+
+# A fixed-size ring buffer of timestamped state snapshots, stored as one array
+# per column (plus one of timestamps) rather than as a list of dicts, so that its
+# memory use is fixed by the capacity and the columns: 8 bytes per row for the
+# timestamp, and 1, 8 or 4 bytes per row for each bool, number or text column.
+# Text values are stored as indexes into a per-column table of distinct strings,
+# which is compacted once it holds twice as many strings as there are rows.
+#
+# A snapshot identical to the last one recorded is not recorded again. Recording
+# and reading may happen on different threads.
+class StateHistory:
+    _count = 0
+    _next = 0
+    _last = None
+
+    # columns is a list of (key, kind), kind being BOOL, NUMBER or TEXT
+    def __init__(self, columns:(list), capacity:(int)):
+        self._keys = [key for key, _ in columns]
+        self._kinds = [kind for _, kind in columns]
+        self._capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._columns = [array(_TYPECODES[kind], [_UNKNOWN[kind]]) * capacity for kind in self._kinds]
+        # For each text column: (list of strings, string -> index)
+        self._strings = { i: ([], {}) for i, kind in enumerate(self._kinds) if kind == TEXT }
+        self._lock = threading.Lock()
+
+    def get_keys(self):
+        return self._keys
+
+    def get_capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._count
+
+    # values are in column order: bools, numbers (or None) and strings (or None).
+    # Returns False if the snapshot was the same as the last one and not recorded.
+    def record(self, values:(list), timestamp=None):
+        if values == self._last:
+            return False
+        self._last = list(values)
+        with self._lock:
+            row = self._next
+            self._times[row] = time.time() if timestamp is None else timestamp
+            for i, value in enumerate(values):
+                self._columns[i][row] = self._encode(i, value)
+            self._next = (row + 1) % self._capacity
+            self._count = min(self._count + 1, self._capacity)
+        return True
+
+    def _encode(self, i, value):
+        if value is None:
+            return _UNKNOWN[self._kinds[i]]
+        kind = self._kinds[i]
+        if kind == BOOL:
+            return 1 if value else 0
+        if kind == NUMBER:
+            return float(value)
+        strings, index = self._strings[i]
+        n = index.get(value)
+        if n is None:
+            if len(strings) >= 2 * self._capacity:
+                self._compact(i)
+                strings, index = self._strings[i]
+            n = len(strings)
+            strings.append(value)
+            index[value] = n
+        return n
+
+    # Rebuilds a text column's string table from the strings still referenced
+    def _compact(self, i):
+        strings, _ = self._strings[i]
+        column = self._columns[i]
+        new_strings = []
+        new_index = {}
+        for row in range(self._capacity):
+            n = column[row]
+            if n < 0:
+                continue
+            s = strings[n]
+            m = new_index.get(s)
+            if m is None:
+                m = len(new_strings)
+                new_strings.append(s)
+                new_index[s] = m
+            column[row] = m
+        self._strings[i] = (new_strings, new_index)
+        logger.debug(f"Compacted history strings for {self._keys[i]}: {len(strings)} -> {len(new_strings)}")
+
+    def _decode(self, i, raw):
+        kind = self._kinds[i]
+        if kind == BOOL:
+            return None if raw < 0 else raw == 1
+        if kind == NUMBER:
+            if math.isnan(raw):
+                return None
+            return int(raw) if raw.is_integer() else raw
+        return None if raw < 0 else self._strings[i][0][raw]
+
+    # Returns the rows recorded after since (a Unix time), oldest first, limited to
+    # the latest limit rows, as columns: { "t": [times], key: [values], ... }.
+    # keys restricts the columns returned.
+    def get_columns(self, since=None, limit=None, keys=None):
+        with self._lock:
+            return self._get_columns(since, limit, keys)
+
+    def _get_columns(self, since, limit, keys):
+        start = (self._next - self._count) % self._capacity
+        rows = [(start + n) % self._capacity for n in range(self._count)]
+        if since is not None:
+            rows = [row for row in rows if self._times[row] > since]
+        if limit is not None:
+            rows = rows[-limit:] if limit > 0 else []
+        result = { "t": [round(self._times[row], 3) for row in rows] }
+        for i, key in enumerate(self._keys):
+            if keys is not None and key not in keys:
+                continue
+            column = self._columns[i]
+            result[key] = [self._decode(i, column[row]) for row in rows]
+        return result
+
+    # Approximate bytes held by the buffer (not counting the strings themselves)
+    def get_size(self):
+        return (self._times.itemsize * len(self._times)
+                + sum(c.itemsize * len(c) for c in self._columns))
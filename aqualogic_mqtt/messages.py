@@ -1,22 +1,75 @@
 import json
 import logging
-from aqualogic.core import AquaLogic
-from aqualogic.states import States
+from operator import attrgetter
 
+from .panel import States
 from .panelmanager import PanelManager
+from .metrics import Counter
+from .filters import SensorFilter
+from .sysmatch import SystemMessageMatcher
+from .history import BOOL, NUMBER, TEXT
 
 logger = logging.getLogger(__name__)
+
+_json_encode = json.JSONEncoder().encode
+_CHECK_SYSTEM_BIT = int(States.CHECK_SYSTEM.value)
+
+# Equivalent to json.dumps() for a single value, with a shortcut for the types
+# that panel attributes usually hold.
+def _json_value(value):
+    if value is None:
+        return "null"
+    if type(value) is int:
+        return int.__repr__(value)
+    return _json_encode(value)
+
+# A single value as a plain payload for the per-entity topic layout; "None" is
+# what Home Assistant takes as an unknown state.
+def _plain_value(value):
+    if type(value) is int:
+        return int.__repr__(value)
+    return str(value)
+
 class Messages:
     _identifier = None
     _discover_prefix = None
     _root = None
     _control_dict = None
     _sensor_dict = None
+    _display_sensor_dict = None
     _system_message_sensor_dict = None
     _ha_status_path = None
     _onoff = {False: "OFF", True: "ON"}
+    _onoff_json = {False: '"OFF"', True: '"ON"'}
+    _state_keys = None
+    _state_template = None
+    _sensor_getters = None
+    _history_getters = None
+    _display_keys = None
+    _control_states = None
+    _control_state_bits = None
+    _system_message_matcher = None
+    _command_topics = None
+    _diagnostic_dict = None
+    _topic_layout = "json"
+    _onoff_plain = {False: "OFF", True: "ON"}
+    _entity_ids = None
+    _entity_topics = None
+    _sensor_filters = None
+    _discovery_layout = "device"
+    _discovery_message = None
+    _history = False
+    _shared_availability_topic = None
     
-    def __init__(self, identifier, discover_prefix, enable, system_message_sensors):
+    # topic_layout is "json" for one state topic carrying every value, or "entity"
+    # for a plain value topic per entity. sensor_filters optionally maps enabled
+    # sensor keys to a SensorFilter applied to their values. discovery_layout is
+    # "device" for a single discovery document, or "component" for a config topic
+    # per component. history adds the state history request topic.
+    # shared_availability_topic, when several panels share one MQTT connection (see
+    # get_shared_availability_topic), is advertised alongside the panel's own.
+    def __init__(self, identifier, discover_prefix, enable, system_message_sensors, diagnostics=False, topic_layout="json",
+                 sensor_filters:(dict)=None, discovery_layout="device", history=False, shared_availability_topic=None):
         self._identifier = identifier #TODO: Sanitize?
         self._discover_prefix = discover_prefix #TODO: Sanitize?
         self._root = f"{self._discover_prefix}/device/{self._identifier}"
@@ -24,8 +77,79 @@ class Messages:
 
         self._control_dict = { k:v for k,v in Messages.get_control_dict(self._identifier).items() if k in enable }
         self._sensor_dict = { k:v for k,v in Messages.get_sensor_dict(self._identifier).items() if k in enable }
+        self._display_sensor_dict = { k:v for k,v in Messages.get_display_sensor_dict(self._identifier).items() if k in enable }
         self._system_message_sensor_dict = Messages.get_system_message_sensor_dict(self._identifier, system_message_sensors)
+        self._diagnostic_dict = Messages.get_diagnostic_dict(self._identifier) if diagnostics else {}
+        self._topic_layout = topic_layout
+        self._sensor_filters = sensor_filters if sensor_filters is not None else {}
+        for k in self._sensor_filters:
+            if k not in self._sensor_dict:
+                raise RuntimeError(f"Filter key \"{k}\" is not an enabled sensor!")
+        self._history = history
+        self._shared_availability_topic = shared_availability_topic
+        self._compile_state_serializer()
+        self._discovery_layout = discovery_layout
+        self._compile_discovery()
+        self._command_topics = { f"{self._root}/{v['id']}/set": v for v in self._control_dict.values() }
+        self._commands = Counter("commands_dispatched", "MQTT commands dispatched to a panel control")
+        self._discovery_requests = Counter("discovery_requests", "Discovery messages sent in response to a Home Assistant birth message")
+
+    def register_metrics(self, registry, labels:(dict)):
+        held = Counter("sensor_values_held", "Sensor readings held back by a filter",
+                       fn=lambda: sum(f.get_held_count() for f in self._sensor_filters.values()))
+        for metric in (self._commands, self._discovery_requests, held):
+            metric.labels = labels
+        registry.register(self._commands, self._discovery_requests, held)
+
+    # The enabled entity set is fixed at construction, so the state message layout
+    # is compiled once into a template with a fixed key order (matching what
+    # json.dumps would produce for the equivalent dict) plus flat accessor lists;
+    # get_state_message then only has to format the values.
+    def _compile_state_serializer(self):
+        keys = (["cs", "sysm"] + list(self._sensor_dict.keys()) + list(self._display_sensor_dict.keys())
+                + list(self._control_dict.keys()) + list(self._system_message_sensor_dict.keys()))
+        self._state_keys = keys
+        self._state_template = "{" + ", ".join(
+            _json_encode(k).replace("%", "%%") + ": %s" for k in keys
+        ) + "}"
+        self._sensor_getters = [self._compile_sensor_getter(k, v) for k, v in self._sensor_dict.items()]
+        self._display_keys = list(self._display_sensor_dict.keys())
+        self._history_getters = [self._compile_history_getter(k, v) for k, v in self._sensor_dict.items()]
+        self._control_states = [v['state'] for v in self._control_dict.values()]
+        self._control_state_bits = [int(v['state'].value) for v in self._control_dict.values()]
+        self._system_message_matcher = SystemMessageMatcher([v['name'] for v in self._system_message_sensor_dict.values()])
+        # Entity IDs in the same order as the state values, for the entity layout
+        self._entity_ids = ([f"{self._identifier}_binary_sensor_check_system", f"{self._identifier}_sensor_system_messages"]
+                            + [v['id'] for v in self._sensor_dict.values()] + [v['id'] for v in self._display_sensor_dict.values()]
+                            + [v['id'] for v in self._control_dict.values()]
+                            + [v['id'] for v in self._system_message_sensor_dict.values()])
+        self._entity_topics = [self.get_entity_state_topic(entity_id) for entity_id in self._entity_ids]
     
+    # The state history records the values as they were last published, so filtered
+    # sensors give their last reported value rather than going through the filter
+    # a second time.
+    def _compile_history_getter(self, key, sensor):
+        sensor_filter = self._sensor_filters.get(key)
+        if sensor_filter is None:
+            return attrgetter(sensor['attr'])
+        return lambda panel: sensor_filter.get_reported()
+
+    # Filtered sensors read through their filter, so that the filtered value is what
+    # gets serialized in either topic layout; the rest cost no more than before.
+    def _compile_sensor_getter(self, key, sensor):
+        getter = attrgetter(sensor['attr'])
+        sensor_filter = self._sensor_filters.get(key)
+        if sensor_filter is None:
+            return getter
+        apply = sensor_filter.apply
+        return lambda panel: apply(getter(panel))
+
+    # The soonest monotonic time at which a sensor filter may report a reading it
+    # has held back (see SensorFilter.get_next_due), or None
+    def get_next_filter_due(self):
+        due = [t for t in (f.get_next_due() for f in self._sensor_filters.values()) if t is not None]
+        return min(due) if due else None
+
     def get_id_for_string(input:(str)):
         return '_'.join(''.join(map(
             lambda c: c if str.isidentifier(c) or str.isdecimal(c) else ' ',
@@ -127,6 +251,30 @@ class Messages:
             }
         }
     
+    # Sensors for values the panel only shows on its display, extracted by a
+    # DisplayParser; the keys are the DisplayParser value keys.
+    def get_display_sensor_dict(identifier = "aqualogic"):
+        return {
+            "sp_p": { "id": f"{ identifier }_sensor_pool_setpoint", "name": "Pool Heater Setpoint",
+                      "dev_cla": "temperature", "unit_of_meas": "°F" },
+            "sp_s": { "id": f"{ identifier }_sensor_spa_setpoint", "name": "Spa Heater Setpoint",
+                      "dev_cla": "temperature", "unit_of_meas": "°F" },
+            "htr": { "id": f"{ identifier }_sensor_heater_state", "name": "Heater State",
+                     "dev_cla": None, "unit_of_meas": None, "text": True },
+            "salt_i": { "id": f"{ identifier }_sensor_instant_salt_level", "name": "Instant Salt Level",
+                        "dev_cla": None, "unit_of_meas": "ppm" },
+            "salt_a": { "id": f"{ identifier }_sensor_average_salt_level", "name": "Average Salt Level",
+                        "dev_cla": None, "unit_of_meas": "ppm" },
+            "cell_v": { "id": f"{ identifier }_sensor_cell_voltage", "name": "Cell Voltage",
+                        "dev_cla": "voltage", "unit_of_meas": "V" },
+            "cell_a": { "id": f"{ identifier }_sensor_cell_current", "name": "Cell Current",
+                        "dev_cla": "current", "unit_of_meas": "A" },
+            "cell_t": { "id": f"{ identifier }_sensor_cell_temperature", "name": "Cell Temperature",
+                        "dev_cla": "temperature", "unit_of_meas": "°F" },
+            "time": { "id": f"{ identifier }_sensor_panel_time", "name": "Panel Time",
+                      "dev_cla": None, "unit_of_meas": None, "text": True }
+        }
+
     def get_system_message_sensor_dict(identifier = "aqualogic", system_message_sensors = []):
         reserved_keys = [k for k in Messages.get_valid_entity_meta()]+['cs','sysm']
         result =  {}
@@ -145,50 +293,196 @@ class Messages:
             }
         return result
 
+    # Diagnostic sensors (Home Assistant entity category "diagnostic") reporting on
+    # the bridge itself, published separately on the diagnostics topic.
+    def get_diagnostic_dict(identifier = "aqualogic"):
+        return {
+            "fps": { "id": f"{ identifier }_diagnostic_frame_rate", "name": "Panel Frame Rate",
+                     "dev_cla": None, "unit_of_meas": "frames/s", "stat_cla": "measurement" },
+            "upd_s": { "id": f"{ identifier }_diagnostic_update_interval", "name": "Panel Update Interval",
+                       "dev_cla": "duration", "unit_of_meas": "s", "stat_cla": "measurement" },
+            "pub_min": { "id": f"{ identifier }_diagnostic_publish_rate", "name": "State Publish Rate",
+                         "dev_cla": None, "unit_of_meas": "msg/min", "stat_cla": "measurement" },
+            "cmd_ms": { "id": f"{ identifier }_diagnostic_command_latency", "name": "Command Latency",
+                        "dev_cla": "duration", "unit_of_meas": "ms", "stat_cla": "measurement" },
+            "reconn": { "id": f"{ identifier }_diagnostic_reconnects", "name": "Panel Reconnects",
+                        "dev_cla": None, "unit_of_meas": None, "stat_cla": "total_increasing" },
+            "mqtt_q": { "id": f"{ identifier }_diagnostic_mqtt_queue", "name": "MQTT Outgoing Queue",
+                        "dev_cla": None, "unit_of_meas": None, "stat_cla": "measurement" },
+            "mqtt_disc": { "id": f"{ identifier }_diagnostic_mqtt_disconnects", "name": "MQTT Disconnects",
+                           "dev_cla": None, "unit_of_meas": None, "stat_cla": "total_increasing" }
+        }
+
     def get_valid_entity_meta():
-        return { k: v['name'] for k, v in (Messages.get_sensor_dict() | Messages.get_control_dict()).items() }
+        return { k: v['name'] for k, v in (Messages.get_sensor_dict() | Messages.get_display_sensor_dict()
+                                          | Messages.get_control_dict()).items() }
 
     def get_subscription_topics(self):
-        return [f"{self._discover_prefix}/device/{self._identifier}/+/set"]
-    
-    def get_discovery_topic(self):
-        return f"{self._root}/config"
+        topics = [f"{self._discover_prefix}/device/{self._identifier}/+/set"]
+        if self._history:
+            topics.append(self.get_history_request_topic())
+        return topics
+
+    def get_history_request_topic(self):
+        return f"{self._root}/history/get"
+
+    # The state history columns, as (key, kind) in state value order
+    def get_history_columns(self):
+        kinds = ([BOOL, TEXT] + [NUMBER] * len(self._sensor_dict)
+                 + [TEXT if v.get("text") else NUMBER for v in self._display_sensor_dict.values()]
+                 + [BOOL] * (len(self._control_dict) + len(self._system_message_sensor_dict)))
+        return list(zip(self._state_keys, kinds))
+
+    # Parses a history request: a JSON object with optional "since" (a Unix time),
+    # "limit" (rows) and "keys" (columns), or an empty payload for everything.
+    # Returns (since, limit, keys); raises ValueError for a malformed request.
+    def parse_history_request(self, payload:(str)):
+        request = json.loads(payload) if payload.strip() else {}
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        since = request.get("since")
+        limit = request.get("limit")
+        keys = request.get("keys")
+        if since is not None and not isinstance(since, (int, float)):
+            raise ValueError("since must be a number")
+        if limit is not None and not isinstance(limit, int):
+            raise ValueError("limit must be an integer")
+        if keys is not None and (not isinstance(keys, list) or not all(k in self._state_keys for k in keys)):
+            raise ValueError(f"keys must be a list of: {', '.join(self._state_keys)}")
+        return since, limit, keys
+
+    # columns as returned by StateHistory.get_columns, with bools given as ON/OFF
+    # like the state message
+    def get_history_response(self, columns:(dict)):
+        onoff = self._onoff
+        return json.dumps({ k: [v if type(v) is not bool else onoff[v] for v in values]
+                            for k, values in columns.items() }, separators=(',', ':'))
     
     def get_state_topic(self):
         return f"{self._root}/state"
+
+    def get_topic_layout(self):
+        return self._topic_layout
+
+    def get_entity_state_topic(self, entity_id:(str)):
+        return f"{self._root}/{entity_id}/state"
+
+    def get_availability_topic(self):
+        return f"{self._root}/availability"
+
+    # The availability topic of the MQTT connection shared by several panels, which
+    # carries its Last Will: an MQTT connection can only have one, so the panels
+    # can't each have theirs on their own availability topic.
+    @staticmethod
+    def get_shared_availability_topic(discover_prefix, identifiers:(list)):
+        return f"{discover_prefix}/aqualogic_mqtt/{'_'.join(identifiers)}/availability"
+
+    def get_diagnostics_topic(self):
+        return f"{self._root}/diagnostics"
+
+    def has_diagnostics(self):
+        return bool(self._diagnostic_dict)
+
+    # Whether any display sensors are enabled, which need the PanelManager to have
+    # a DisplayParser
+    def has_display_sensors(self):
+        return bool(self._display_sensor_dict)
+
+    # values maps the keys of get_diagnostic_dict to their current values
+    def get_diagnostics_message(self, values:(dict)):
+        return json.dumps({ k: values.get(k) for k in self._diagnostic_dict })
     
-    def get_state_message(self, panel, panel_manager:(PanelManager)):
+    # overrides optionally maps States to the value to report in place of the
+    # panel's own (e.g. for optimistic updates while a command is in flight).
+    def get_state_message(self, panel, panel_manager:(PanelManager), overrides=None):
         sysm = panel_manager.get_system_messages()
+        onoff = self._onoff_json
 
-        state = {
-            "cs": self._onoff[panel.get_state(States.CHECK_SYSTEM)],
-            "sysm": ', '.join(sysm)
-        }
-        for k, v in self._sensor_dict.items():
-            state[k] = getattr(panel, v['attr'])
+        if panel._send_queue.empty():
+            # Nothing pending, so AquaLogic.get_state would just test the LED bits;
+            # do that directly on a plain int rather than once per control.
+            states = int(panel._states)
+            values = [onoff[(states & _CHECK_SYSTEM_BIT) != 0], _json_encode(', '.join(sysm))]
+            values += [_json_value(getter(panel)) for getter in self._sensor_getters]
+            if self._display_keys:
+                display = panel_manager.get_display_values()
+                values += [_json_value(display.get(k)) for k in self._display_keys]
+            values += [onoff[(states & bit) != 0] for bit in self._control_state_bits]
+        else:
+            get_state = panel.get_state
+            values = [onoff[get_state(States.CHECK_SYSTEM)], _json_encode(', '.join(sysm))]
+            values += [_json_value(getter(panel)) for getter in self._sensor_getters]
+            if self._display_keys:
+                display = panel_manager.get_display_values()
+                values += [_json_value(display.get(k)) for k in self._display_keys]
+            values += [onoff[get_state(state)] for state in self._control_states]
+
+        if overrides:
+            offset = 2 + len(self._sensor_getters) + len(self._display_keys)
+            for i, state in enumerate(self._control_states):
+                if state in overrides:
+                    values[offset + i] = onoff[overrides[state]]
+        values += [onoff[matched] for matched in self._system_message_matcher.evaluate(sysm)]
 
-        for k, v in self._control_dict.items():
-            state[k] = self._onoff[panel.get_state(v['state'])]
+        return self._state_template % tuple(values)
 
-        for k, v in self._system_message_sensor_dict.items():
-            state[k] = self._onoff[v["name"] in sysm]
+    # The values of get_state_message before formatting, in the same order, for the
+    # state history: bools for binary entities, raw sensor values and strings.
+    def get_state_values(self, panel, panel_manager:(PanelManager), overrides=None):
+        sysm = panel_manager.get_system_messages()
+        get_state = panel.get_state
+        values = [get_state(States.CHECK_SYSTEM), ', '.join(sysm)]
+        values += [getter(panel) for getter in self._history_getters]
+        if self._display_keys:
+            display = panel_manager.get_display_values()
+            values += [display.get(k) for k in self._display_keys]
+        values += [overrides[state] if overrides and state in overrides else get_state(state)
+                   for state in self._control_states]
+        values += self._system_message_matcher.evaluate(sysm)
+        return values
 
-        return json.dumps(state)
+    # The entity layout equivalent of get_state_message: a list of (topic, plain
+    # value) with an entry for every entity, in a fixed order.
+    # The system messages are sent as a JSON string, as with no messages a plain
+    # value would be an empty payload, which clears a retained message instead.
+    def get_entity_state_messages(self, panel, panel_manager:(PanelManager), overrides=None):
+        sysm = panel_manager.get_system_messages()
+        onoff = self._onoff_plain
+        get_state = panel.get_state
+        values = [onoff[get_state(States.CHECK_SYSTEM)], _json_encode(', '.join(sysm))]
+        values += [_plain_value(getter(panel)) for getter in self._sensor_getters]
+        if self._display_keys:
+            display = panel_manager.get_display_values()
+            values += [_plain_value(display.get(k)) for k in self._display_keys]
+        values += [onoff[overrides[state] if overrides and state in overrides else get_state(state)]
+                   for state in self._control_states]
+        values += [onoff[matched] for matched in self._system_message_matcher.evaluate(sysm)]
+        return list(zip(self._entity_topics, values))
     
     #TODO: ^ and v move out of this class, to divorce it from Aqualogic panel?
 
-    def handle_message_on_topic(self, topic, msg, panel):
-        if topic == self._ha_status_path and msg == "online": #TODO: Make configurable?
-            return [(self.get_discovery_topic(), self.get_discovery_message())] 
-        
-        state_dict_filtered = { k:v for (k,v) in self._control_dict.items() if f"{self._root}/{v['id']}/set" == topic }
-        logger.debug(f"{state_dict_filtered=}")
-        for k,v in state_dict_filtered.items(): # Really there will be only one...
-            panel.set_state(v['state'], True if msg == "ON" else False)
+    # Returns a list of (topic, message) tuples to publish (retained) in response.
+    # Commands are passed to set_state, which has the signature of AquaLogic.set_state.
+    def handle_message_on_topic(self, topic, msg, set_state):
+        if topic == self._ha_status_path:
+            # The device document is re-sent (from cache) when Home Assistant comes
+            # online. Per-component config topics are left to the broker's retained
+            # copies, so that a restart doesn't set off one message per component.
+            if msg == "online" and self._discovery_layout == "device": #TODO: Make configurable?
+                self._discovery_requests.inc()
+                return self.get_discovery_messages()
             return []
 
-    def get_discovery_message(self):
-        p =  {
+        control = self._command_topics.get(topic)
+        if control is None:
+            logger.debug(f"No command handler for topic {topic}")
+            return []
+        self._commands.inc()
+        set_state(control['state'], True if msg == "ON" else False)
+        return []
+
+    def _get_discovery_device(self):
+        return {
             "dev": {
                 "ids": self._identifier,
                 "name": self._identifier,
@@ -202,27 +496,45 @@ class Messages:
                 "name":"aqualogic_mqtt",
                 "sw": "0.0.1a",
                 "url": "https://github.com/SphtKr/aqualogic_mqtt"
-            },
-            "cmps": {
-                f"{ self._identifier }_binary_sensor_check_system": {
-                    "p": "binary_sensor",
-                    "dev_cla":"problem",
-                    "val_tpl":"{{ value_json.cs }}",
-                    "obj_id": f"{ self._identifier }_binary_sensor_check_system",
-                    "uniq_id": f"{ self._identifier }_binary_sensor_check_system",
-                    "name": "Check System"
-                },
-                f"{ self._identifier }_sensor_system_messages": {
-                    "p": "sensor",
-                    "val_tpl":"{{ value_json.sysm }}",
-                    "obj_id": f"{ self._identifier }_sensor_system_messages",
-                    "uniq_id": f"{ self._identifier }_sensor_system_messages",
-                    "name": "System Messages"
-                }
-            },
+            }
+        }
+
+    # Options shared by every component
+    def _get_discovery_shared(self):
+        shared = {
             "stat_t": self.get_state_topic(),
+            "avty_t": self.get_availability_topic(),
             "qos": 2
         }
+        if self._shared_availability_topic is not None:
+            # Available only while both the panel link and the connection are up
+            del shared["avty_t"]
+            shared["avty"] = [{ "t": self.get_availability_topic() }, { "t": self._shared_availability_topic }]
+            shared["avty_mode"] = "all"
+        if self._topic_layout == "entity":
+            # Each entity reads its own plain value topic instead
+            del shared["stat_t"]
+        return shared
+
+    # Builds the discovery components for the enabled entities: component ID -> dict
+    def _build_components(self):
+        cmps = {
+            f"{ self._identifier }_binary_sensor_check_system": {
+                "p": "binary_sensor",
+                "dev_cla":"problem",
+                "val_tpl":"{{ value_json.cs }}",
+                "obj_id": f"{ self._identifier }_binary_sensor_check_system",
+                "uniq_id": f"{ self._identifier }_binary_sensor_check_system",
+                "name": "Check System"
+            },
+            f"{ self._identifier }_sensor_system_messages": {
+                "p": "sensor",
+                "val_tpl":"{{ value_json.sysm }}",
+                "obj_id": f"{ self._identifier }_sensor_system_messages",
+                "uniq_id": f"{ self._identifier }_sensor_system_messages",
+                "name": "System Messages"
+            }
+        }
         for k,v in self._sensor_dict.items():
             cmp = {
                 "p": v["p"],
@@ -233,7 +545,19 @@ class Messages:
                 "uniq_id": v["id"],
                 "name": v["name"]
             }
-            p['cmps'][v["id"]] = cmp
+            cmps[v["id"]] = cmp
+
+        for k,v in self._display_sensor_dict.items():
+            cmp = {
+                "p": "sensor",
+                "dev_cla": v["dev_cla"],
+                "unit_of_meas": v["unit_of_meas"],
+                "val_tpl":"{{ value_json." + k + " }}",
+                "obj_id": v["id"],
+                "uniq_id": v["id"],
+                "name": v["name"]
+            }
+            cmps[v["id"]] = cmp
 
         for k,v in self._control_dict.items():
             cmp = {
@@ -250,7 +574,7 @@ class Messages:
                 cmp['stat_val_tpl'] = cmp['val_tpl']
                 del cmp['val_tpl']
                 del cmp['dev_cla']
-            p['cmps'][v["id"]] = cmp
+            cmps[v["id"]] = cmp
 
         for k,v in self._system_message_sensor_dict.items():
             cmp = {
@@ -261,6 +585,77 @@ class Messages:
                 "uniq_id": v["id"],
                 "name": v["name"]
             }
-            p['cmps'][v["id"]] = cmp
+            cmps[v["id"]] = cmp
+
+        for k,v in self._diagnostic_dict.items():
+            cmp = {
+                "p": "sensor",
+                "ent_cat": "diagnostic",
+                "dev_cla": v["dev_cla"],
+                "unit_of_meas": v["unit_of_meas"],
+                "stat_cla": v["stat_cla"],
+                "stat_t": self.get_diagnostics_topic(),
+                "val_tpl":"{{ value_json." + k + " }}",
+                "obj_id": v["id"],
+                "uniq_id": v["id"],
+                "name": v["name"]
+            }
+            cmps[v["id"]] = cmp
+
+        if self._topic_layout == "entity":
+            # Each entity reads its own plain value topic, with no template
+            for entity_id in self._entity_ids:
+                cmp = cmps[entity_id]
+                cmp.pop("val_tpl", None)
+                cmp.pop("stat_val_tpl", None)
+                cmp["stat_t"] = self.get_entity_state_topic(entity_id)
+            # ...except for the system messages, a JSON string (see get_entity_state_messages)
+            cmps[f"{ self._identifier }_sensor_system_messages"]["val_tpl"] = "{{ value_json }}"
+
+        return cmps
+
+    # The enabled entities are fixed at construction, so the discovery document (or
+    # each component's config, in the "component" layout) is built and serialized
+    # once, and the cached copy is sent on every (re)connect and birth message.
+    def _compile_discovery(self):
+        device = self._get_discovery_device()
+        shared = self._get_discovery_shared()
+        # Spliced around the components to give exactly what json.dumps produces
+        # for the whole document
+        self._discovery_head = json.dumps(device)[:-1] + ', "cmps": {'
+        self._discovery_tail = "}, " + json.dumps(shared)[1:]
+        # Per-component config topics carry the device and shared options themselves
+        self._discovery_component_base = device | shared
+        self._discovery_components = {}
+        self._discovery_component_messages = {}
+        for cmp_id, cmp in self._build_components().items():
+            self._set_component(cmp_id, cmp)
+        self._discovery_message = None
+
+    def _set_component(self, cmp_id, cmp):
+        self._discovery_components[cmp_id] = (cmp["p"], _json_encode(cmp_id) + ": " + json.dumps(cmp))
+        if self._discovery_layout == "component":
+            payload = self._discovery_component_base | { k: v for k, v in cmp.items() if k != "p" }
+            self._discovery_component_messages[cmp_id] = json.dumps(payload)
+
+    def get_discovery_topic(self):
+        return f"{self._root}/config"
+
+    def get_component_discovery_topic(self, platform:(str), cmp_id:(str)):
+        return f"{self._discover_prefix}/{platform}/{self._identifier}/{cmp_id}/config"
+
+    def get_discovery_message(self):
+        if self._discovery_message is None:
+            self._discovery_message = (self._discovery_head
+                                       + ", ".join(entry for _, entry in self._discovery_components.values())
+                                       + self._discovery_tail)
+        return self._discovery_message
 
-        return json.dumps(p)
+    # Returns the (topic, message) tuples that make up the discovery configuration,
+    # to be published retained: a single device document, or with the "component"
+    # discovery layout, one config topic per component.
+    def get_discovery_messages(self):
+        if self._discovery_layout == "component":
+            return [(self.get_component_discovery_topic(platform, cmp_id), self._discovery_component_messages[cmp_id])
+                    for cmp_id, (platform, _) in self._discovery_components.items()]
+        return [(self.get_discovery_topic(), self.get_discovery_message())]
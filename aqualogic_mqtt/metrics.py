@@ -0,0 +1,162 @@
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Lightweight instruments for runtime statistics. They are always kept (updating
+# one costs about the same as the plain counters they replaced), but are only
+# exported when registered with a MetricsRegistry, which renders them in the
+# Prometheus text format for the optional /metrics endpoint.
+#
+# Updates are not locked: a rare lost increment from concurrent threads is
+# acceptable for statistics.
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if value is True or value is False:
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+    _value = 0
+    _fn = None
+
+    # fn, if given, is called for the value instead (for counts kept elsewhere)
+    def __init__(self, name:(str), help:(str), labels:(dict)=None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self._fn = fn
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def get(self):
+        return self._fn() if self._fn is not None else self._value
+
+    def samples(self):
+        return [("_total", self.labels, self.get())]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self._value = value
+
+    def samples(self):
+        return [("", self.labels, self.get())]
+
+# Durations in seconds by default
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    kind = "histogram"
+    _count = 0
+    _sum = 0
+    _max = 0
+
+    def __init__(self, name:(str), help:(str), labels:(dict)=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self._bounds = list(buckets)
+        # The last bucket counts observations above every bound (+Inf)
+        self._buckets = [0] * (len(self._bounds) + 1)
+
+    def observe(self, value):
+        self._buckets[bisect.bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._sum += value
+        if value > self._max:
+            self._max = value
+
+    def get_count(self):
+        return self._count
+
+    def get_sum(self):
+        return self._sum
+
+    def get_avg(self):
+        return self._sum / self._count if self._count else None
+
+    def get_max(self):
+        return self._max
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + ["+Inf"], self._buckets):
+            cumulative += count
+            result.append(("_bucket", self.labels | {"le": bound}, cumulative))
+        result.append(("_sum", self.labels, self._sum))
+        result.append(("_count", self.labels, self._count))
+        return result
+
+class MetricsRegistry:
+    _server = None
+
+    def __init__(self, prefix:(str)="aqualogic"):
+        self._prefix = prefix
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, *metrics):
+        with self._lock:
+            self._metrics += metrics
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        described = set()
+        # Group samples of the same name (e.g. one per panel) under one HELP/TYPE
+        for metric in sorted(metrics, key=lambda m: m.name):
+            name = f"{self._prefix}_{metric.name}"
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {metric.help}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    # Serves render() at /metrics over HTTP from a daemon thread
+    def serve(self, host:(str)="127.0.0.1", port:(int)=9100):
+        # Imported here, as most runs never serve metrics
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        logger.info(f"Serving metrics on http://{host}:{self._server.server_address[1]}/metrics")
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
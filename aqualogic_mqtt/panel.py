@@ -0,0 +1,26 @@
+import sys
+import types
+import logging
+
+logger = logging.getLogger(__name__)
+
+# aqualogic.core imports aqualogic.web at the top, which pulls in aiohttp and
+# websockets (most of our startup time and memory) for a web server we never
+# run: panels are created with web_port=0, and PanelManager stands in for the
+# server (see PanelManager.text_updated). So unless aqualogic.core has already
+# been loaded, aqualogic.web is registered as a stub before importing it.
+#
+# Import AquaLogic, States and Keys from here rather than from aqualogic.
+
+class WebServer:
+    def __init__(self, panel):
+        raise RuntimeError("aqualogic's web server is not available in aqualogic_mqtt; use web_port=0")
+
+if "aqualogic.core" not in sys.modules and "aqualogic.web" not in sys.modules:
+    _web = types.ModuleType("aqualogic.web")
+    _web.WebServer = WebServer
+    sys.modules["aqualogic.web"] = _web
+
+from aqualogic.core import AquaLogic
+from aqualogic.states import States
+from aqualogic.keys import Keys
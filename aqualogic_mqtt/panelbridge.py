@@ -0,0 +1,713 @@
+import threading
+import logging
+import time
+import socket
+import json
+
+from .panel import AquaLogic
+from .messages import Messages
+from .panelmanager import PanelManager
+from .coalescer import Coalescer
+from .commandqueue import CommandQueue
+from .writer import FrameWriter
+from .history import StateHistory
+from .stream import FrameFeeder, AsyncSource, REPLAY_PREFIX
+from .capture import CaptureWriter, pace_capture
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Imported by run_async, for the same reason as in the client
+asyncio = None
+
+# Everything belonging to a single pool controller: the AquaLogic panel and its
+# source, the Messages formatter and PanelManager, and the publishing and command
+# pipelines between them. Several bridges can share one MQTT connection, which
+# is passed in as a publish(topic, payload, retain=False) callable.
+class PanelBridge:
+    _source = None
+    _panel = None
+    _panel_thread = None
+    _formatter = None
+    _pman = None
+    _publish = None
+    _publish_mode = "changes"
+    _heartbeat_interval = 300
+    _retain_state = False
+    _last_state_msg = None
+    _last_state_publish = None
+    _coalescer = None
+    _command_queue = None
+    _writer = None
+    _next_received = None
+    _next_attempts = 0
+    _history = None
+    _optimistic = False
+    _inflight_timeout = 30
+    _reconnect = True
+    _reconnect_wait_max = 60
+    _reconnect_wait = 1
+    _connected = False
+    _available = None
+    _link_lost_at = None
+    _recovery_last = None
+    _capture = None
+    _replay_speed = 1.0
+    _finished = False
+    _pending_since = None
+    _count_frames = False
+    _mqtt_stats = None
+    _diagnostics_interval = 0
+    _diagnostics_last = None
+
+    def __init__(self, source:(str), formatter:Messages, panel_manager:PanelManager, publish,
+                 publish_mode="changes", heartbeat_interval=300, coalesce_window=0.1, coalesce_max_latency=0.5,
+                 command_queue_size=16, optimistic=False, retain_state=False, reconnect=True, reconnect_wait_max=60,
+                 record=None, replay_speed=1.0, metrics=None, diagnostics_interval=0, mqtt_stats=None,
+                 write_min_interval=0, write_retries=2, history_size=0):
+        self._source = source
+        self._formatter = formatter
+        self._pman = panel_manager
+        self._publish = publish
+        self._panel = AquaLogic(web_port=0)
+        # PanelManager stands in for aqualogic's web server (see PanelManager.text_updated)
+        self._panel._web = self._pman
+        self._panel._send_frame = self._send_frame_timed
+        # All writes to the source go through the writer, which owns its handle
+        self._panel._write = self._write_frame
+        self._writer = FrameWriter(write_min_interval, write_retries)
+        self._writer.set_written_listener(self._frame_written)
+        self._writer.set_retry_listener(self._retry_frame)
+        self._publish_mode = publish_mode
+        self._heartbeat_interval = heartbeat_interval
+        self._retain_state = retain_state
+        self._publish_lock = threading.Lock()
+        # Entity layout: topic -> last value published
+        self._last_entity_values = {}
+        if coalesce_window > 0:
+            self._coalescer = Coalescer(self._publish_current_state, coalesce_window, coalesce_max_latency)
+        self._command_queue = CommandQueue(self._set_panel_state, command_queue_size)
+        self._optimistic = optimistic
+        # States with a command sent but not yet confirmed by the panel: state -> (enable, received)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._pman.set_system_messages_listener(self._system_messages_changed)
+        self._pman.set_display_values_listener(self._display_values_changed)
+        self._reconnect = reconnect
+        self._reconnect_wait_max = reconnect_wait_max
+        self._link_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        if record is not None:
+            self._capture = CaptureWriter(record)
+        self._replay_speed = replay_speed
+        if history_size > 0:
+            self._history = StateHistory(formatter.get_history_columns(), history_size)
+        self._create_metrics()
+        if formatter.has_diagnostics():
+            self._diagnostics_interval = diagnostics_interval
+            self._mqtt_stats = mqtt_stats
+        # Counting frames in thread mode costs a little per byte, so only when wanted
+        self._count_frames = metrics is not None or bool(self._diagnostics_interval)
+        if metrics is not None:
+            self._register_metrics(metrics)
+
+    def _create_metrics(self):
+        self._frames = Counter("panel_frames", "Frames received from the panel")
+        self._published = Counter("state_published", "State messages published")
+        self._suppressed = Counter("state_suppressed", "State messages suppressed as unchanged")
+        self._publish_latency = Histogram("publish_latency_seconds", "Time from a panel update to its state being published")
+        self._commands_received = Counter("commands_received", "MQTT commands received for the panel")
+        self._command_write_latency = Histogram("command_write_latency_seconds", "Time from an MQTT command to its key frame being written")
+        self._command_completion = Histogram("command_completion_seconds", "Time from an MQTT command to the panel confirming it")
+        self._commands_failed = Counter("commands_failed", "MQTT commands not confirmed by the panel in time")
+        self._reconnects = Counter("panel_reconnects", "Panel source reconnection attempts")
+        self._history_requests = Counter("history_requests", "State history requests answered")
+        self._link_recovery = Histogram("panel_link_recovery_seconds", "Time from losing the panel link to it being restored",
+                                        buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600))
+
+    def _register_metrics(self, registry):
+        labels = { "panel": self.get_identifier() }
+        metrics = [
+            self._frames, self._published, self._suppressed, self._publish_latency,
+            self._commands_received, self._command_write_latency, self._command_completion,
+            self._commands_failed, self._reconnects, self._link_recovery, self._history_requests,
+            Gauge("panel_available", "Whether the panel link is up", fn=lambda: self._available),
+            Gauge("panel_update_age_seconds", "Seconds since the last display update from the panel",
+                  fn=self.get_last_update_age),
+            Gauge("command_queue_depth", "Commands waiting to be sent to the panel", fn=self._command_queue.get_depth),
+            Counter("command_queue_coalesced", "Commands replaced by a newer command for the same control before being sent",
+                    fn=lambda: self._command_queue.get_stats()["coalesced"]),
+            Counter("command_queue_dropped", "Commands dropped because the command queue was full",
+                    fn=lambda: self._command_queue.get_stats()["dropped"]),
+        ]
+        if self._coalescer is not None:
+            metrics += [
+                Counter("coalescer_offered", "Panel updates offered for publishing",
+                        fn=lambda: self._coalescer.get_stats()["offered"]),
+                Counter("coalescer_emitted", "Coalesced publishes of panel updates",
+                        fn=lambda: self._coalescer.get_stats()["emitted"]),
+            ]
+        for metric in metrics:
+            metric.labels = labels
+        registry.register(*metrics)
+        self._writer.register_metrics(registry, labels)
+        self._pman.register_metrics(registry, labels)
+        self._formatter.register_metrics(registry, labels)
+
+    def get_identifier(self):
+        return self._formatter._identifier
+
+    def get_formatter(self):
+        return self._formatter
+
+    # Respond to panel events
+    def _panel_changed(self, panel):
+        logger.debug(f"_panel_changed called... Publishing to {self._formatter.get_state_topic()}...")
+        self._pman.observe_system_message(panel.check_system_msg)
+        self._request_publish()
+
+    # Called by the PanelManager when a system message appears or expires, which
+    # may happen without any new panel update.
+    def _system_messages_changed(self, messages):
+        self._request_publish()
+
+    # Called by the PanelManager when a display sensor value changes
+    def _display_values_changed(self, values):
+        self._request_publish()
+
+    def _request_publish(self):
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        if self._coalescer is not None:
+            self._coalescer.offer()
+        else:
+            self._publish_current_state()
+
+    def _publish_current_state(self, force=False):
+        overrides = self._reconcile_inflight()
+        if not self._optimistic:
+            overrides = None
+        if self._formatter.get_topic_layout() == "entity":
+            self._publish_entity_states(self._formatter.get_entity_state_messages(self._panel, self._pman, overrides), force)
+        else:
+            msg = self._formatter.get_state_message(self._panel, self._pman, overrides)
+            logger.debug(msg)
+            self._publish_state(msg, force)
+        if self._history is not None:
+            self._history.record(self._formatter.get_state_values(self._panel, self._pman, overrides))
+
+    # Time from the first panel update not yet reflected in a published (or
+    # suppressed) state until now. Called with the publish lock held.
+    def _observe_publish_latency(self):
+        if self._pending_since is not None:
+            self._publish_latency.observe(time.monotonic() - self._pending_since)
+            self._pending_since = None
+
+    # In "changes" mode a state message identical to the last one sent is suppressed;
+    # force=True (used for heartbeats) always publishes.
+    def _publish_state(self, msg, force=False):
+        with self._publish_lock:
+            self._observe_publish_latency()
+            if not force and self._publish_mode == "changes" and msg == self._last_state_msg:
+                self._suppressed.inc()
+                return
+            self._publish(self._formatter.get_state_topic(), msg, retain=self._retain_state)
+            self._last_state_msg = msg
+            self._last_state_publish = time.monotonic()
+            self._published.inc()
+
+    # The entity layout equivalent of _publish_state: in "changes" mode only the
+    # entity values that differ from the last ones sent are published.
+    def _publish_entity_states(self, messages, force=False):
+        with self._publish_lock:
+            self._observe_publish_latency()
+            last = self._last_entity_values
+            if not force and self._publish_mode == "changes":
+                messages = [(topic, value) for topic, value in messages if last.get(topic) != value]
+                if not messages:
+                    self._suppressed.inc()
+                    return
+            for topic, value in messages:
+                logger.debug(f"{topic}: {value}")
+                self._publish(topic, value, retain=self._retain_state)
+                last[topic] = value
+            self._last_state_publish = time.monotonic()
+            self._published.inc()
+
+    # Publishes again once a sensor filter may report a reading it held back, which
+    # would otherwise wait for some other update to be published.
+    def _check_filters(self):
+        due = self._formatter.get_next_filter_due()
+        if due is not None and due <= time.monotonic():
+            logger.debug(f"Publishing held sensor values for {self.get_identifier()}...")
+            self._publish_current_state()
+
+    # Periodically re-send the full state so late subscribers converge even when
+    # nothing has changed. There is no heartbeat until the panel's state has been
+    # published once, so that a state with nothing known yet is never sent.
+    def _check_heartbeat(self):
+        if self._publish_mode != "changes" or not self._heartbeat_interval or self._last_state_publish is None:
+            return
+        if time.monotonic() - self._last_state_publish < self._heartbeat_interval:
+            return
+        logger.debug(f"Publishing heartbeat state for {self.get_identifier()}...")
+        self._publish_current_state(force=True)
+        logger.info(f"Publish stats for {self.get_identifier()}: {self.get_publish_stats()}")
+        logger.info(f"Command stats for {self.get_identifier()}: {self.get_command_stats()}")
+        logger.info(f"Link stats for {self.get_identifier()}: {self.get_link_stats()}")
+
+    def get_publish_stats(self):
+        latency = self._publish_latency.get_avg()
+        stats = {
+            "published": self._published.get(),
+            "suppressed": self._suppressed.get(),
+            "latency_avg_ms": latency * 1000 if latency is not None else None,
+            "latency_max_ms": self._publish_latency.get_max() * 1000
+        }
+        if self._coalescer is not None:
+            stats["coalesced"] = self._coalescer.get_stats()
+        return stats
+
+    # Called from the command queue worker for each (coalesced) MQTT command, so that
+    # each command can be timed through to the frame being written.
+    def _set_panel_state(self, state, enable, received):
+        result = self._panel.set_state(state, enable)
+        for data in list(self._panel._send_queue.queue):
+            data.setdefault('received', received)
+        return result
+
+    # Stands in for AquaLogic.set_state when dispatching MQTT commands.
+    def _queue_panel_state(self, state, enable):
+        self._commands_received.inc()
+        if not self._command_queue.set_state(state, enable):
+            return False
+        with self._inflight_lock:
+            received = self._inflight[state][1] if state in self._inflight else time.monotonic()
+            self._inflight[state] = (enable, received)
+        if self._optimistic:
+            self._publish_current_state()
+        return True
+
+    # Drops in-flight commands that the panel LEDs now confirm (or that have timed
+    # out), and returns the overrides still to be reported optimistically.
+    def _reconcile_inflight(self):
+        with self._inflight_lock:
+            if not self._inflight:
+                return None
+            now = time.monotonic()
+            states = int(self._panel._states)
+            for state, (enable, received) in list(self._inflight.items()):
+                if ((states & state.value) != 0) == enable:
+                    del self._inflight[state]
+                    latency = now - received
+                    self._command_completion.observe(latency)
+                    logger.debug(f"Command for {state} confirmed by panel after {latency*1000:.0f}ms")
+                elif now - received > self._inflight_timeout:
+                    del self._inflight[state]
+                    self._commands_failed.inc()
+                    logger.warning(f"Command for {state} not confirmed by panel after {self._inflight_timeout}s")
+            return { state: enable for state, (enable, received) in self._inflight.items() }
+
+    # Replaces AquaLogic._send_frame on our panel instance, which is called from the
+    # process loop when a keep-alive frame gives us a chance to write.
+    def _send_frame_timed(self):
+        if not self._writer.is_ready():
+            return # Leave the frame queued for a later keep-alive
+        pending = list(self._panel._send_queue.queue)
+        # Pop the timestamp so that retries of the same frame are not counted again
+        self._next_received = pending[0].pop('received', None) if pending else None
+        self._next_attempts = pending[0].pop('attempts', 0) if pending else 0
+        AquaLogic._send_frame(self._panel)
+
+    # Replaces AquaLogic._write on our panel instance: hands the frame to the
+    # writer rather than writing it on the calling (panel) thread.
+    def _write_frame(self, frame):
+        received, self._next_received = self._next_received, None
+        attempts, self._next_attempts = self._next_attempts, 0
+        self._writer.submit(frame, received, attempts)
+
+    # Called from the writer when writing a frame failed: the frame is queued
+    # again, to be written in a later keep-alive slot once the writer is ready.
+    # aqualogic checks the state a command asked for when it was first sent, so
+    # the retry carries no desired states of its own (but the key must be there,
+    # as AquaLogic.get_state reads it from every queued frame).
+    def _retry_frame(self, frame, received, attempts):
+        self._panel._send_queue.put({ 'frame': frame, 'desired_states': [], 'received': received, 'attempts': attempts })
+
+    # Called from the writer once a frame carrying a command has been written
+    def _frame_written(self, received, written):
+        latency = written - received
+        self._command_write_latency.observe(latency)
+        logger.debug(f"Command written to panel {latency*1000:.0f}ms after it was received")
+
+    # Raw writers for the source handles, used by the writer thread
+    def _write_serial(self, data):
+        self._panel._serial.write(data)
+        self._panel._serial.flush()
+
+    def _write_socket(self, data):
+        self._panel._socket.sendall(data)
+
+    def get_command_stats(self):
+        latency = self._command_write_latency.get_avg()
+        completion = self._command_completion.get_avg()
+        return {
+            "received": self._commands_received.get(),
+            "written": self._command_write_latency.get_count(),
+            "latency_avg_ms": latency * 1000 if latency is not None else None,
+            "latency_max_ms": self._command_write_latency.get_max() * 1000,
+            "completed": self._command_completion.get_count(),
+            "failed": self._commands_failed.get(),
+            "completion_avg_ms": completion * 1000 if completion is not None else None,
+            "completion_max_ms": self._command_completion.get_max() * 1000,
+            "queue": self._command_queue.get_stats(),
+            "writer": self._writer.get_stats()
+        }
+
+    # Answers a state history request (see Messages.parse_history_request) with the
+    # response payload. Returns None if topic isn't this panel's history request topic.
+    def handle_request(self, topic, msg):
+        if self._history is None or topic != self._formatter.get_history_request_topic():
+            return None
+        try:
+            since, limit, keys = self._formatter.parse_history_request(msg)
+        except ValueError as e:
+            logger.warning(f"Bad history request for {self.get_identifier()}: {e}")
+            return json.dumps({ "error": str(e) })
+        self._history_requests.inc()
+        return self._formatter.get_history_response(self._history.get_columns(since, limit, keys))
+
+    # Returns a list of (topic, message) tuples to publish in response
+    def handle_message(self, topic, msg):
+        return self._formatter.handle_message_on_topic(topic, msg, self._queue_panel_state)
+
+    def is_replay(self):
+        return self._source.startswith(REPLAY_PREFIX)
+
+    def panel_connect(self):
+        with self._link_lock:
+            self._close_source()
+            if self.is_replay():
+                pass # Nothing to open until _replay runs
+            elif ':' in self._source:
+                s_host, s_port = self._source.split(':')
+                self._panel.connect(s_host, int(s_port))
+                self._writer.attach(self._write_socket)
+            else:
+                self._panel.connect_serial(self._source)
+                self._writer.attach(self._write_serial)
+            # connect and connect_serial set their own writer
+            self._panel._write = self._write_frame
+            if (self._capture is not None or self._count_frames) and not self.is_replay():
+                self._panel._read = self._wrap_read(self._panel._read)
+            self._connected = True
+        # Give the new connection a full timeout period to produce its first update
+        self._pman.reset_timeout()
+
+    # Wraps AquaLogic's byte reader to record the stream and/or count frames (DLE
+    # followed by ETX, which only occurs at the end of a frame).
+    def _wrap_read(self, read):
+        capture = self._capture
+        frames = self._frames if self._count_frames else None
+        last = None
+        def wrapped_read():
+            nonlocal last
+            byte = read()
+            if capture is not None:
+                capture.write(bytes((byte,)))
+            if frames is not None:
+                if byte == AquaLogic.FRAME_ETX and last == AquaLogic.FRAME_DLE:
+                    frames.inc()
+                last = byte
+            return byte
+        return wrapped_read
+
+    # Closing the source from another thread makes a blocked AquaLogic.process
+    # read fail, so that the supervisor can reconnect.
+    def _close_source(self):
+        self._connected = False
+        self._writer.detach()
+        if self._panel._socket is not None:
+            try:
+                self._panel._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._panel._socket.close()
+            self._panel._socket = None
+        if self._panel._serial is not None:
+            self._panel._serial.close()
+            self._panel._serial = None
+
+    # Runs AquaLogic.process on the panel thread, reconnecting the source with
+    # exponential backoff whenever process returns or fails, while the MQTT
+    # session carries on.
+    def _supervise(self):
+        if self.is_replay():
+            self._replay()
+            return
+        while not self._stop_event.is_set():
+            try:
+                self._panel.process(self._panel_changed)
+            except Exception as e:
+                logger.error(f"Panel {self.get_identifier()} source failed: {e}")
+            with self._link_lock:
+                self._close_source()
+            self._link_lost("source closed")
+            if not self._reconnect:
+                return
+            while not self._stop_event.wait(self._next_reconnect_wait()):
+                try:
+                    logger.info(f"Reconnecting panel {self.get_identifier()} to {self._source}...")
+                    self._reconnects.inc()
+                    self.panel_connect()
+                    break
+                except Exception as e:
+                    logger.error(f"Reconnecting panel {self.get_identifier()} failed: {e}")
+
+    # Feeds a capture file (see capture.py) to the panel in place of a live source.
+    # There is nothing to write commands to, so they are discarded.
+    def _replay(self):
+        path = self._source[len(REPLAY_PREFIX):]
+        feeder = FrameFeeder(self._panel, self._panel_changed, lambda data: None)
+        start = time.monotonic()
+        size = 0
+        try:
+            for delay, data in pace_capture(path, self._replay_speed):
+                if self._stop_event.wait(delay):
+                    return
+                self._frames.inc(feeder.feed(data))
+                size += len(data)
+        except Exception as e:
+            logger.error(f"Replaying {path} failed: {e}")
+        self._finish_replay(path, size, feeder.get_frame_count(), time.monotonic() - start)
+
+    def _finish_replay(self, path, size, frames, elapsed):
+        # Let a pending coalesced publish go out before reporting
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        logger.warning(f"Replay of {path} for panel {self.get_identifier()} finished: {size} bytes, "
+                       f"{frames} frames in {elapsed:.3f}s ({frames / elapsed if elapsed else 0:.0f} frames/s)")
+        logger.warning(f"Publish stats for {self.get_identifier()}: {self.get_publish_stats()}")
+        self._finished = True
+
+    # True once a replay source has been fully replayed
+    def is_finished(self):
+        return self._finished
+
+    def _next_reconnect_wait(self):
+        wait = self._reconnect_wait
+        self._reconnect_wait = min(self._reconnect_wait*2, self._reconnect_wait_max)
+        return wait
+
+    def start(self):
+        self._command_queue.start()
+        self._writer.start()
+        if self._coalescer is not None:
+            self._coalescer.start()
+        self._panel_thread = threading.Thread(target=self._supervise, name=f"panel-{self.get_identifier()}")
+        self._panel_thread.daemon = True # https://stackoverflow.com/a/50788759/489116 ?
+        self._panel_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._coalescer is not None:
+            self._coalescer.stop()
+        self._command_queue.stop()
+        self._writer.stop()
+        if self._capture is not None:
+            self._capture.close()
+
+    # Housekeeping, called about once a second by the client (or when
+    # get_next_check_delay says it is due). Returns False if the panel has stopped
+    # updating.
+    def check(self):
+        logger.debug(f"Update age for {self.get_identifier()}: {self._pman.get_last_update_age()}")
+        if not self._pman.is_updating():
+            self._link_lost(f"not updated in {self.get_last_update_age():.0f}s")
+            return False
+        if self._connected and not self._pman.is_awaiting_update():
+            self._link_restored()
+        self._pman.expire_system_messages()
+        self._check_filters()
+        self._check_heartbeat()
+        self._check_diagnostics()
+        return True
+
+    # Called by the client's watchdog when check() fails. Returns False if the panel
+    # should be given up on; otherwise the source is closed so that it is reopened.
+    def handle_stall(self):
+        if self.is_replay():
+            return True
+        if not self._reconnect:
+            return False
+        with self._link_lock:
+            if self._connected:
+                logger.warning(f"Closing stalled source for panel {self.get_identifier()}")
+                self._close_source()
+        return True
+
+    def _link_lost(self, reason):
+        with self._link_lock:
+            if self._link_lost_at is None:
+                self._link_lost_at = time.monotonic()
+                logger.error(f"Panel {self.get_identifier()} link lost: {reason}")
+            if self._available is not False:
+                self._available = False
+                self.publish_availability()
+
+    def _link_restored(self):
+        with self._link_lock:
+            if self._link_lost_at is not None:
+                recovery = time.monotonic() - self._link_lost_at
+                self._link_lost_at = None
+                self._reconnect_wait = 1
+                self._recovery_last = recovery
+                self._link_recovery.observe(recovery)
+                logger.warning(f"Panel {self.get_identifier()} link restored after {recovery:.1f}s")
+            if self._available is not True:
+                self._available = True
+                self.publish_availability()
+
+    # Publishes the (retained) panel link state; also called by the client on connect.
+    def publish_availability(self):
+        if self._available is None:
+            return
+        self._publish(self._formatter.get_availability_topic(), "online" if self._available else "offline", retain=True)
+
+    def get_link_stats(self):
+        return {
+            "available": self._available,
+            "reconnects": self._reconnects.get(),
+            "recovery_last_s": self._recovery_last,
+            "recovery_max_s": self._link_recovery.get_max()
+        }
+
+    # Publishes the diagnostic sensor values every diagnostics_interval seconds, with
+    # rates and averages taken over the interval since the previous publish.
+    def _check_diagnostics(self):
+        if not self._diagnostics_interval:
+            return
+        now = time.monotonic()
+        updates = self._pman.get_update_interval()
+        snapshot = (now, self._frames.get(), self._published.get(), updates.get_count(), updates.get_sum(),
+                    self._command_write_latency.get_count(), self._command_write_latency.get_sum())
+        last = self._diagnostics_last
+        if last is None:
+            self._diagnostics_last = snapshot
+            return
+        if now - last[0] < self._diagnostics_interval:
+            return
+        self._diagnostics_last = snapshot
+        elapsed = now - last[0]
+        update_count = snapshot[3] - last[3]
+        command_count = snapshot[5] - last[5]
+        values = {
+            "fps": round((snapshot[1] - last[1]) / elapsed, 1),
+            "upd_s": round((snapshot[4] - last[4]) / update_count, 2) if update_count else None,
+            "pub_min": round((snapshot[2] - last[2]) / elapsed * 60, 1),
+            "cmd_ms": round((snapshot[6] - last[6]) / command_count * 1000) if command_count else None,
+            "reconn": self._reconnects.get()
+        }
+        if self._mqtt_stats is not None:
+            mqtt_stats = self._mqtt_stats()
+            values["mqtt_q"] = mqtt_stats["queue"]
+            values["mqtt_disc"] = mqtt_stats["disconnects"]
+        self._publish(self._formatter.get_diagnostics_topic(), self._formatter.get_diagnostics_message(values),
+                      retain=self._retain_state)
+
+    def get_last_update_age(self):
+        return self._pman.get_last_update_age()
+
+    # Seconds until check() next has something to do: the watchdog timeout, the
+    # next system message expiry, a held sensor value coming due, or the next
+    # heartbeat, whichever is soonest.
+    def get_next_check_delay(self):
+        delays = [self._pman.get_timeout_delay()]
+        expiry = self._pman.get_next_expiry_delay()
+        if expiry is not None:
+            delays.append(expiry)
+        filter_due = self._formatter.get_next_filter_due()
+        if filter_due is not None:
+            delays.append(filter_due - time.monotonic())
+        if self._publish_mode == "changes" and self._heartbeat_interval and self._last_state_publish is not None:
+            delays.append(self._heartbeat_interval - (time.monotonic() - self._last_state_publish))
+        if self._diagnostics_interval:
+            last = self._diagnostics_last[0] if self._diagnostics_last is not None else time.monotonic()
+            delays.append(self._diagnostics_interval - (time.monotonic() - last))
+        return max(min(delays), 0.01)
+
+    # The asyncio equivalent of panel_connect, start, _supervise and the client's
+    # watchdog loop. Reads the source as a stream and only wakes for data or when
+    # check() is due. Returns when the panel stops updating and reconnection is
+    # disabled.
+    async def run_async(self):
+        global asyncio
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self._command_queue.start_async(loop)
+        self._writer.start_async(loop)
+        if self._coalescer is not None:
+            self._coalescer.start_async(loop)
+        first = True
+        try:
+            while True:
+                if not first:
+                    await asyncio.sleep(self._next_reconnect_wait())
+                    logger.info(f"Reconnecting panel {self.get_identifier()} to {self._source}...")
+                    self._reconnects.inc()
+                source = AsyncSource(self._source, self._replay_speed)
+                try:
+                    await source.open()
+                except Exception as e:
+                    if first and not self._reconnect:
+                        raise
+                    logger.error(f"Connecting panel {self.get_identifier()} failed: {e}")
+                else:
+                    await self._run_source_async(source)
+                finally:
+                    source.close()
+                first = False
+                if self.is_replay():
+                    return
+                self._link_lost("source closed")
+                if not self._reconnect:
+                    logger.critical(f"Panel {self.get_identifier()} stopped updating, stopping it!")
+                    return
+        finally:
+            self.stop()
+
+    async def _run_source_async(self, source):
+        self._pman.reset_timeout()
+        self._connected = True
+        feeder = FrameFeeder(self._panel, self._panel_changed, self._write_frame)
+        self._writer.attach(source.write)
+        reader = asyncio.create_task(self._read_async(source, feeder))
+        start = time.monotonic()
+        try:
+            while True:
+                await asyncio.wait([reader], timeout=self.get_next_check_delay())
+                if reader.done():
+                    if not reader.cancelled() and reader.exception() is not None:
+                        logger.error(f"Panel {self.get_identifier()} source failed: {reader.exception()}")
+                    elif self.is_replay():
+                        self._finish_replay(self._source[len(REPLAY_PREFIX):], reader.result(),
+                                            feeder.get_frame_count(), time.monotonic() - start)
+                    return
+                if not self.check() and not self.is_replay():
+                    return
+        finally:
+            self._connected = False
+            self._writer.detach()
+            reader.cancel()
+
+    # Returns the number of bytes read once the source reaches EOF
+    async def _read_async(self, source, feeder):
+        size = 0
+        while True:
+            data = await source.read()
+            if not data:
+                return size
+            if self._capture is not None and not self.is_replay():
+                self._capture.write(data)
+            size += len(data)
+            self._frames.inc(feeder.feed(data))
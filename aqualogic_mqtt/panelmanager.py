@@ -1,5 +1,9 @@
 import time
 import logging
+import threading
+from collections import OrderedDict
+
+from .metrics import Counter, Gauge, Histogram
 
 logger = logging.getLogger(__name__)
 
@@ -9,24 +13,105 @@ class PanelManager:
     _timeout = None
     _exp_s = None
     _last_text_update = None
+    _system_messages_listener = None
+    _awaiting_update = True
+    _display_parser = None
+    _display_values_listener = None
 
-    def __init__(self, connect_timeout:(int), message_exp_seconds:(int)):
+    # display_parser, if given, is a DisplayParser fed every display update
+    def __init__(self, connect_timeout:(int), message_exp_seconds:(int), display_parser=None):
         self._last_text_update = time.time()
         self._timeout = connect_timeout
         self._exp_s = message_exp_seconds
-        self._registry = {}
+        # Ordered by last seen, oldest first, so expiry only ever looks at the front
+        self._registry = OrderedDict()
+        self._sorted_messages = []
+        self._lock = threading.Lock()
+        self._update_interval = Histogram("panel_update_interval_seconds", "Time between display updates from the panel",
+                                          buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60))
+        self._active_messages = Gauge("panel_system_messages", "Check System messages currently active",
+                                      fn=lambda: len(self._sorted_messages))
+        self._display_parser = display_parser
+
+    # Labels identify the panel among several
+    def register_metrics(self, registry, labels:(dict)):
+        metrics = [self._update_interval, self._active_messages]
+        if self._display_parser is not None:
+            metrics.append(Counter("display_texts_parsed", "Display texts parsed for display sensors (not found in the cache)",
+                                   fn=self._display_parser.get_parsed_count))
+        for metric in metrics:
+            metric.labels = labels
+        registry.register(*metrics)
+
+    def get_update_interval(self):
+        return self._update_interval
+
+    # The listener is called with the new sorted message list whenever a message
+    # appears or expires (not when an already active message is seen again).
+    def set_system_messages_listener(self, listener):
+        self._system_messages_listener = listener
+
+    # The listener is called with the display values whenever one of them changes
+    def set_display_values_listener(self, listener):
+        self._display_values_listener = listener
+
+    # The latest value seen for each display sensor key (see DisplayParser)
+    def get_display_values(self):
+        return self._display_parser.get_values() if self._display_parser is not None else {}
 
     def observe_system_message(self, message:(str)):
         if message is None:
+            self.expire_system_messages()
             return
         message = message.strip(' \x00')
         now = time.time()
-        self._registry[message] = now
+        with self._lock:
+            changed = message not in self._registry
+            self._registry[message] = now
+            self._registry.move_to_end(message)
+            changed = self._evict(now) or changed
+            if changed:
+                self._sorted_messages = sorted(self._registry.keys())
+        if changed:
+            self._notify()
+
+    # Drops messages not seen within the expiration time. This is called on each
+    # observation, and should also be called periodically so that messages expire
+    # even when no new frames arrive.
+    def expire_system_messages(self):
+        with self._lock:
+            changed = self._evict(time.time())
+            if changed:
+                self._sorted_messages = sorted(self._registry.keys())
+        if changed:
+            self._notify()
+
+    def _evict(self, now):
         exp = now - self._exp_s
-        self._registry = { k:v for k,v in self._registry.items() if v > exp }
+        evicted = False
+        while self._registry:
+            message, seen = next(iter(self._registry.items()))
+            if seen > exp:
+                break
+            del self._registry[message]
+            evicted = True
+        return evicted
+
+    def _notify(self):
+        logger.debug(f"System messages changed: {self._sorted_messages}")
+        if self._system_messages_listener is not None:
+            self._system_messages_listener(self._sorted_messages)
 
     def get_system_messages(self):
-        return sorted(self._registry.keys())
+        return self._sorted_messages
+
+    # Seconds until the oldest active message expires, or None if there are none
+    def get_next_expiry_delay(self):
+        with self._lock:
+            if not self._registry:
+                return None
+            seen = next(iter(self._registry.values()))
+        return seen + self._exp_s - time.time()
     
     def get_last_update_age(self):
         return time.time() - self._last_text_update
@@ -34,11 +119,38 @@ class PanelManager:
     def is_updating(self):
         return (time.time() - self._last_text_update) < self._timeout
 
+    # Restarts the timeout, e.g. to give a newly (re)connected source a full timeout
+    # period to produce its first update.
+    def reset_timeout(self):
+        self._last_text_update = time.time()
+        self._awaiting_update = True
+
+    # True if there has been no update since construction or reset_timeout()
+    def is_awaiting_update(self):
+        return self._awaiting_update
+
+    # Seconds until is_updating() will turn False if no further update arrives
+    def get_timeout_delay(self):
+        return self._timeout - (time.time() - self._last_text_update)
+
     # This is a method with the same name/sig as one in aqualogic.web.WebServer. This
     # allows 1: monkey-patching this class into aqualogic to allow the process loop to
     # function without its web server running, 2: us to pick up activity and screen
     # updates from the panel (e.g. to determine if the connection is lost).
     def text_updated(self, str):
-        self._last_text_update = time.time()
+        now = time.time()
+        if not self._awaiting_update:
+            self._update_interval.observe(now - self._last_text_update)
+        self._last_text_update = now
+        self._awaiting_update = False
         logger.debug(f"text_updated: {str}")
+        # aqualogic only reports a Check System message when it differs from the
+        # last one, so each time one is on screen it is observed here too, keeping
+        # it from expiring for as long as the panel keeps showing it.
+        parts = str.split()
+        if len(parts) > 2 and parts[0] == 'Check' and parts[1] == 'System':
+            self.observe_system_message(' '.join(parts[2:]))
+        if self._display_parser is not None and self._display_parser.update(str):
+            if self._display_values_listener is not None:
+                self._display_values_listener(self._display_parser.get_values())
         return
@@ -0,0 +1,150 @@
+import io
+import logging
+import threading
+
+from .capture import pace_capture
+
+logger = logging.getLogger(__name__)
+
+# Imported by AsyncSource.open, for the same reason as in the client
+asyncio = None
+
+_FRAME_END = b'\x10\x03'
+
+# Source prefix for replaying a capture file (see capture.py) instead of a live panel
+REPLAY_PREFIX = "replay:"
+
+# AquaLogic.process logs "eof" at INFO each time its source runs out, which for a
+# FrameFeeder is the end of every chunk. The record is dropped while feeding (on
+# the feeding thread only), so a live source reaching EOF is still logged.
+class _EndOfChunkFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self._feeding = threading.local()
+
+    def set_feeding(self, feeding:(bool)):
+        self._feeding.value = feeding
+
+    def filter(self, record):
+        return not (record.msg == "eof" and getattr(self._feeding, "value", False))
+
+_end_of_chunk_filter = _EndOfChunkFilter()
+logging.getLogger("aqualogic.core").addFilter(_end_of_chunk_filter)
+
+# Feeds an arbitrarily chunked byte stream from a panel into AquaLogic.process,
+# which otherwise insists on pulling bytes itself with blocking reads. Bytes are
+# buffered until they contain complete frames (DLE/ETX), then handed to process
+# through its in-memory io source; process returns at the end of the buffer.
+#
+# DLE bytes within a frame's data or checksum are always followed by a NULL, so
+# DLE/ETX can only occur at the end of a frame.
+class FrameFeeder:
+    _panel = None
+    _callback = None
+    _write = None
+    _frame_count = 0
+
+    def __init__(self, panel, callback, write):
+        self._panel = panel
+        self._callback = callback
+        self._write = write
+        self._buffer = bytearray()
+        panel._read = panel._read_byte_from_io
+
+    # Returns the number of complete frames processed
+    def feed(self, data):
+        self._buffer += data
+        end = self._buffer.rfind(_FRAME_END)
+        if end < 0:
+            return 0
+        end += len(_FRAME_END)
+        frames = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        count = frames.count(_FRAME_END)
+        self._frame_count += count
+        self._panel._io = io.BytesIO(frames)
+        # Keep-alive frames may trigger a write of a queued command
+        self._panel._write = self._write
+        _end_of_chunk_filter.set_feeding(True)
+        try:
+            self._panel.process(self._callback)
+        finally:
+            _end_of_chunk_filter.set_feeding(False)
+        return count
+
+    def reset(self):
+        self._buffer.clear()
+
+    def get_frame_count(self):
+        return self._frame_count
+
+# An asyncio wrapper around a panel source, either a serial device path, a
+# network serial adapter host:port, or a capture file to replay (prefixed with
+# REPLAY_PREFIX) at replay_speed times its recorded rate (0 for no delays).
+class AsyncSource:
+    _source = None
+    _reader = None
+    _writer = None
+    _serial = None
+    _replay = None
+    _replay_speed = None
+    _loop = None
+
+    def __init__(self, source:(str), replay_speed:(float)=1.0):
+        self._source = source
+        self._replay_speed = replay_speed
+
+    async def open(self):
+        global asyncio
+        import asyncio
+        self._loop = asyncio.get_running_loop()
+        if self._source.startswith(REPLAY_PREFIX):
+            self._replay = pace_capture(self._source[len(REPLAY_PREFIX):], self._replay_speed, self._loop.time)
+        elif ':' in self._source:
+            s_host, s_port = self._source.split(':')
+            self._reader, self._writer = await asyncio.open_connection(s_host, int(s_port))
+        else:
+            import serial
+            self._serial = serial.Serial(port=self._source, baudrate=19200,
+                                         stopbits=serial.STOPBITS_TWO, timeout=0)
+
+    async def read(self):
+        if self._replay is not None:
+            record = next(self._replay, None)
+            if record is None:
+                return b''
+            delay, data = record
+            # Yield to the loop even when replaying as fast as possible
+            await asyncio.sleep(delay)
+            return data
+        if self._reader is not None:
+            return await self._reader.read(4096)
+        # pyserial has no asyncio support of its own; wait for the descriptor to
+        # become readable and then take whatever is buffered.
+        ready = self._loop.create_future()
+        fd = self._serial.fileno()
+        self._loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            self._loop.remove_reader(fd)
+        return self._serial.read(self._serial.in_waiting or 1)
+
+    def write(self, data):
+        if self._replay is not None:
+            pass # Commands have nowhere to go
+        elif self._writer is not None:
+            self._writer.write(data)
+        else:
+            self._serial.write(data)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = self._reader = None
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+        if self._replay is not None:
+            self._replay.close()
+            self._replay = None
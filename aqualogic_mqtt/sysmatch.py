@@ -0,0 +1,80 @@
+import re
+import fnmatch
+import logging
+
+logger = logging.getLogger(__name__)
+
+_GLOB_PREFIX = "glob:"
+_REGEX_PREFIX = "re:"
+# Distinct messages are few in practice, but the display can show garbage while
+# the link is noisy; past this the cache is simply started over.
+_CACHE_MAX = 256
+
+# Matches "Check System" messages against the system message sensor patterns. A
+# pattern is an exact message by default (even if it contains * ? or [), a glob if
+# it starts with "glob:" (e.g. "glob:Low Salt*"), or a regular expression if it
+# starts with "re:". Globs and regular expressions must match the whole message.
+#
+# Unless a pattern has groups, all patterns are combined into one expression that
+# rejects messages matching none of them in a single pass. (Combining renumbers
+# groups, which would break backreferences such as \1.) The result for each
+# distinct message is cached, as is the result for the last list of active
+# messages, so that evaluating the same list again (as every state update does)
+# costs one identity check.
+class SystemMessageMatcher:
+    _any = None
+    _last = (None, ())
+
+    def __init__(self, patterns:(list)):
+        self._patterns = [SystemMessageMatcher.compile_pattern(p) for p in patterns]
+        self._none = (False,) * len(self._patterns)
+        self._last = (None, self._none)
+        self._cache = {}
+        if self._patterns and all(p.groups == 0 for p in self._patterns):
+            try:
+                self._any = re.compile("|".join(f"(?:{p.pattern})" for p in self._patterns))
+            except re.error:
+                # e.g. a global flag like (?i) in a pattern; test them one by one
+                logger.debug("System message patterns can't be combined, matching individually")
+
+    # Returns the compiled expression for a pattern. Raises ValueError if a regular
+    # expression is invalid.
+    @staticmethod
+    def compile_pattern(pattern:(str)):
+        if pattern.startswith(_REGEX_PREFIX):
+            try:
+                return re.compile(pattern[len(_REGEX_PREFIX):])
+            except re.error as e:
+                raise ValueError(f"invalid regular expression \"{pattern[len(_REGEX_PREFIX):]}\": {e}")
+        if pattern.startswith(_GLOB_PREFIX):
+            return re.compile(fnmatch.translate(pattern[len(_GLOB_PREFIX):]))
+        return re.compile(re.escape(pattern))
+
+    # A tuple with, for each pattern in order, whether it matches message
+    def match(self, message:(str)):
+        result = self._cache.get(message)
+        if result is None:
+            if self._any is not None and self._any.fullmatch(message) is None:
+                result = self._none
+            else:
+                result = tuple(p.fullmatch(message) is not None for p in self._patterns)
+            if len(self._cache) >= _CACHE_MAX:
+                self._cache.clear()
+            self._cache[message] = result
+        return result
+
+    # A tuple with, for each pattern in order, whether it matches any of messages.
+    # messages is expected to be replaced rather than modified when it changes, as
+    # PanelManager.get_system_messages does.
+    def evaluate(self, messages:(list)):
+        last_messages, last_result = self._last
+        if messages is last_messages:
+            return last_result
+        result = self._none
+        for message in messages:
+            matched = self.match(message)
+            if matched is not self._none:
+                result = tuple(a or b for a, b in zip(result, matched))
+        # One assignment, so that a concurrent caller never sees a mismatched pair
+        self._last = (messages, result)
+        return result
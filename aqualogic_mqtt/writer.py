@@ -0,0 +1,191 @@
+import threading
+import time
+import logging
+from collections import deque
+
+from .metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Writes frames to the panel source on its own worker thread, so that neither the
+# panel read loop nor MQTT callbacks ever block on a slow serial port or network
+# adapter. The writer is attached to the raw write(data) of the current source
+# handle, and detached when the handle is closed (dropping anything unwritten).
+#
+# Frames that are handed over while a write is still in progress are written
+# together as one batch. When a write fails, each frame in the batch that has
+# been attempted no more than `retries` times is handed to the retry listener, to
+# be queued for a later keep-alive slot just like a new frame; the rest are
+# dropped.
+#
+# The panel only accepts a frame in the slot after a keep-alive, so frames are
+# not delayed here; instead, is_ready() tells the caller whether min_interval has
+# passed since the last write, and a caller that isn't ready leaves its frame for
+# a later keep-alive. This spaces out key presses without ever writing outside a
+# slot.
+#
+# When running on an asyncio event loop (start_async) there is no worker thread;
+# writes are made from a callback scheduled on the loop instead, and submit must
+# be called from the loop's thread.
+class FrameWriter:
+    _write = None
+    _thread = None
+    _loop = None
+    _flush_scheduled = False
+    _stopped = False
+    _min_interval = 0
+    _retries = 2
+    _last_write = 0
+    _written_listener = None
+    _retry_listener = None
+
+    def __init__(self, min_interval:(float)=0, retries:(int)=2):
+        self._min_interval = min_interval
+        self._retries = retries
+        # (frame, received, submitted, attempts)
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._write_latency = Histogram("panel_write_seconds", "Time taken by each write to the panel source",
+                                        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+        self._queue_wait = Histogram("panel_write_queue_seconds", "Time from a frame being handed to the writer to its write starting",
+                                     buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+        self._frames_written = Counter("panel_frames_written", "Frames written to the panel source")
+        self._batches = Counter("panel_write_batches", "Writes to the panel source (each of one or more frames)")
+        self._write_retries = Counter("panel_write_retries", "Frames queued to be written again after a failed write")
+        self._frames_failed = Counter("panel_write_failures", "Frames dropped after failing to write, or unwritten when the source closed")
+        self._slots_skipped = Counter("panel_write_slots_skipped", "Keep-alive slots left unused to keep frames min-interval apart")
+
+    def register_metrics(self, registry, labels:(dict)):
+        metrics = (self._write_latency, self._queue_wait, self._frames_written, self._batches,
+                   self._write_retries, self._frames_failed, self._slots_skipped)
+        for metric in metrics:
+            metric.labels = labels
+        registry.register(*metrics)
+
+    # The listener is called with (received, written) monotonic times for each
+    # frame submitted with a received time, once it has been written.
+    def set_written_listener(self, listener):
+        self._written_listener = listener
+
+    # The listener is called with (frame, received, attempts) for each frame to be
+    # written again after a failed write, and should submit it again (with
+    # attempts) from a later keep-alive slot. Without a listener, failed frames
+    # are dropped.
+    def set_retry_listener(self, listener):
+        self._retry_listener = listener
+
+    def attach(self, write):
+        with self._cond:
+            self._write = write
+            self._cond.notify()
+
+    def detach(self):
+        with self._cond:
+            self._write = None
+            if self._pending:
+                logger.warning(f"Dropping {len(self._pending)} unwritten frame(s) for a closed source")
+                self._frames_failed.inc(len(self._pending))
+                self._pending.clear()
+
+    # True if a frame may be written now without breaking min_interval (since the
+    # last write, whether or not it failed). Counts a skipped slot otherwise.
+    def is_ready(self):
+        if time.monotonic() - self._last_write >= self._min_interval:
+            return True
+        self._slots_skipped.inc()
+        return False
+
+    # Hands a frame over to be written, without waiting. received, if given, is the
+    # monotonic time of the command it carries, for the written listener. attempts
+    # is the number of failed writes of the frame so far.
+    def submit(self, frame:(bytes), received=None, attempts:(int)=0):
+        with self._cond:
+            self._pending.append((frame, received, time.monotonic(), attempts))
+            if self._loop is not None:
+                if not self._flush_scheduled:
+                    self._flush_scheduled = True
+                    self._loop.call_soon(self._flush_async)
+            else:
+                self._cond.notify()
+
+    # Writes everything pending as one batch
+    def _flush(self):
+        with self._cond:
+            if not self._pending or self._write is None:
+                return
+            batch = list(self._pending)
+            self._pending.clear()
+            write = self._write
+        start = time.monotonic()
+        try:
+            write(b''.join(frame for frame, _, _, _ in batch))
+        except OSError as e:
+            self._last_write = time.monotonic()
+            self._write_failed(batch, e)
+            return
+        now = time.monotonic()
+        self._last_write = now
+        self._write_latency.observe(now - start)
+        self._batches.inc()
+        self._frames_written.inc(len(batch))
+        for frame, received, submitted, _ in batch:
+            self._queue_wait.observe(start - submitted)
+            if received is not None and self._written_listener is not None:
+                self._written_listener(received, now)
+
+    def _write_failed(self, batch, e):
+        retry = [] if self._retry_listener is None else [entry for entry in batch if entry[3] < self._retries]
+        dropped = len(batch) - len(retry)
+        if dropped:
+            self._frames_failed.inc(dropped)
+            logger.error(f"Dropping {dropped} frame(s) that failed to write: {e}")
+        if retry:
+            self._write_retries.inc(len(retry))
+            logger.warning(f"Write to panel failed, queueing {len(retry)} frame(s) to retry: {e}")
+            for frame, received, _, attempts in retry:
+                self._retry_listener(frame, received, attempts + 1)
+
+    def _flush_async(self):
+        self._flush_scheduled = False
+        if not self._stopped:
+            self._flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not (self._pending and self._write is not None):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            try:
+                self._flush()
+            except Exception:
+                logger.exception("Panel write failed")
+
+    def start_async(self, loop):
+        self._loop = loop
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def get_depth(self):
+        return len(self._pending)
+
+    def get_stats(self):
+        latency = self._write_latency.get_avg()
+        return {
+            "written": self._frames_written.get(),
+            "batches": self._batches.get(),
+            "retries": self._write_retries.get(),
+            "failed": self._frames_failed.get(),
+            "slots_skipped": self._slots_skipped.get(),
+            "write_avg_ms": latency * 1000 if latency is not None else None,
+            "write_max_ms": self._write_latency.get_max() * 1000
+        }
@@ -0,0 +1,68 @@
+# Micro-benchmark for Messages.get_state_message with every entity enabled,
+# comparing the compiled serializer against the previous dict + json.dumps
+# implementation. Run from the repository root:
+#
+#   python -m benchmarks.bench_state_message
+#
+import json
+import timeit
+
+from aqualogic_mqtt.display import DisplayParser
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import AquaLogic, States
+from aqualogic_mqtt.panelmanager import PanelManager
+
+# The implementation of get_state_message prior to the compiled serializer, with
+# the display sensors since added, so that both give the same message.
+def legacy_state_message(formatter, panel, panel_manager):
+    sysm = panel_manager.get_system_messages()
+    state = {
+        "cs": formatter._onoff[panel.get_state(States.CHECK_SYSTEM)],
+        "sysm": ', '.join(sysm)
+    }
+    for k, v in formatter._sensor_dict.items():
+        state[k] = getattr(panel, v['attr'])
+    display = panel_manager.get_display_values()
+    for k in formatter._display_sensor_dict:
+        state[k] = display.get(k)
+    for k, v in formatter._control_dict.items():
+        state[k] = formatter._onoff[panel.get_state(v['state'])]
+    for k, v in formatter._system_message_sensor_dict.items():
+        state[k] = formatter._onoff[v["name"] in sysm]
+    return json.dumps(state)
+
+def make_fixture():
+    panel = AquaLogic(web_port=0)
+    panel._states = States.FILTER | States.LIGHTS | States.AUX_1 | States.CHECK_SYSTEM
+    panel._air_temp = 72
+    panel._pool_temp = 81
+    panel._salt_level = 3100.0
+    panel._pool_chlorinator = 50
+    panel._pump_speed = 75
+    panel._pump_power = 1200
+
+    pman = PanelManager(10, 180, display_parser=DisplayParser())
+    for text in ("Pool Heater1 82\xb0F", "Heater1 Auto Control", "Chlorinator 24.5V 5.1A", "Wednesday 3:45P"):
+        pman.text_updated(text)
+    pman.observe_system_message("Low Salt")
+    pman.observe_system_message("Inspect Cell")
+
+    formatter = Messages(identifier="aqualogic", discover_prefix="homeassistant",
+                         enable=list(Messages.get_valid_entity_meta().keys()),
+                         system_message_sensors=[["Low Salt", "ls"], ["Inspect Cell", "ic"], ["Very Low Salt", "vls"]])
+    return formatter, panel, pman
+
+def main(number=20000):
+    formatter, panel, pman = make_fixture()
+    assert formatter.get_state_message(panel, pman) == legacy_state_message(formatter, panel, pman)
+
+    results = {
+        "legacy": timeit.timeit(lambda: legacy_state_message(formatter, panel, pman), number=number),
+        "compiled": timeit.timeit(lambda: formatter.get_state_message(panel, pman), number=number),
+    }
+    for name, total in results.items():
+        print(f"{name:>10}: {total / number * 1e6:8.2f} us/update")
+    print(f"   speedup: {results['legacy'] / results['compiled']:.2f}x")
+
+if __name__ == "__main__":
+    main()
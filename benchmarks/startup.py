@@ -0,0 +1,84 @@
+# Cold-start benchmark: the time and memory taken to import the client, and to
+# run it to the point of printing its help, each in a fresh interpreter. Also
+# checks that the web server dependencies of aqualogic are never imported. Run
+# from the repository root:
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --runs 20 --top 15
+#
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that should not be imported when starting the client
+UNWANTED = ["aiohttp", "websockets", "aqualogic.web", "asyncio", "http.server"]
+
+_IMPORT_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import aqualogic_mqtt.client
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "import_s": elapsed,
+    "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    # The aqualogic.web stub has no file
+    "unwanted": [m for m in %r if getattr(sys.modules.get(m), "__file__", None)]
+}))
+""" % (UNWANTED,)
+
+def _probe_import():
+    out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+def _time_help():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "aqualogic_mqtt.client", "--help"], capture_output=True, check=True)
+    return time.perf_counter() - start
+
+def _baseline():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - start
+
+# The slowest imports by cumulative time, from python -X importtime
+def _top_imports(count):
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import aqualogic_mqtt.client"],
+                         capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.startup", description="Benchmark client import time and cold start")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per measurement, the median is reported (default is 10)")
+    parser.add_argument("--top", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    args = parser.parse_args()
+
+    probes = [_probe_import() for _ in range(args.runs)]
+    imports = statistics.median(p["import_s"] for p in probes)
+    rss = statistics.median(p["maxrss_kb"] for p in probes)
+    helps = statistics.median(_time_help() for _ in range(args.runs))
+    baseline = statistics.median(_baseline() for _ in range(args.runs))
+    unwanted = sorted(set(m for p in probes for m in p["unwanted"]))
+
+    print(f"{'import aqualogic_mqtt.client':<30} {imports * 1000:>8.1f} ms")
+    print(f"{'client --help (process)':<30} {helps * 1000:>8.1f} ms ({baseline * 1000:.1f} ms for an empty interpreter)")
+    print(f"{'peak RSS after import':<30} {rss / 1024:>8.1f} MB")
+    print(f"{'modules loaded':<30} {probes[0]['modules']:>8}")
+    print(f"{'unwanted modules':<30} {', '.join(unwanted) if unwanted else 'none'}")
+    if args.top:
+        print(f"\nSlowest imports (cumulative):")
+        for us, name in _top_imports(args.top):
+            print(f"{us / 1000:>8.1f} ms {name}")
+    if unwanted:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
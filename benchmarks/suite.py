@@ -0,0 +1,258 @@
+# Benchmark suite for the message formatting hot paths, run across entity
+# scenarios. Reports ops/sec and memory allocated per operation, and stores the
+# results as JSON under benchmarks/results/ (not committed, as timings are only
+# comparable on the same machine). To compare versions, --baseline runs the suite
+# of another git revision side by side with this one. Run from the repository
+# root:
+#
+#   python -m benchmarks.suite                      # run, print and save
+#   python -m benchmarks.suite --baseline main      # and compare with main
+#   python -m benchmarks.suite --compare benchmarks/results/OTHER.json
+#   python -m benchmarks.suite --label v0.2 --only state
+#
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from aqualogic_mqtt.display import DisplayParser
+from aqualogic_mqtt.history import StateHistory
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import AquaLogic, States
+from aqualogic_mqtt.panelmanager import PanelManager
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# A cycle of display screens as the panel shows them
+DISPLAY_TEXTS = [
+    "Pool Temp 81\xb0F", "Air Temp 72\xb0F", "Salt Level 3100 PPM", "Pool Chlorinator 50%",
+    "Heater1 Auto Control", "Pool Heater1 82\xb0F", "Chlorinator 24.5V 5.1A", "Wednesday 3:45P",
+    "Check System Low Salt",
+]
+
+def _make_panel():
+    panel = AquaLogic(web_port=0)
+    panel._states = States.FILTER | States.LIGHTS | States.AUX_1 | States.CHECK_SYSTEM
+    panel._air_temp = 72
+    panel._pool_temp = 81
+    panel._salt_level = 3100.0
+    panel._pool_chlorinator = 50
+    panel._pump_speed = 75
+    panel._pump_power = 1200
+    return panel
+
+# Each scenario returns (enabled entity keys, system message sensors, system
+# messages currently on the display)
+def _scenario_minimal():
+    return [], [], ["Low Salt"]
+
+def _scenario_all():
+    return (list(Messages.get_valid_entity_meta().keys()),
+            [["Low Salt", "ls"], ["Inspect Cell", "ic"], ["Very Low Salt", "vls"]],
+            ["Low Salt", "Inspect Cell"])
+
+def _scenario_many_sms(count=300):
+    enable, _, _ = _scenario_all()
+    sms = [[f"Check Message {i}", f"msg_{i}"] for i in range(count)]
+    return enable, sms, [f"Check Message {i}" for i in range(0, count, 15)]
+
+SCENARIOS = {
+    "minimal": _scenario_minimal,
+    "all": _scenario_all,
+    "many_sms": _scenario_many_sms,
+}
+
+# Each case takes the scenario fixture and returns a zero-argument callable
+# performing one operation.
+def _case_state(f):
+    return lambda: f["formatter"].get_state_message(f["panel"], f["pman"])
+
+def _case_discovery(f):
+    return f["formatter"].get_discovery_message
+
+def _case_command(f):
+    formatter = f["formatter"]
+    messages = [(topic, "ON") for topic in formatter._command_topics]
+    messages.append((formatter._ha_status_path, "offline"))
+    messages.append((f"{formatter._root}/unknown/set", "ON"))
+    cycle = itertools.cycle(messages).__next__
+    set_state = lambda state, enable: True
+    def op():
+        topic, msg = cycle()
+        formatter.handle_message_on_topic(topic, msg, set_state)
+    return op
+
+def _case_id_for_string(f):
+    strings = [sms[0] for sms in f["sms"]] or ["Low Salt"]
+    strings += list(Messages.get_valid_entity_meta().values())
+    cycle = itertools.cycle(strings).__next__
+    return lambda: Messages.get_id_for_string(cycle())
+
+def _case_display(f):
+    pman = f["pman"]
+    cycle = itertools.cycle(DISPLAY_TEXTS).__next__
+    return lambda: pman.text_updated(cycle())
+
+# Recording a state that differs from the last, into a full buffer
+def _case_history(f):
+    formatter, panel, pman = f["formatter"], f["panel"], f["pman"]
+    history = StateHistory(formatter.get_history_columns(), 1000)
+    values = formatter.get_state_values(panel, pman)
+    count = itertools.count()
+    def op():
+        values[0] = next(count) % 2 == 0
+        history.record(values)
+    return op
+
+def _case_observe(f):
+    pman = f["pman"]
+    cycle = itertools.cycle(f["messages"]).__next__
+    return lambda: pman.observe_system_message(cycle())
+
+CASES = {
+    "state": _case_state,
+    "discovery": _case_discovery,
+    "command": _case_command,
+    "id_for_string": _case_id_for_string,
+    "observe": _case_observe,
+    "display": _case_display,
+    "history": _case_history,
+}
+
+def make_fixture(scenario:(str)):
+    enable, sms, messages = SCENARIOS[scenario]()
+    pman = PanelManager(10, 180, display_parser=DisplayParser())
+    for message in messages:
+        pman.observe_system_message(message)
+    for text in DISPLAY_TEXTS:
+        pman.text_updated(text)
+    formatter = Messages(identifier="aqualogic", discover_prefix="homeassistant",
+                         enable=enable, system_message_sensors=sms)
+    return { "formatter": formatter, "panel": _make_panel(), "pman": pman, "sms": sms, "messages": messages }
+
+def _ops_per_sec(op, repeat, min_time):
+    timer = timeit.Timer(op)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+# Peak bytes allocated during one operation, and bytes still held per operation
+# after many (which should be ~0 unless something accumulates)
+def _allocations(op, retained_number=200):
+    op()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(retained_number):
+            op()
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before, (end - start) / retained_number
+
+def run(scenarios, cases, repeat=3, min_time=0.2):
+    results = {}
+    for scenario in scenarios:
+        for case in cases:
+            op = CASES[case](make_fixture(scenario))
+            ops = _ops_per_sec(op, repeat, min_time)
+            peak, retained = _allocations(op)
+            results[f"{case}/{scenario}"] = {
+                "ops_per_sec": round(ops, 1),
+                "us_per_op": round(1e6 / ops, 3),
+                "peak_alloc_bytes": peak,
+                "retained_bytes_per_op": round(retained, 1),
+            }
+            print(f"{case + '/' + scenario:<26} {ops:>12,.0f} ops/s {1e6 / ops:>10.2f} us/op "
+                  f"{peak:>9,} B peak {retained:>8.1f} B retained", flush=True)
+    return results
+
+def _default_label():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime("%Y%m%d-%H%M%S")
+
+# Runs the suite as it is at git revision ref, in a temporary worktree, and
+# returns its results. cases and scenarios must exist in that revision's suite
+# (None runs all of its own).
+def run_baseline(ref, scenarios, cases, repeat):
+    root = subprocess.run(["git", "rev-parse", "--show-toplevel"], capture_output=True, text=True,
+                          check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    with tempfile.TemporaryDirectory() as tmp:
+        worktree = os.path.join(tmp, "baseline")
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, ref], capture_output=True, check=True, cwd=root)
+        try:
+            print(f"\nRunning the suite at {ref}...", flush=True)
+            command = [sys.executable, "-m", "benchmarks.suite", "--label", "baseline", "--repeat", str(repeat)]
+            if cases:
+                command += ["--only"] + cases
+            if scenarios:
+                command += ["--scenario"] + scenarios
+            # Its results are saved in the worktree, which is about to go
+            process = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True, cwd=worktree)
+            print("\n".join(line for line in process.stdout.splitlines() if not line.startswith("Saved to")).rstrip())
+            with open(os.path.join(worktree, "benchmarks", "results", "baseline.json")) as f:
+                baseline = json.load(f)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], capture_output=True, cwd=root)
+    baseline["label"] = ref
+    return baseline
+
+def compare(results, baseline:(dict)):
+    print(f"\nCompared to {baseline['label']} (positive is faster):")
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:<26} {'new':>8}")
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        alloc = result["peak_alloc_bytes"] - old["peak_alloc_bytes"]
+        print(f"{name:<26} {change:>+8.1%} {alloc:>+9,} B peak")
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.suite", description="Benchmark the message formatting hot paths")
+    parser.add_argument("--label", type=str, help="name for this run's results (default is git describe)")
+    parser.add_argument("--only", nargs="+", choices=list(CASES), help="run only these cases")
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repeats, the best is kept (default is 3)")
+    parser.add_argument("--baseline", type=str, metavar="REF", help="also run the suite at git revision REF and compare against it")
+    parser.add_argument("--compare", type=str, metavar="FILE", help="compare against a previously saved result file")
+    parser.add_argument("--no-save", action="store_true", help="don't save results")
+    args = parser.parse_args()
+
+    label = args.label or _default_label()
+    results = run(args.scenario or list(SCENARIOS), args.only or list(CASES), repeat=args.repeat)
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{label}.json")
+        with open(path, "w") as f:
+            json.dump({
+                "label": label,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": results
+            }, f, indent=2)
+            f.write("\n")
+        print(f"\nSaved to {os.path.relpath(path)}")
+    if args.baseline:
+        compare(results, run_baseline(args.baseline, args.scenario, args.only, args.repeat))
+    elif args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import pytest
+
+# Stands in for the time module in the module under test (monkeypatch it over the
+# module's `time`), so that expiry, intervals and timeouts can be stepped through
+# without sleeping. time() and monotonic() share the one clock.
+class FakeClock:
+    def __init__(self, now:(float)=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return FakeClock()
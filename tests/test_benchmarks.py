@@ -0,0 +1,18 @@
+import pytest
+
+from benchmarks import bench_state_message, startup, suite
+
+def test_compiled_state_message_matches_legacy():
+    formatter, panel, pman = bench_state_message.make_fixture()
+    assert formatter._display_sensor_dict
+    assert formatter.get_state_message(panel, pman) == bench_state_message.legacy_state_message(formatter, panel, pman)
+
+@pytest.mark.parametrize("scenario", list(suite.SCENARIOS))
+@pytest.mark.parametrize("case", list(suite.CASES))
+def test_suite_case_runs(case, scenario):
+    op = suite.CASES[case](suite.make_fixture(scenario))
+    for _ in range(3):
+        op()
+
+def test_client_import_skips_the_web_stack():
+    assert startup._probe_import()["unwanted"] == []
@@ -0,0 +1,46 @@
+import pytest
+
+from aqualogic_mqtt import capture
+from aqualogic_mqtt.capture import CaptureWriter, pace_capture, read_capture
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(capture, "time", clock)
+
+def test_round_trip(tmp_path, clock):
+    path = str(tmp_path / "panel.cap")
+    writer = CaptureWriter(path)
+    writer.write(b"\x10")
+    writer.write(b"\x02")
+    clock.advance(0.5)
+    writer.write(b"\x10\x03")
+    writer.close()
+    # Bytes read within the grouping interval share a record
+    assert list(read_capture(path)) == [(0, b"\x10\x02"), (0.5, b"\x10\x03")]
+
+def test_long_gaps_are_padded(tmp_path, clock):
+    path = str(tmp_path / "panel.cap")
+    writer = CaptureWriter(path)
+    writer.write(b"a")
+    clock.advance(5000)
+    writer.write(b"b")
+    writer.close()
+    (t0, a), (t1, b) = read_capture(path)
+    assert (a, b) == (b"a", b"b")
+    assert t1 - t0 == pytest.approx(5000)
+
+def test_pace_capture(tmp_path, clock):
+    path = str(tmp_path / "panel.cap")
+    writer = CaptureWriter(path)
+    writer.write(b"a")
+    clock.advance(2)
+    writer.write(b"b")
+    writer.close()
+    assert list(pace_capture(path, speed=2, clock=clock.monotonic)) == [(0, b"a"), (1, b"b")]
+    assert list(pace_capture(path, speed=0, clock=clock.monotonic)) == [(0, b"a"), (0, b"b")]
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / "panel.cap"
+    path.write_bytes(b"hello")
+    with pytest.raises(RuntimeError):
+        list(read_capture(str(path)))
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+
+from aqualogic_mqtt.client import Client
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panelmanager import PanelManager
+
+def _add_panel(client, identifier, **kwargs):
+    formatter = Messages(identifier, "homeassistant", [], [], **kwargs)
+    return client.add_panel("localhost:8899", formatter, PanelManager(10, 180), coalesce_window=0)
+
+# Connects without a broker, returning the (host, port) paho was asked to connect to
+def _connect(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(client._paho_client, "connect", lambda host, port, keepalive: calls.append((host, port)))
+    client.mqtt_connect("broker:1883")
+    return calls
+
+def _discovery(formatter):
+    (topic, message), = formatter.get_discovery_messages()
+    return json.loads(message)
+
+def test_will_is_the_panel_availability_topic(monkeypatch):
+    client = Client()
+    _add_panel(client, "pool")
+    assert _connect(client, monkeypatch) == [("broker", 1883)]
+    assert client._paho_client._will_topic == b"homeassistant/device/pool/availability"
+    assert client._paho_client._will_payload == b"offline"
+    assert client._paho_client._will_retain
+
+def test_will_is_shared_by_several_panels(monkeypatch):
+    topic = Messages.get_shared_availability_topic("homeassistant", ["pool", "spa"])
+    client = Client(availability_topic=topic)
+    pool = _add_panel(client, "pool", shared_availability_topic=topic)
+    _add_panel(client, "spa", shared_availability_topic=topic)
+    _connect(client, monkeypatch)
+    assert client._paho_client._will_topic == topic.encode()
+    shared = _discovery(pool.get_formatter())
+    assert "avty_t" not in shared
+    assert shared["avty"] == [{ "t": "homeassistant/device/pool/availability" }, { "t": topic }]
+    assert shared["avty_mode"] == "all"
+
+def test_single_panel_discovery_uses_its_own_availability_topic():
+    shared = _discovery(Messages("pool", "homeassistant", [], []))
+    assert shared["avty_t"] == "homeassistant/device/pool/availability"
+    assert "avty" not in shared
+
+def test_reconnect_does_not_block_the_event_loop(monkeypatch):
+    client = Client()
+    # An unreachable broker: the connect blocks until it times out
+    def reconnect():
+        time.sleep(0.3)
+        raise OSError("timed out")
+    monkeypatch.setattr(client._paho_client, "reconnect", reconnect)
+    ticks = []
+
+    async def run():
+        client._loop = asyncio.get_running_loop()
+        client._try_reconnect()
+        start = time.monotonic()
+        while time.monotonic() - start < 0.25:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+        await client._reconnect_task
+        client._stopping = True
+
+    asyncio.run(run())
+    assert len(ticks) > 10
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+    # The failure scheduled the next attempt with backoff
+    assert client._disconnect_retry_wait == 2
+
+# Records what paho is asked to publish, as (topic, payload, retain, topic alias)
+def _record_publishes(client, monkeypatch):
+    published = []
+    def publish(topic, payload, retain=False, properties=None):
+        published.append((topic, payload, retain, getattr(properties, "TopicAlias", None)))
+    monkeypatch.setattr(client._paho_client, "publish", publish)
+    monkeypatch.setattr(client._paho_client, "subscribe", lambda topic: None)
+    return published
+
+def _on_connect(client, topic_alias_max=0):
+    properties = Properties(PacketTypes.CONNACK)
+    if topic_alias_max:
+        properties.TopicAliasMaximum = topic_alias_max
+    client._on_connect(client._paho_client, None, None, ReasonCode(PacketTypes.CONNACK, "Success"), properties)
+
+def test_duplicate_identifier_is_rejected():
+    client = Client()
+    _add_panel(client, "pool")
+    with pytest.raises(RuntimeError):
+        _add_panel(client, "pool")
+
+def test_messages_held_while_disconnected_are_replayed_on_connect(monkeypatch):
+    client = Client(topic_alias_limit=0)
+    published = _record_publishes(client, monkeypatch)
+    client._publish("a/state", "1")
+    client._publish("b/state", "x", retain=True)
+    client._publish("a/state", "2")
+    assert published == []
+    assert client.get_mqtt_stats()["held"] == 2
+    _on_connect(client)
+    assert published == [("a/state", "2", False, None), ("b/state", "x", True, None)]
+    assert client.get_mqtt_stats()["replayed"] == 2
+    client._on_disconnect(client._paho_client, None, None, ReasonCode(PacketTypes.DISCONNECT, "Normal disconnection"), None)
+    client._publish("a/state", "3")
+    assert len(published) == 2
+
+def test_topic_aliases(monkeypatch):
+    client = Client(topic_alias_limit=8)
+    published = _record_publishes(client, monkeypatch)
+    _on_connect(client, topic_alias_max=2)
+    for topic in ("a", "b", "c", "a", "b", "c"):
+        client._publish(topic, "1")
+    assert published == [("a", "1", False, 1), ("b", "1", False, 2), ("c", "1", False, None),
+                         ("", "1", False, 1), ("", "1", False, 2), ("c", "1", False, None)]
+    assert client.get_mqtt_stats()["aliased"] == 2
+    # Aliases only last for the connection
+    _on_connect(client, topic_alias_max=2)
+    client._publish("b", "2")
+    assert published[-1] == ("b", "2", False, 1)
+
+def test_commands_are_routed_to_their_panel(monkeypatch):
+    client = Client()
+    pool = client.add_panel("localhost:8899", Messages("pool", "homeassistant", ["f"], []), PanelManager(10, 180),
+                            coalesce_window=0)
+    spa = client.add_panel("localhost:8899", Messages("spa", "homeassistant", ["f"], []), PanelManager(10, 180),
+                           coalesce_window=0)
+    client._on_message(client._paho_client, None,
+                       SimpleNamespace(topic="homeassistant/device/spa/spa_switch_filter/set", payload=b"ON"))
+    assert (pool._command_queue.get_depth(), spa._command_queue.get_depth()) == (0, 1)
+
+def test_history_response(monkeypatch):
+    client = Client()
+    published = _record_publishes(client, monkeypatch)
+    client.add_panel("localhost:8899", Messages("pool", "homeassistant", ["t_p"], [], history=True),
+                     PanelManager(10, 180), coalesce_window=0, history_size=8)
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.ResponseTopic = "app/response"
+    properties.CorrelationData = b"42"
+    client._on_message(client._paho_client, None,
+                       SimpleNamespace(topic="homeassistant/device/pool/history/get", payload=b"", properties=properties))
+    (topic, payload, retain, alias), = published
+    assert (topic, json.loads(payload)) == ("app/response", { "t": [], "cs": [], "sysm": [], "t_p": [] })
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from aqualogic_mqtt.coalescer import Coalescer
+
+def test_flush_emits_a_pending_burst_once():
+    emitted = []
+    coalescer = Coalescer(lambda: emitted.append(1), 1, 5)
+    coalescer.flush()
+    assert emitted == []
+    for _ in range(3):
+        coalescer.offer()
+    coalescer.flush()
+    coalescer.flush()
+    assert emitted == [1]
+    assert coalescer.get_stats() == { "offered": 3, "emitted": 1 }
+
+def test_burst_is_emitted_once_quiet():
+    emitted = []
+
+    async def run():
+        coalescer = Coalescer(lambda: emitted.append(time.monotonic()), 0.05, 1)
+        coalescer.start_async(asyncio.get_running_loop())
+        for _ in range(3):
+            coalescer.offer()
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        coalescer.stop()
+        return coalescer.get_stats()
+
+    assert asyncio.run(run()) == { "offered": 3, "emitted": 1 }
+    assert len(emitted) == 1
+
+def test_steady_updates_are_emitted_by_max_latency():
+    emitted = []
+
+    async def run():
+        coalescer = Coalescer(lambda: emitted.append(time.monotonic()), 0.05, 0.1)
+        coalescer.start_async(asyncio.get_running_loop())
+        start = time.monotonic()
+        while time.monotonic() - start < 0.35:
+            coalescer.offer()
+            await asyncio.sleep(0.01)
+        coalescer.stop()
+
+    asyncio.run(run())
+    # Never quiet for a whole window, so only max_latency lets updates out
+    assert 2 <= len(emitted) <= 4
+
+def test_worker_thread():
+    emitted = []
+    coalescer = Coalescer(lambda: emitted.append(1), 0.02, 0.1)
+    coalescer.start()
+    coalescer.offer()
+    coalescer.offer()
+    time.sleep(0.1)
+    coalescer.stop()
+    assert emitted == [1]
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from aqualogic_mqtt import commandqueue
+from aqualogic_mqtt.commandqueue import CommandQueue
+from aqualogic_mqtt.panel import States
+
+def test_commands_for_the_same_state_are_collapsed(monkeypatch, clock):
+    monkeypatch.setattr(commandqueue, "time", clock)
+    executed = []
+    queue = CommandQueue(lambda *command: executed.append(command))
+    assert queue.set_state(States.FILTER, True)
+    clock.advance(1)
+    assert queue.set_state(States.LIGHTS, True)
+    assert queue.set_state(States.FILTER, False)
+    assert queue.get_stats() == { "depth": 2, "coalesced": 1, "dropped": 0 }
+    queue._drain()
+    # The latest command, in the order first received, timed from the first
+    assert executed == [(States.FILTER, False, 1000), (States.LIGHTS, True, 1001)]
+
+def test_full_queue_drops_commands():
+    queue = CommandQueue(lambda *command: None, maxsize=1)
+    assert queue.set_state(States.FILTER, True)
+    assert not queue.set_state(States.LIGHTS, True)
+    assert queue.set_state(States.FILTER, False)
+    assert queue.get_stats() == { "depth": 1, "coalesced": 1, "dropped": 1 }
+
+def test_failed_command_does_not_stop_the_queue():
+    executed = []
+    def execute(state, enable, received):
+        executed.append(state)
+        if state == States.FILTER:
+            raise RuntimeError("panel gone")
+    queue = CommandQueue(execute)
+    queue.set_state(States.FILTER, True)
+    queue.set_state(States.LIGHTS, True)
+    queue._drain()
+    assert executed == [States.FILTER, States.LIGHTS]
+
+def test_async_drain():
+    executed = []
+
+    async def run():
+        queue = CommandQueue(lambda state, enable, received: executed.append((state, enable)))
+        queue.start_async(asyncio.get_running_loop())
+        queue.set_state(States.FILTER, True)
+        queue.set_state(States.FILTER, False)
+        assert executed == []
+        await asyncio.sleep(0)
+        return queue.get_depth()
+
+    assert asyncio.run(run()) == 0
+    assert executed == [(States.FILTER, False)]
+
+def test_worker_thread():
+    done = []
+    queue = CommandQueue(lambda state, enable, received: done.append(state))
+    queue.start()
+    queue.set_state(States.LIGHTS, True)
+    for _ in range(100):
+        if done:
+            break
+        time.sleep(0.01)
+    queue.stop()
+    assert done == [States.LIGHTS]
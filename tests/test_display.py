@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from aqualogic_mqtt.display import DisplayParser
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import AquaLogic
+from aqualogic_mqtt.panelmanager import PanelManager
+
+@pytest.mark.parametrize("text, values", [
+    ("Pool Heater1 82°F", { "sp_p": 82 }),
+    ("Spa Heater1 Set to 102°F", { "sp_s": 102 }),
+    ("Heater1 Auto Control", { "htr": "Auto Control" }),
+    ("Instant Salt 3150 PPM", { "salt_i": 3150 }),
+    ("Average Salt Level 3.1 g/L", { "salt_a": 3.1 }),
+    ("Cell Voltage 24.5V", { "cell_v": 24.5 }),
+    ("Cell Current  5.1 A", { "cell_a": 5.1 }),
+    ("Chlorinator 24.5V 5.1A", { "cell_v": 24.5, "cell_a": 5.1 }),
+    ("Cell Temp 80°F", { "cell_t": 80 }),
+    ("Wednesday 3:45P", { "time": "Wednesday 15:45" }),
+    ("Monday 12:05 AM", { "time": "Monday 00:05" }),
+    ("Sunday 23:59", { "time": "Sunday 23:59" }),
+    ("Pool Temp 80°F", {}),
+    ("Check System Low Salt", {}),
+])
+def test_parse(text, values):
+    assert DisplayParser().parse(text) == values
+
+def test_update_keeps_latest_values_and_reports_changes():
+    parser = DisplayParser()
+    assert parser.update("Pool Heater1 82°F")
+    assert not parser.update("Pool Heater1 82°F")
+    assert not parser.update("Pool Temp 80°F")
+    assert parser.update("Heater1 Manual Off")
+    assert parser.update("Pool Heater1 84°F")
+    assert parser.get_values() == { "sp_p": 84, "htr": "Manual Off" }
+
+def test_parse_is_cached_by_text():
+    parser = DisplayParser()
+    for _ in range(3):
+        parser.parse("Pool Heater1 82°F")
+        parser.parse("Pool Temp 80°F")
+    assert parser.get_parsed_count() == 2
+
+def test_panel_manager_reports_display_value_changes():
+    pman = PanelManager(10, 180, display_parser=DisplayParser())
+    changes = []
+    pman.set_display_values_listener(lambda values: changes.append(dict(values)))
+    pman.text_updated("Pool Heater1 82°F")
+    pman.text_updated("Pool Temp 80°F")
+    pman.text_updated("Pool Heater1 82°F")
+    pman.text_updated("Cell Temp 80°F")
+    assert changes == [{ "sp_p": 82 }, { "sp_p": 82, "cell_t": 80 }]
+    assert pman.get_display_values() == { "sp_p": 82, "cell_t": 80 }
+
+def test_display_values_are_published_with_the_state():
+    formatter = Messages("pool", "homeassistant", ["sp_p", "htr"], [])
+    pman = PanelManager(10, 180, display_parser=DisplayParser())
+    pman.text_updated("Heater1 Auto Control")
+    message = json.loads(formatter.get_state_message(AquaLogic(web_port=0), pman))
+    assert (message["sp_p"], message["htr"]) == (None, "Auto Control")
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+from aqualogic_mqtt import filters, panelbridge, panelmanager
+from aqualogic_mqtt.filters import SensorFilter
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panelbridge import PanelBridge
+from aqualogic_mqtt.panelmanager import PanelManager
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    for module in (filters, panelbridge, panelmanager):
+        monkeypatch.setattr(module, "time", clock)
+
+def test_deadband():
+    f = SensorFilter(deadband=2)
+    assert f.apply(80) == 80
+    assert f.apply(81) == 80
+    assert f.apply(79) == 80
+    assert f.apply(82) == 82
+    assert f.get_held_count() == 2
+    assert f.get_next_due() is None
+
+def test_deadband_percent():
+    f = SensorFilter(deadband=5, deadband_pct=True)
+    assert f.apply(1000) == 1000
+    assert f.apply(1040) == 1000
+    assert f.apply(1050) == 1050
+
+def test_non_numeric_readings_pass_through():
+    f = SensorFilter(deadband=10)
+    assert f.apply(80) == 80
+    assert f.apply(None) is None
+    assert f.apply(85) == 85
+
+def test_min_interval(clock):
+    f = SensorFilter(min_interval=10)
+    assert f.apply(80) == 80
+    clock.advance(4)
+    assert f.apply(81) == 80
+    assert f.get_next_due() == clock.now + 6
+    clock.advance(6)
+    assert f.apply(81) == 81
+    assert f.get_next_due() is None
+
+def test_max_staleness(clock):
+    f = SensorFilter(deadband=2, max_staleness=60)
+    f.apply(80)
+    clock.advance(1)
+    assert f.apply(81) == 80
+    assert f.get_next_due() == clock.now + 60
+    clock.advance(59)
+    assert f.apply(81) == 80
+    clock.advance(1)
+    assert f.apply(81) == 81
+
+def test_held_in_deadband_after_min_interval_is_not_due(clock):
+    f = SensorFilter(deadband=2, min_interval=10)
+    f.apply(80)
+    clock.advance(1)
+    f.apply(81)
+    assert f.get_next_due() == clock.now + 9
+    clock.advance(9)
+    assert f.apply(81) == 80
+    # Only a bigger change can be reported now, and that comes with an update
+    assert f.get_next_due() is None
+
+def test_parse():
+    f = SensorFilter.parse(["deadband=5%", "min-interval=30", "max-staleness=900"])
+    assert (f._deadband, f._deadband_pct, f._min_interval, f._max_staleness) == (5, True, 30, 900)
+    for options in (["deadband"], ["speed=1"], ["min-interval=soon"]):
+        with pytest.raises(ValueError):
+            SensorFilter.parse(options)
+
+def _bridge(sensor_filter, published):
+    formatter = Messages("pool", "homeassistant", ["t_p"], [], sensor_filters={ "t_p": sensor_filter })
+    return PanelBridge("localhost:8899", formatter, PanelManager(30, 180),
+                       lambda topic, payload, retain=False: published.append(json.loads(payload)),
+                       heartbeat_interval=0, coalesce_window=0)
+
+def _update_pool_temp(bridge, value):
+    bridge._panel._pool_temp = value
+    bridge._panel_changed(bridge._panel)
+
+def test_held_value_is_published_when_min_interval_runs_out(clock):
+    published = []
+    bridge = _bridge(SensorFilter(min_interval=1), published)
+    _update_pool_temp(bridge, 80)
+    _update_pool_temp(bridge, 81)
+    assert [m["t_p"] for m in published] == [80]
+    assert bridge.get_next_check_delay() == pytest.approx(1)
+    clock.advance(1)
+    assert bridge.check()
+    assert [m["t_p"] for m in published] == [80, 81]
+
+def test_held_value_is_published_once_stale(clock):
+    published = []
+    bridge = _bridge(SensorFilter(deadband=2, max_staleness=60), published)
+    _update_pool_temp(bridge, 80)
+    clock.advance(1)
+    _update_pool_temp(bridge, 81)
+    assert bridge.get_next_check_delay() == pytest.approx(29)  # the source timeout comes first
+    for _ in range(60):
+        clock.advance(1)
+        bridge._pman.text_updated("Pool Temp 81°F")
+        bridge.check()
+    assert [m["t_p"] for m in published] == [80, 81]
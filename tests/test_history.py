@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from aqualogic_mqtt.history import BOOL, NUMBER, TEXT, StateHistory
+from aqualogic_mqtt.messages import Messages
+
+COLUMNS = [("f", BOOL), ("t_p", NUMBER), ("sysm", TEXT)]
+
+def test_record_and_get_columns():
+    history = StateHistory(COLUMNS, 4)
+    assert history.record([True, 80, ""], timestamp=1)
+    assert history.record([False, 80.5, "Low Salt"], timestamp=2)
+    assert history.get_columns() == {
+        "t": [1, 2], "f": [True, False], "t_p": [80, 80.5], "sysm": ["", "Low Salt"]
+    }
+
+def test_unchanged_snapshot_is_not_recorded():
+    history = StateHistory(COLUMNS, 4)
+    assert history.record([True, 80, ""], timestamp=1)
+    assert not history.record([True, 80, ""], timestamp=2)
+    assert len(history) == 1
+
+def test_unknown_values():
+    history = StateHistory(COLUMNS, 4)
+    history.record([None, None, None], timestamp=1)
+    assert history.get_columns() == { "t": [1], "f": [None], "t_p": [None], "sysm": [None] }
+
+def test_ring_keeps_the_latest_rows():
+    history = StateHistory(COLUMNS, 3)
+    for n in range(5):
+        history.record([n % 2 == 0, n, str(n)], timestamp=n)
+    assert len(history) == 3
+    columns = history.get_columns()
+    assert columns["t"] == [2, 3, 4]
+    assert columns["sysm"] == ["2", "3", "4"]
+
+def test_since_limit_and_keys():
+    history = StateHistory(COLUMNS, 8)
+    for n in range(5):
+        history.record([True, n, ""], timestamp=n)
+    assert history.get_columns(since=2)["t"] == [3, 4]
+    assert history.get_columns(limit=2)["t"] == [3, 4]
+    assert history.get_columns(limit=0)["t"] == []
+    assert history.get_columns(keys=["t_p"]) == { "t": [0, 1, 2, 3, 4], "t_p": [0, 1, 2, 3, 4] }
+
+def test_text_strings_are_compacted():
+    history = StateHistory(COLUMNS, 2)
+    for n in range(20):
+        history.record([True, 80, f"message {n}"], timestamp=n)
+    strings, index = history._strings[2]
+    assert len(strings) <= 2 * history.get_capacity()
+    assert history.get_columns()["sysm"] == ["message 18", "message 19"]
+
+def test_parse_history_request():
+    formatter = Messages("pool", "homeassistant", ["t_p", "f"], [], history=True)
+    assert formatter.parse_history_request("") == (None, None, None)
+    assert formatter.parse_history_request('{"since": 5, "limit": 2, "keys": ["t_p"]}') == (5, 2, ["t_p"])
+    for payload in ('[]', '{"since": "now"}', '{"limit": 1.5}', '{"keys": ["spa"]}'):
+        with pytest.raises(ValueError):
+            formatter.parse_history_request(payload)
+
+def test_history_response_uses_on_off():
+    formatter = Messages("pool", "homeassistant", ["f"], [], history=True)
+    response = formatter.get_history_response({ "t": [1], "f": [True], "t_p": [None] })
+    assert json.loads(response) == { "t": [1], "f": ["ON"], "t_p": [None] }
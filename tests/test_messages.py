@@ -0,0 +1,78 @@
+import json
+
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import AquaLogic, States
+from aqualogic_mqtt.panelmanager import PanelManager
+
+def _panel(states=States.FILTER):
+    panel = AquaLogic(web_port=0)
+    panel._states = states
+    panel._pool_temp = 81
+    return panel
+
+def _components(formatter):
+    (topic, message), = formatter.get_discovery_messages()
+    return json.loads(message)["cmps"]
+
+def test_state_message():
+    formatter = Messages("pool", "homeassistant", ["t_p", "f", "l"], [["Low Salt", "ls"]])
+    pman = PanelManager(10, 180)
+    pman.observe_system_message("Low Salt")
+    message = json.loads(formatter.get_state_message(_panel(States.FILTER | States.CHECK_SYSTEM), pman))
+    assert message == { "cs": "ON", "sysm": "Low Salt", "t_p": 81, "f": "ON", "l": "OFF", "ls": "ON" }
+
+def test_entity_layout_never_publishes_an_empty_payload():
+    formatter = Messages("pool", "homeassistant", ["t_p", "f"], [], topic_layout="entity")
+    messages = dict(formatter.get_entity_state_messages(_panel(), PanelManager(10, 180)))
+    assert messages == {
+        "homeassistant/device/pool/pool_binary_sensor_check_system/state": "OFF",
+        "homeassistant/device/pool/pool_sensor_system_messages/state": '""',
+        "homeassistant/device/pool/pool_sensor_pool_temperature/state": "81",
+        "homeassistant/device/pool/pool_switch_filter/state": "ON",
+    }
+    assert all(messages.values())
+
+def test_entity_layout_system_messages_are_a_json_string():
+    formatter = Messages("pool", "homeassistant", [], [], topic_layout="entity")
+    pman = PanelManager(10, 180)
+    pman.observe_system_message("Low Salt")
+    pman.observe_system_message("Inspect Cell")
+    messages = dict(formatter.get_entity_state_messages(_panel(States.CHECK_SYSTEM), pman))
+    assert json.loads(messages["homeassistant/device/pool/pool_sensor_system_messages/state"]) == "Inspect Cell, Low Salt"
+    cmps = _components(formatter)
+    assert cmps["pool_sensor_system_messages"]["val_tpl"] == "{{ value_json }}"
+    assert "val_tpl" not in cmps["pool_binary_sensor_check_system"]
+
+def test_device_discovery_is_one_cached_document():
+    formatter = Messages("pool", "homeassistant", ["t_p", "f"], [["Low Salt", "ls"]])
+    (topic, message), = formatter.get_discovery_messages()
+    assert topic == "homeassistant/device/pool/config"
+    document = json.loads(message)
+    # The spliced cache matches serializing the whole document
+    assert message == json.dumps(document)
+    assert set(document["cmps"]) == {
+        "pool_binary_sensor_check_system", "pool_sensor_system_messages", "pool_sensor_pool_temperature",
+        "pool_switch_filter", "pool_Low_Salt",
+    }
+    assert formatter.get_discovery_messages()[0][1] is message
+
+def test_component_discovery_has_a_config_topic_per_component():
+    formatter = Messages("pool", "homeassistant", ["f"], [], discovery_layout="component")
+    messages = dict(formatter.get_discovery_messages())
+    assert set(messages) == {
+        "homeassistant/binary_sensor/pool/pool_binary_sensor_check_system/config",
+        "homeassistant/sensor/pool/pool_sensor_system_messages/config",
+        "homeassistant/switch/pool/pool_switch_filter/config",
+    }
+    config = json.loads(messages["homeassistant/switch/pool/pool_switch_filter/config"])
+    assert config["dev"]["ids"] == "pool"
+    assert config["avty_t"] == "homeassistant/device/pool/availability"
+    assert "p" not in config
+
+def test_birth_message_resends_device_discovery_only():
+    set_state = lambda state, enable: True
+    device = Messages("pool", "homeassistant", [], [])
+    assert device.handle_message_on_topic("homeassistant/status", "online", set_state) == device.get_discovery_messages()
+    assert device.handle_message_on_topic("homeassistant/status", "offline", set_state) == []
+    component = Messages("pool", "homeassistant", [], [], discovery_layout="component")
+    assert component.handle_message_on_topic("homeassistant/status", "online", set_state) == []
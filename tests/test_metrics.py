@@ -0,0 +1,44 @@
+from aqualogic_mqtt.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+def test_counter_and_gauge():
+    counter = Counter("frames", "Frames")
+    counter.inc()
+    counter.inc(2)
+    assert counter.get() == 3
+    gauge = Gauge("depth", "Depth", fn=lambda: 7)
+    assert gauge.get() == 7
+
+def test_histogram():
+    histogram = Histogram("latency", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.get_count() == 4
+    assert histogram.get_sum() == 6.05
+    assert histogram.get_max() == 5
+    assert histogram.get_avg() == 6.05 / 4
+    assert [(suffix, labels.get("le"), value) for suffix, labels, value in histogram.samples()] == [
+        ("_bucket", 0.1, 1), ("_bucket", 1, 3), ("_bucket", "+Inf", 4), ("_sum", None, 6.05), ("_count", None, 4)
+    ]
+
+def test_empty_histogram_has_no_average():
+    assert Histogram("latency", "Latency").get_avg() is None
+
+def test_render():
+    registry = MetricsRegistry()
+    pool = Counter("frames", "Frames received", labels={ "panel": "pool" })
+    spa = Counter("frames", "Frames received", labels={ "panel": "spa" })
+    pool.inc(5)
+    registry.register(pool, spa, Gauge("available", "Link up", fn=lambda: True),
+                      Gauge("age", "Update age", fn=lambda: None))
+    assert registry.render() == (
+        "# HELP aqualogic_age Update age\n"
+        "# TYPE aqualogic_age gauge\n"
+        "aqualogic_age NaN\n"
+        "# HELP aqualogic_available Link up\n"
+        "# TYPE aqualogic_available gauge\n"
+        "aqualogic_available 1\n"
+        "# HELP aqualogic_frames Frames received\n"
+        "# TYPE aqualogic_frames counter\n"
+        'aqualogic_frames_total{panel="pool"} 5\n'
+        'aqualogic_frames_total{panel="spa"} 0\n'
+    )
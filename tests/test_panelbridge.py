@@ -0,0 +1,176 @@
+import asyncio
+import json
+
+import pytest
+
+from aqualogic_mqtt import commandqueue, history, panelbridge, panelmanager
+from aqualogic_mqtt.capture import CaptureWriter, read_capture
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import States
+from aqualogic_mqtt.panelbridge import PanelBridge
+from aqualogic_mqtt.panelmanager import PanelManager
+from aqualogic_mqtt.stream import FrameFeeder
+from tools.simulator import make_display_frame
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    for module in (commandqueue, history, panelbridge, panelmanager):
+        monkeypatch.setattr(module, "time", clock)
+
+# A bridge publishing (topic, payload, retain) to published, with no worker threads
+def _bridge(published, enable=("t_p", "f"), source="localhost:8899", formatter_args={}, **kwargs):
+    formatter = Messages("pool", "homeassistant", list(enable), [], **formatter_args)
+    kwargs.setdefault("coalesce_window", 0)
+    return PanelBridge(source, formatter, PanelManager(10, 180),
+                       lambda topic, payload, retain=False: published.append((topic, payload, retain)), **kwargs)
+
+def _states(published):
+    return [json.loads(payload) for topic, payload, retain in published if topic.endswith("/state")]
+
+def _update(bridge, **values):
+    for k, v in values.items():
+        setattr(bridge._panel, f"_{k}", v)
+    bridge._panel_changed(bridge._panel)
+
+def test_unchanged_state_is_suppressed():
+    published = []
+    bridge = _bridge(published)
+    _update(bridge, pool_temp=80)
+    _update(bridge, pool_temp=80)
+    _update(bridge, pool_temp=81)
+    assert [m["t_p"] for m in _states(published)] == [80, 81]
+    stats = bridge.get_publish_stats()
+    assert (stats["published"], stats["suppressed"]) == (2, 1)
+
+def test_always_mode_publishes_every_update():
+    published = []
+    bridge = _bridge(published, publish_mode="always")
+    _update(bridge, pool_temp=80)
+    _update(bridge, pool_temp=80)
+    assert [m["t_p"] for m in _states(published)] == [80, 80]
+
+def test_heartbeat_republishes_unchanged_state(clock):
+    published = []
+    bridge = _bridge(published, heartbeat_interval=60)
+    bridge._pman.text_updated("Pool Temp 80°F")
+    _update(bridge, pool_temp=80)
+    assert bridge.get_next_check_delay() == pytest.approx(10)  # the source timeout comes first
+    for _ in range(6):
+        clock.advance(9)
+        bridge._pman.text_updated("Pool Temp 80°F")
+        bridge.check()
+    assert len(_states(published)) == 1
+    clock.advance(6)
+    bridge._pman.text_updated("Pool Temp 80°F")
+    bridge.check()
+    assert [m["t_p"] for m in _states(published)] == [80, 80]
+
+def test_no_heartbeat_before_the_first_state(clock):
+    published = []
+    bridge = _bridge(published, heartbeat_interval=60)
+    # The clock starts well past the heartbeat interval
+    assert clock.now > 60
+    bridge._pman.text_updated("Pool Temp 80°F")
+    assert bridge.check()
+    assert published == []
+    assert bridge.get_next_check_delay() == pytest.approx(10)
+
+def test_entity_layout_publishes_only_changed_values():
+    published = []
+    bridge = _bridge(published, formatter_args={ "topic_layout": "entity" })
+    _update(bridge, pool_temp=80)
+    first = len(published)
+    _update(bridge, pool_temp=81)
+    assert published[first:] == [("homeassistant/device/pool/pool_sensor_pool_temperature/state", "81", False)]
+
+def test_command_is_queued_and_timed_through_to_its_frame(clock):
+    published = []
+    bridge = _bridge(published)
+    assert bridge.handle_message("homeassistant/device/pool/pool_switch_filter/set", "ON") == []
+    assert bridge._command_queue.get_depth() == 1
+    assert published == []
+    clock.advance(1)
+    bridge._command_queue._drain()
+    (queued,) = bridge._panel._send_queue.queue
+    assert queued["received"] == 1000
+    assert bridge.get_command_stats()["received"] == 1
+
+def test_optimistic_state_until_the_panel_confirms(clock):
+    published = []
+    bridge = _bridge(published, optimistic=True)
+    _update(bridge, pool_temp=80)
+    bridge.handle_message("homeassistant/device/pool/pool_switch_filter/set", "ON")
+    assert [m["f"] for m in _states(published)] == ["OFF", "ON"]
+    clock.advance(2)
+    _update(bridge, states=States.FILTER)
+    assert bridge._inflight == {}
+    stats = bridge.get_command_stats()
+    assert (stats["completed"], stats["completion_max_ms"]) == (1, 2000)
+
+def test_unconfirmed_optimistic_command_times_out(clock):
+    published = []
+    bridge = _bridge(published, optimistic=True)
+    bridge.handle_message("homeassistant/device/pool/pool_switch_filter/set", "ON")
+    clock.advance(31)
+    _update(bridge, pool_temp=80)
+    assert _states(published)[-1]["f"] == "OFF"
+    assert bridge.get_command_stats()["failed"] == 1
+
+def test_availability_follows_the_panel_link(clock):
+    published = []
+    bridge = _bridge(published)
+    bridge._connected = True
+    bridge._pman.text_updated("Pool Temp 80°F")
+    assert bridge.check()
+    clock.advance(11)
+    assert not bridge.check()
+    assert not bridge.check()
+    clock.advance(4)
+    bridge._pman.text_updated("Pool Temp 80°F")
+    assert bridge.check()
+    availability = [(payload, retain) for topic, payload, retain in published
+                    if topic == "homeassistant/device/pool/availability"]
+    assert availability == [("online", True), ("offline", True), ("online", True)]
+    # Timed from when the link was found lost
+    assert bridge.get_link_stats()["recovery_last_s"] == 4
+
+def test_history_request():
+    published = []
+    bridge = _bridge(published, formatter_args={ "history": True }, history_size=8)
+    _update(bridge, pool_temp=80)
+    _update(bridge, pool_temp=81)
+    topic = "homeassistant/device/pool/history/get"
+    assert json.loads(bridge.handle_request(topic, '{"keys": ["t_p"]}')) == { "t": [1000, 1000], "t_p": [80, 81] }
+    assert "error" in json.loads(bridge.handle_request(topic, '{"limit": "all"}'))
+    assert bridge.handle_request("homeassistant/device/pool/pool_switch_filter/set", "ON") is None
+
+def test_replay(tmp_path):
+    path = str(tmp_path / "panel.cap")
+    capture = CaptureWriter(path)
+    capture.write(make_display_frame("Pool Temp 80°F"))
+    capture.write(make_display_frame("Pool Temp 82°F"))
+    capture.close()
+    published = []
+    bridge = _bridge(published, source=f"replay:{path}", replay_speed=0)
+    bridge._replay()
+    assert bridge.is_finished()
+    assert [m["t_p"] for m in _states(published)] == [80, 82]
+
+# Stands in for an AsyncSource, reading the given chunks and then EOF
+class ChunkSource:
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+
+    async def read(self):
+        return self._chunks.pop(0) if self._chunks else b""
+
+def test_replay_is_not_recorded_in_asyncio_mode(tmp_path):
+    record = str(tmp_path / "record.cap")
+    published = []
+    bridge = _bridge(published, source="replay:panel.cap", record=record)
+    feeder = FrameFeeder(bridge._panel, bridge._panel_changed, lambda data: None)
+    source = ChunkSource([make_display_frame("Pool Temp 80°F")])
+    assert asyncio.run(bridge._read_async(source, feeder)) > 0
+    bridge.stop()
+    assert [m["t_p"] for m in _states(published)] == [80]
+    assert list(read_capture(record)) == []
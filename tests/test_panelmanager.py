@@ -0,0 +1,67 @@
+import pytest
+
+from aqualogic_mqtt import panelmanager
+from aqualogic_mqtt.panelmanager import PanelManager
+
+@pytest.fixture
+def pman(monkeypatch, clock):
+    monkeypatch.setattr(panelmanager, "time", clock)
+    pman = PanelManager(connect_timeout=10, message_exp_seconds=2)
+    pman.changes = []
+    pman.set_system_messages_listener(lambda messages: pman.changes.append(list(messages)))
+    return pman
+
+def test_messages_are_sorted_and_only_notified_on_change(pman):
+    pman.observe_system_message("Low Salt")
+    pman.observe_system_message("Inspect Cell\x00 ")
+    pman.observe_system_message("Low Salt")
+    assert pman.get_system_messages() == ["Inspect Cell", "Low Salt"]
+    assert pman.changes == [["Low Salt"], ["Inspect Cell", "Low Salt"]]
+
+def test_message_expires_once_no_longer_seen(pman, clock):
+    pman.observe_system_message("Low Salt")
+    clock.advance(1)
+    pman.observe_system_message("Inspect Cell")
+    assert pman.get_next_expiry_delay() == pytest.approx(1)
+    clock.advance(1)
+    pman.expire_system_messages()
+    assert pman.get_system_messages() == ["Inspect Cell"]
+    clock.advance(1)
+    pman.observe_system_message(None)
+    assert pman.get_system_messages() == []
+    assert pman.get_next_expiry_delay() is None
+    assert pman.changes[-1] == []
+
+def test_message_on_screen_does_not_expire(pman, clock):
+    # aqualogic reports the message once; the panel then keeps showing it
+    pman.observe_system_message("Low Salt")
+    for _ in range(5):
+        clock.advance(1)
+        pman.text_updated("Check System Low Salt")
+        pman.text_updated("Pool Temp 80°F")
+        pman.expire_system_messages()
+    assert pman.get_system_messages() == ["Low Salt"]
+    assert pman.changes == [["Low Salt"]]
+    clock.advance(2)
+    pman.expire_system_messages()
+    assert pman.get_system_messages() == []
+
+def test_message_reappearing_on_screen_is_observed_again(pman, clock):
+    pman.text_updated("Check System Low Salt")
+    clock.advance(3)
+    pman.expire_system_messages()
+    assert pman.get_system_messages() == []
+    # The same text again is not a change to aqualogic, but it is seen here
+    pman.text_updated("Check System Low Salt")
+    assert pman.get_system_messages() == ["Low Salt"]
+
+def test_update_timeout(pman, clock):
+    assert pman.is_awaiting_update()
+    clock.advance(5)
+    pman.text_updated("Pool Temp 80°F")
+    assert not pman.is_awaiting_update()
+    assert pman.get_timeout_delay() == pytest.approx(10)
+    clock.advance(10)
+    assert not pman.is_updating()
+    pman.reset_timeout()
+    assert pman.is_updating() and pman.is_awaiting_update()
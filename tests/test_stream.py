@@ -0,0 +1,43 @@
+import logging
+
+from aqualogic_mqtt.panel import AquaLogic
+from aqualogic_mqtt.panelmanager import PanelManager
+from tools.simulator import make_display_frame, make_frame
+from aqualogic_mqtt.stream import FrameFeeder
+
+def _panel():
+    panel = AquaLogic(web_port=0)
+    panel._web = PanelManager(30, 180)
+    return panel
+
+def test_feed_processes_frames_split_across_chunks():
+    panel = _panel()
+    changes = []
+    feeder = FrameFeeder(panel, lambda p: changes.append(p.pool_temp), lambda data: None)
+    data = make_display_frame("Pool Temp 80°F") + make_display_frame("Pool Temp 81°F")
+    split = len(data) // 2 + 3
+    assert feeder.feed(data[:split]) == 1
+    assert changes == [80]
+    assert feeder.feed(data[split:]) == 1
+    assert changes == [80, 81]
+    assert feeder.get_frame_count() == 2
+
+def test_feed_writes_queued_frame_on_keep_alive():
+    panel = _panel()
+    written = []
+    feeder = FrameFeeder(panel, lambda p: None, written.append)
+    panel._send_queue.put({ 'frame': b'key' })
+    feeder.feed(make_frame(AquaLogic.FRAME_TYPE_KEEP_ALIVE))
+    assert written == [b'key']
+
+def test_feed_does_not_log_eof_for_each_chunk(caplog):
+    feeder = FrameFeeder(_panel(), lambda p: None, lambda data: None)
+    with caplog.at_level(logging.DEBUG, logger="aqualogic.core"):
+        for _ in range(3):
+            feeder.feed(make_display_frame("Pool Temp 80°F"))
+    assert not [r for r in caplog.records if r.getMessage() == "eof"]
+
+def test_eof_is_still_logged_outside_a_feed(caplog):
+    with caplog.at_level(logging.INFO, logger="aqualogic.core"):
+        logging.getLogger("aqualogic.core").info("eof")
+    assert [r for r in caplog.records if r.getMessage() == "eof"]
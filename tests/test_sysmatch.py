@@ -0,0 +1,54 @@
+import pytest
+
+from aqualogic_mqtt.sysmatch import SystemMessageMatcher
+
+def test_exact_match_by_default():
+    matcher = SystemMessageMatcher(["Low Salt", "Inspect Cell"])
+    assert matcher.match("Low Salt") == (True, False)
+    assert matcher.match("Low Salt 2700") == (False, False)
+
+def test_glob_characters_without_prefix_match_exactly():
+    matcher = SystemMessageMatcher(["Low Salt*", "Cell [2]"])
+    assert matcher.match("Low Salt*") == (True, False)
+    assert matcher.match("Low Salt 2700") == (False, False)
+    assert matcher.match("Cell [2]") == (False, True)
+    assert matcher.match("Cell 2") == (False, False)
+
+def test_glob_prefix():
+    matcher = SystemMessageMatcher(["glob:Low Salt*", "glob:Cell ?"])
+    assert matcher.match("Low Salt 2700") == (True, False)
+    assert matcher.match("Cell 2") == (False, True)
+    assert matcher.match("Very Low Salt") == (False, False)
+
+def test_regex_must_match_the_whole_message():
+    matcher = SystemMessageMatcher(["re:(Check|Inspect) Cell"])
+    assert matcher.match("Inspect Cell") == (True,)
+    assert matcher.match("Inspect Cell Now") == (False,)
+
+def test_patterns_that_cannot_be_combined_still_match():
+    matcher = SystemMessageMatcher(["re:(?P<x>Low) Salt", "re:(?P<x>High) Salt"])
+    assert matcher._any is None
+    assert matcher.match("High Salt") == (False, True)
+
+def test_patterns_with_backreferences_are_not_combined():
+    matcher = SystemMessageMatcher(["glob:Low*", r"re:(\w+) \1"])
+    assert matcher._any is None
+    assert matcher.match("Cell Cell") == (False, True)
+    assert matcher.match("Cell Salt") == (False, False)
+
+def test_patterns_with_global_flags_still_match():
+    matcher = SystemMessageMatcher(["Low Salt", "re:(?i)high salt"])
+    assert matcher._any is None
+    assert matcher.match("High Salt") == (False, True)
+
+def test_invalid_regex():
+    with pytest.raises(ValueError):
+        SystemMessageMatcher.compile_pattern("re:(unclosed")
+
+def test_evaluate_combines_messages_and_caches_the_list():
+    matcher = SystemMessageMatcher(["Low Salt", "glob:Inspect*", "High Salt"])
+    messages = ["Inspect Cell", "Low Salt"]
+    result = matcher.evaluate(messages)
+    assert result == (True, True, False)
+    assert matcher.evaluate(messages) is result
+    assert matcher.evaluate([]) == (False, False, False)
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from aqualogic_mqtt import panelbridge, writer
+from aqualogic_mqtt.messages import Messages
+from aqualogic_mqtt.panel import States
+from aqualogic_mqtt.panelbridge import PanelBridge
+from aqualogic_mqtt.panelmanager import PanelManager
+from aqualogic_mqtt.writer import FrameWriter
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(writer, "time", clock)
+    monkeypatch.setattr(panelbridge, "time", clock)
+
+# A write that fails the first `failures` times it is called
+class FlakyWrite:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.written = []
+
+    def __call__(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("write failed")
+        self.written.append(data)
+
+def test_frames_handed_over_together_are_written_as_one_batch(clock):
+    w = FrameWriter()
+    write = FlakyWrite()
+    w.attach(write)
+    written = []
+    w.set_written_listener(lambda received, at: written.append((received, at)))
+    clock.advance(1)
+    w.submit(b'a', received=999)
+    w.submit(b'b')
+    w._flush()
+    assert write.written == [b'ab']
+    assert written == [(999, clock.now)]
+    assert w.get_stats()["written"] == 2 and w.get_stats()["batches"] == 1
+
+def test_nothing_is_written_until_attached():
+    w = FrameWriter()
+    w.submit(b'a')
+    w._flush()
+    write = FlakyWrite()
+    w.attach(write)
+    w._flush()
+    assert write.written == [b'a']
+
+def test_detach_drops_pending_frames():
+    w = FrameWriter()
+    w.attach(FlakyWrite())
+    w.submit(b'a')
+    w.detach()
+    assert w.get_depth() == 0
+    assert w.get_stats()["failed"] == 1
+
+def test_min_interval(clock):
+    w = FrameWriter(min_interval=0.5)
+    w.attach(FlakyWrite())
+    assert w.is_ready()
+    w.submit(b'a')
+    w._flush()
+    clock.advance(0.3)
+    assert not w.is_ready()
+    clock.advance(0.2)
+    assert w.is_ready()
+    assert w.get_stats()["slots_skipped"] == 1
+
+def test_failed_frames_are_handed_back_until_out_of_retries():
+    w = FrameWriter(retries=1)
+    w.attach(FlakyWrite(failures=5))
+    retries = []
+    w.set_retry_listener(lambda frame, received, attempts: retries.append((frame, received, attempts)))
+    w.submit(b'a', received=5)
+    w._flush()
+    # Handed back rather than written again straight away
+    assert retries == [(b'a', 5, 1)]
+    assert w.get_depth() == 0
+    w.submit(b'a', received=5, attempts=1)
+    w._flush()
+    assert retries == [(b'a', 5, 1)]
+    assert w.get_stats()["retries"] == 1 and w.get_stats()["failed"] == 1
+
+def test_failed_write_counts_for_min_interval(clock):
+    w = FrameWriter(min_interval=0.5)
+    w.attach(FlakyWrite(failures=1))
+    w.set_retry_listener(lambda frame, received, attempts: None)
+    w.submit(b'a')
+    w._flush()
+    assert not w.is_ready()
+
+def test_bridge_retries_a_failed_frame_in_a_later_ready_slot(clock):
+    bridge = PanelBridge("localhost:8899", Messages("pool", "homeassistant", [], []), PanelManager(30, 180),
+                         lambda topic, payload, retain=False: None, coalesce_window=0, write_min_interval=0.5)
+    write = FlakyWrite(failures=1)
+    bridge._writer.attach(write)
+    bridge._panel._send_queue.put({ 'frame': b'key', 'desired_states': [], 'received': clock.now })
+
+    # Each keep-alive slot: the panel offers the queued frame, the writer writes it
+    def keep_alive():
+        if not bridge._panel._send_queue.empty():
+            bridge._send_frame_timed()
+        bridge._writer._flush()
+
+    keep_alive()
+    assert write.written == [] and bridge._panel._send_queue.qsize() == 1
+    clock.advance(0.1)
+    keep_alive()
+    assert write.written == [] # not ready yet
+    clock.advance(0.4)
+    keep_alive()
+    assert write.written == [b'key']
+    assert bridge._panel._send_queue.empty()
+    # The command's write latency is still measured from when it was received
+    assert bridge.get_command_stats()["written"] == 1
+
+def test_state_can_be_read_and_set_while_a_retry_is_queued():
+    formatter = Messages("pool", "homeassistant", ["f", "l"], [])
+    bridge = PanelBridge("localhost:8899", formatter, PanelManager(30, 180),
+                         lambda topic, payload, retain=False: None, coalesce_window=0)
+    bridge._retry_frame(b'key', None, 1)
+    assert json.loads(formatter.get_state_message(bridge._panel, bridge._pman))["f"] == "OFF"
+    assert formatter.get_state_values(bridge._panel, bridge._pman)
+    assert bridge._panel.set_state(States.FILTER, True)
+    assert bridge._panel.get_state(States.FILTER)
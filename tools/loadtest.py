@@ -0,0 +1,149 @@
+import asyncio
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+
+from tools.simulator import SimulatedPanel, PanelSimulator
+from tools.testbroker import TestBroker
+
+logger = logging.getLogger(__name__)
+
+# Drives the full client pipeline (python -m aqualogic_mqtt.client, run as a
+# subprocess) between a simulated panel and the test broker, both in this
+# process so that they share a clock. The simulated air temperature carries a
+# sequence number; the time from its display frame to the first state message
+# containing it is the end-to-end lag. Optionally toggles Aux 1 through its
+# command topic and times the round trip to a state message showing the change.
+class LoadTest:
+    _commands_sent = 0
+    _command_pending = None
+    _states_received = 0
+
+    def __init__(self, identifier:(str)="aqualogic", discover_prefix:(str)="homeassistant"):
+        self._root = f"{discover_prefix}/device/{identifier}"
+        self._command_topic = f"{self._root}/{identifier}_switch_aux_1/set"
+        self._sequence_sent = {}
+        self._lags = []
+        self._command_lags = []
+        self._aux1 = None
+        self.panel = SimulatedPanel()
+        self.panel.set_sequence_listener(self._sequence_sent.__setitem__)
+        self.broker = TestBroker()
+        self.broker.set_publish_listener(self._on_publish)
+
+    def _on_publish(self, topic, payload, props):
+        if topic != f"{self._root}/state":
+            return
+        now = time.monotonic()
+        self._states_received += 1
+        state = json.loads(payload)
+        sent = self._sequence_sent.pop(state.get("t_a"), None)
+        if sent is not None:
+            self._lags.append(now - sent)
+        self._aux1 = state.get("aux1")
+        if self._command_pending is not None and self._aux1 == self._command_pending[0]:
+            self._command_lags.append(now - self._command_pending[1])
+            self._command_pending = None
+
+    async def _send_commands(self, rate):
+        while True:
+            await asyncio.sleep(1 / rate)
+            if self._command_pending is not None or self._aux1 is None:
+                continue
+            target = "OFF" if self._aux1 == "ON" else "ON"
+            self._command_pending = (target, time.monotonic())
+            self._commands_sent += 1
+            self.broker.publish(self._command_topic, target)
+
+    def take_interval(self):
+        lags, self._lags = self._lags, []
+        command_lags, self._command_lags = self._command_lags, []
+        states, self._states_received = self._states_received, 0
+        return lags, command_lags, states
+
+def _percentile(values, p):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def _summarize(lags):
+    if not lags:
+        return "n/a"
+    return (f"p50 {_percentile(lags, 0.5)*1000:.0f}ms, p99 {_percentile(lags, 0.99)*1000:.0f}ms, "
+            f"max {max(lags)*1000:.0f}ms")
+
+async def _main(args, client_args):
+    test = LoadTest()
+    simulator = PanelSimulator(test.panel, speedup=args.speedup)
+    panel_server = await simulator.start("127.0.0.1", 0)
+    broker_server = await test.broker.start("127.0.0.1", 0)
+    panel_port = panel_server.sockets[0].getsockname()[1]
+    broker_port = broker_server.sockets[0].getsockname()[1]
+
+    command = [sys.executable, "-m", "aqualogic_mqtt.client",
+               "-t", f"127.0.0.1:{panel_port}", "-m", f"127.0.0.1:{broker_port}",
+               "-e", "t_a", "t_p", "aux1", "--runtime", args.runtime] + client_args
+    print(f"Running {' '.join(command[1:])} at {args.speedup}x for {args.duration}s", flush=True)
+    client = await asyncio.create_subprocess_exec(*command)
+    commands = asyncio.create_task(test._send_commands(args.command_rate)) if args.command_rate > 0 else None
+
+    all_lags = []
+    all_command_lags = []
+    last_frames = 0
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < args.duration and client.returncode is None:
+            await asyncio.sleep(args.report_interval)
+            lags, command_lags, states = test.take_interval()
+            all_lags += lags
+            all_command_lags += command_lags
+            frames = simulator.get_stats()["frames"]
+            print(f"frames/s: {(frames - last_frames) / args.report_interval:.0f}, "
+                  f"states/s: {states / args.report_interval:.1f}, lag: {_summarize(lags)}, "
+                  f"commands: {_summarize(command_lags)}", flush=True)
+            last_frames = frames
+    finally:
+        if commands is not None:
+            commands.cancel()
+        if client.returncode is None:
+            client.terminate()
+            await client.wait()
+        panel_server.close()
+        broker_server.close()
+
+    print(f"Overall lag: {_summarize(all_lags)} over {len(all_lags)} samples", flush=True)
+    if all_command_lags:
+        print(f"Overall command round trip: {_summarize(all_command_lags)} over {len(all_command_lags)} commands "
+              f"({test._commands_sent} sent, {test.panel.get_stats()['keys']} key frames received)", flush=True)
+    # Lag growing steadily across the run means the pipeline is falling behind
+    if len(all_lags) >= 20:
+        half = len(all_lags) // 2
+        print(f"Median lag first half {statistics.median(all_lags[:half])*1000:.0f}ms, "
+              f"second half {statistics.median(all_lags[half:])*1000:.0f}ms", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='tools.loadtest',
+                    description='Load test the client between a simulated panel and a test broker',
+                    epilog='Arguments after "--" are passed to the client, e.g. -- --publish-mode always',
+                    )
+    parser.add_argument('--speedup', type=float, default=10, metavar="FACTOR", help="panel frame rate relative to a real panel (default is 10)")
+    parser.add_argument('--duration', type=float, default=30, metavar="SECONDS", help="seconds to run for (default is 30)")
+    parser.add_argument('--runtime', type=str, choices=["threads","asyncio"], default="threads", help="client runtime (default is threads)")
+    parser.add_argument('--command-rate', type=float, default=0, metavar="HZ", help="toggle Aux 1 at up to this rate (default is 0, disabled)")
+    parser.add_argument('--report-interval', type=float, default=5, metavar="SECONDS", help="seconds between reports (default is 5)")
+    argv = sys.argv[1:]
+    client_args = []
+    if "--" in argv:
+        client_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        asyncio.run(_main(args, client_args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,229 @@
+import asyncio
+import argparse
+import logging
+import random
+import time
+
+from aqualogic_mqtt.panel import AquaLogic, Keys, States
+
+logger = logging.getLogger(__name__)
+
+# Builds a complete frame as sent on the bus: DLE/STX, type and data with DLE
+# stuffing, checksum, DLE/ETX.
+def make_frame(frame_type:(bytes), data:(bytes)=b''):
+    frame = bytearray((AquaLogic.FRAME_DLE, AquaLogic.FRAME_STX))
+    checksum = AquaLogic.FRAME_DLE + AquaLogic.FRAME_STX + sum(frame_type) + sum(data)
+    for byte in frame_type + data + checksum.to_bytes(2, byteorder='big'):
+        frame.append(byte)
+        if byte == AquaLogic.FRAME_DLE:
+            frame.append(0)
+    frame += bytes((AquaLogic.FRAME_DLE, AquaLogic.FRAME_ETX))
+    return bytes(frame)
+
+def make_display_frame(text:(str)):
+    # The panel uses 0xdf for the degree symbol
+    return make_frame(AquaLogic.FRAME_TYPE_DISPLAY_UPDATE, text.replace('°', '\xdf').encode('latin-1'))
+
+# Splits frames out of a byte stream, yielding (frame_type, data) with DLE
+# stuffing and the checksum removed.
+class FrameParser:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        while True:
+            start = self._buffer.find(b'\x10\x02')
+            if start < 0:
+                self._buffer.clear()
+                return
+            end = self._buffer.find(b'\x10\x03', start + 2)
+            if end < 0:
+                del self._buffer[:start]
+                return
+            raw = bytes(self._buffer[start + 2:end]).replace(b'\x10\x00', b'\x10')
+            del self._buffer[:end + 2]
+            if len(raw) >= 4:
+                yield raw[0:2], raw[2:-2]
+
+# A simulated AquaLogic panel: keeps LED states and sensor values, produces the
+# frames the panel would send, and toggles states in response to key events.
+class SimulatedPanel:
+    _states = 0
+    _flashing = 0
+    _keys_received = 0
+    _display_index = 0
+    _sequence = 0
+    _on_sequence = None
+
+    def __init__(self, jitter:(bool)=True, check_system:(str)=None):
+        self._jitter = jitter
+        self._states = States.FILTER | States.POOL | States.HEATER_AUTO_MODE
+        self._values = {
+            "pool_temp": 80, "spa_temp": 98, "salt": 3200, "pool_chlorinator": 50,
+            "spa_chlorinator": 25, "pump_speed": 75, "pump_power": 1200, "pool_setpoint": 82
+        }
+        self._check_system = check_system
+        if check_system:
+            self._states |= States.CHECK_SYSTEM
+        # Keys toggle the state of the same name, except for the few that set_state
+        # maps differently
+        self._key_states = { Keys[s.name].value: s for s in States if s.name in Keys.__members__ }
+        self._key_states[Keys.POOL_SPA.value] = States.POOL | States.SPA
+        self._key_states[Keys.HEATER_1.value] = States.HEATER_AUTO_MODE
+
+    # Called with (sequence, time) each time an air temperature frame carrying a new
+    # sequence number is produced, so that a harness can measure end-to-end lag.
+    def set_sequence_listener(self, listener):
+        self._on_sequence = listener
+
+    def keep_alive_frame(self):
+        return make_frame(AquaLogic.FRAME_TYPE_KEEP_ALIVE)
+
+    def led_frame(self):
+        return make_frame(AquaLogic.FRAME_TYPE_LEDS,
+                          int(self._states).to_bytes(4, byteorder='little') +
+                          int(self._flashing).to_bytes(4, byteorder='little'))
+
+    def pump_frame(self):
+        power = self._values["pump_power"]
+        bcd = int(str(power).zfill(4), 16).to_bytes(2, byteorder='big')
+        return make_frame(AquaLogic.FRAME_TYPE_PUMP_STATUS, b'\x00\x00' + bytes((self._values["pump_speed"],)) + bcd)
+
+    def display_frame(self):
+        if self._jitter:
+            for k in ("pool_temp", "pump_power"):
+                self._values[k] += random.choice((-1, 0, 0, 1))
+        screens = [
+            lambda: f"Pool Temp {self._values['pool_temp']}°F",
+            lambda: f"Spa Temp {self._values['spa_temp']}°F",
+            self._air_temp_screen,
+            lambda: f"Salt Level {self._values['salt']} PPM",
+            lambda: f"Pool Chlorinator {self._values['pool_chlorinator']}%",
+            lambda: f"Spa Chlorinator {self._values['spa_chlorinator']}%",
+            lambda: "Heater1 Auto Control" if self._states & States.HEATER_AUTO_MODE else "Heater1 Manual Off",
+            lambda: f"Pool Heater1 {self._values['pool_setpoint']}°F",
+            lambda: time.strftime("%A %I:%M%p").replace(" 0", " ")[:-1],
+        ]
+        if self._check_system:
+            screens.append(lambda: f"Check System {self._check_system}")
+        text = screens[self._display_index % len(screens)]()
+        self._display_index += 1
+        return make_display_frame(text)
+
+    # The air temperature doubles as a sequence number (0-999)
+    def _air_temp_screen(self):
+        self._sequence = (self._sequence + 1) % 1000
+        if self._on_sequence is not None:
+            self._on_sequence(self._sequence, time.monotonic())
+        return f"Air Temp {self._sequence}°F"
+
+    def handle_frame(self, frame_type, data):
+        if frame_type == AquaLogic.FRAME_TYPE_LOCAL_WIRED_KEY_EVENT and len(data) >= 2:
+            key = int.from_bytes(data[0:2], byteorder='little')
+        elif frame_type == AquaLogic.FRAME_TYPE_WIRELESS_KEY_EVENT and len(data) >= 5:
+            key = int.from_bytes(data[1:5], byteorder='little')
+        else:
+            logger.debug(f"Ignoring frame {frame_type.hex()} {data.hex()}")
+            return
+        self._keys_received += 1
+        state = self._key_states.get(key)
+        if state is None:
+            logger.info(f"Key {key:#x} has no simulated effect")
+            return
+        self._states ^= state
+        logger.info(f"Key {key:#x} toggled {state!r}")
+
+    def get_stats(self):
+        return { "keys": self._keys_received }
+
+# Serves a SimulatedPanel to TCP clients (as a network serial adapter would) with
+# frames sent at the given rates (per second), all multiplied by speedup.
+class PanelSimulator:
+    _frames_sent = 0
+
+    def __init__(self, panel:SimulatedPanel, keep_alive_rate=10, led_rate=2, display_rate=2, pump_rate=1, speedup=1):
+        self._panel = panel
+        self._rates = [
+            (keep_alive_rate * speedup, panel.keep_alive_frame),
+            (led_rate * speedup, panel.led_frame),
+            (display_rate * speedup, panel.display_frame),
+            (pump_rate * speedup, panel.pump_frame),
+        ]
+
+    async def _send(self, writer, rate, make):
+        interval = 1 / rate
+        next_send = time.monotonic()
+        while True:
+            writer.write(make())
+            self._frames_sent += 1
+            await writer.drain()
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay < -1:
+                next_send = time.monotonic() # Too far behind, don't try to catch up
+            await asyncio.sleep(max(delay, 0))
+
+    async def _handle(self, reader, writer):
+        logger.info(f"Client connected from {writer.get_extra_info('peername')}")
+        senders = [asyncio.create_task(self._send(writer, rate, make)) for rate, make in self._rates if rate > 0]
+        parser = FrameParser()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                for frame_type, frame_data in parser.feed(data):
+                    self._panel.handle_frame(frame_type, frame_data)
+        except ConnectionError:
+            pass
+        finally:
+            for sender in senders:
+                sender.cancel()
+            writer.close()
+            logger.info("Client disconnected")
+
+    async def start(self, host="127.0.0.1", port=8899):
+        return await asyncio.start_server(self._handle, host, port)
+
+    def get_stats(self):
+        return { "frames": self._frames_sent } | self._panel.get_stats()
+
+async def _report(simulator, interval):
+    last = 0
+    while True:
+        await asyncio.sleep(interval)
+        stats = simulator.get_stats()
+        print(f"frames/s: {(stats['frames'] - last) / interval:.0f}, keys: {stats['keys']}", flush=True)
+        last = stats['frames']
+
+async def _main(args):
+    panel = SimulatedPanel(jitter=not args.no_jitter, check_system=args.check_system)
+    simulator = PanelSimulator(panel, args.keep_alive_rate, args.led_rate, args.display_rate, args.pump_rate, args.speedup)
+    server = await simulator.start(args.host, args.port)
+    print(f"Simulated panel listening on {args.host}:{args.port}", flush=True)
+    async with server:
+        await _report(simulator, args.report_interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='tools.simulator',
+                    description='Simulated AquaLogic panel served over TCP, for load testing',
+                    )
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="address to listen on (default is 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8899, help="port to listen on (default is 8899)")
+    parser.add_argument('--keep-alive-rate', type=float, default=10, metavar="HZ", help="keep-alive frames per second (default is 10)")
+    parser.add_argument('--led-rate', type=float, default=2, metavar="HZ", help="LED frames per second (default is 2)")
+    parser.add_argument('--display-rate', type=float, default=2, metavar="HZ", help="display frames per second (default is 2)")
+    parser.add_argument('--pump-rate', type=float, default=1, metavar="HZ", help="pump status frames per second (default is 1)")
+    parser.add_argument('--speedup', type=float, default=1, metavar="FACTOR", help="multiply all frame rates (default is 1)")
+    parser.add_argument('--check-system', type=str, metavar="MESSAGE", help="show a Check System message")
+    parser.add_argument('--no-jitter', action='store_true', help="keep sensor values constant")
+    parser.add_argument('--report-interval', type=float, default=5, metavar="SECONDS", help="seconds between statistics reports (default is 5)")
+    parser.add_argument('-v', '--verbose', action="count", default=0, help="more output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,335 @@
+import asyncio
+import argparse
+import logging
+import struct
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# A minimal in-process MQTT broker stand-in (MQTT 3.1.1 and 5) for driving the
+# client in load tests without an external broker. It accepts any connection,
+# acknowledges QoS 1 and 2 publishes, keeps retained messages, forwards
+# publishes to matching subscribers at QoS 0 and counts what it receives. There
+# is no authentication, session persistence, will message or flow control.
+
+_CONNECT = 1
+_PUBLISH = 3
+_PUBREL = 6
+_SUBSCRIBE = 8
+_UNSUBSCRIBE = 10
+_PINGREQ = 12
+_DISCONNECT = 14
+
+_PROP_TOPIC_ALIAS = 0x23
+_PROP_TOPIC_ALIAS_MAXIMUM = 0x22
+
+# Value sizes of MQTT 5 properties by identifier; 0 is a length-prefixed string
+# or binary, -1 a variable byte integer and -2 a string pair
+_PROPERTY_SIZES = {
+    0x01: 1, 0x02: 4, 0x03: 0, 0x08: 0, 0x09: 0, 0x0b: -1, 0x11: 4, 0x12: 0,
+    0x13: 2, 0x15: 0, 0x16: 0, 0x17: 1, 0x18: 4, 0x19: 1, 0x1a: 0, 0x1c: 0,
+    0x1f: 0, 0x21: 2, 0x22: 2, 0x23: 2, 0x24: 1, 0x25: 1, 0x26: -2, 0x27: 4,
+    0x28: 1, 0x29: 1, 0x2a: 1
+}
+
+def _encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        out.append(byte | 0x80 if value else byte)
+        if not value:
+            return bytes(out)
+
+def _decode_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def _encode_string(s):
+    b = s.encode() if isinstance(s, str) else s
+    return struct.pack("!H", len(b)) + b
+
+def _decode_string(data, pos):
+    length, = struct.unpack_from("!H", data, pos)
+    return data[pos + 2:pos + 2 + length], pos + 2 + length
+
+# Returns ([(identifier, raw value bytes)], position after the properties)
+def _decode_properties(data, pos):
+    length, pos = _decode_varint(data, pos)
+    end = pos + length
+    props = []
+    while pos < end:
+        ident, pos = _decode_varint(data, pos)
+        size = _PROPERTY_SIZES.get(ident)
+        if size is None:
+            raise ValueError(f"Unknown property {ident:#x}")
+        start = pos
+        if size > 0:
+            pos += size
+        elif size == 0:
+            _, pos = _decode_string(data, pos)
+        elif size == -1:
+            _, pos = _decode_varint(data, pos)
+        else:
+            _, pos = _decode_string(data, pos)
+            _, pos = _decode_string(data, pos)
+        props.append((ident, data[start:pos]))
+    return props, end
+
+def _encode_properties(props):
+    body = b''.join(_encode_varint(ident) + value for ident, value in props)
+    return _encode_varint(len(body)) + body
+
+def _packet(packet_type, flags, body):
+    return bytes(((packet_type << 4) | flags,)) + _encode_varint(len(body)) + body
+
+# MQTT topic filter matching with + and # wildcards
+def topic_matches(topic_filter:(str), topic:(str)):
+    f_parts = topic_filter.split('/')
+    t_parts = topic.split('/')
+    for i, f in enumerate(f_parts):
+        if f == '#':
+            return True
+        if i >= len(t_parts) or (f != '+' and f != t_parts[i]):
+            return False
+    return len(f_parts) == len(t_parts)
+
+class _Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.version = 4
+        self.client_id = ""
+        self.subscriptions = []
+        self.aliases = {}
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def deliver(self, topic, payload, props, retain=False):
+        body = _encode_string(topic)
+        if self.version == 5:
+            body += _encode_properties([p for p in props if p[0] != _PROP_TOPIC_ALIAS])
+        self.send(_packet(_PUBLISH, 1 if retain else 0, body + payload))
+
+class TestBroker:
+    _published_count = 0
+    _published_bytes = 0
+    _on_publish = None
+
+    def __init__(self, topic_alias_maximum:(int)=16):
+        self._topic_alias_maximum = topic_alias_maximum
+        self._sessions = []
+        self._retained = {}
+        self._topic_counts = Counter()
+        self._aliased_count = 0
+
+    # Called with (topic, payload, properties) for each publish received, on the
+    # loop thread; properties is a list of (identifier, raw bytes).
+    def set_publish_listener(self, listener):
+        self._on_publish = listener
+
+    async def start(self, host="127.0.0.1", port=1883):
+        return await asyncio.start_server(self._handle, host, port)
+
+    # Publishes from the broker itself, e.g. to inject commands
+    def publish(self, topic:(str), payload, retain:(bool)=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._route(topic, payload, [], retain)
+
+    def _route(self, topic, payload, props, retain):
+        if retain:
+            if payload:
+                self._retained[topic] = (payload, props)
+            else:
+                self._retained.pop(topic, None)
+        for session in self._sessions:
+            if any(topic_matches(f, topic) for f in session.subscriptions):
+                session.deliver(topic, payload, props)
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        body = await reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0f, body
+
+    async def _handle(self, reader, writer):
+        session = _Session(writer)
+        self._sessions.append(session)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == _DISCONNECT:
+                    break
+                self._dispatch(session, packet_type, flags, body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception(f"Dropping client {session.client_id}")
+        finally:
+            self._sessions.remove(session)
+            writer.close()
+            logger.info(f"Client {session.client_id} disconnected")
+
+    def _dispatch(self, session, packet_type, flags, body):
+        if packet_type == _CONNECT:
+            self._handle_connect(session, body)
+        elif packet_type == _PUBLISH:
+            self._handle_publish(session, flags, body)
+        elif packet_type == _PUBREL:
+            session.send(_packet(7, 0, body[0:2]))
+        elif packet_type == _SUBSCRIBE:
+            self._handle_subscribe(session, body)
+        elif packet_type == _UNSUBSCRIBE:
+            self._handle_unsubscribe(session, body)
+        elif packet_type == _PINGREQ:
+            session.send(_packet(13, 0, b''))
+        else:
+            logger.debug(f"Ignoring packet type {packet_type}")
+
+    def _handle_connect(self, session, body):
+        _, pos = _decode_string(body, 0)
+        session.version = body[pos]
+        pos += 4 # Level, flags, keep alive
+        if session.version == 5:
+            _, pos = _decode_properties(body, pos)
+        client_id, _ = _decode_string(body, pos)
+        session.client_id = client_id.decode()
+        logger.info(f"Client {session.client_id} connected with protocol level {session.version}")
+        if session.version == 5:
+            props = [(_PROP_TOPIC_ALIAS_MAXIMUM, struct.pack("!H", self._topic_alias_maximum))]
+            session.send(_packet(2, 0, b'\x00\x00' + _encode_properties(props)))
+        else:
+            session.send(_packet(2, 0, b'\x00\x00'))
+
+    def _handle_publish(self, session, flags, body):
+        qos = (flags >> 1) & 3
+        topic, pos = _decode_string(body, 0)
+        topic = topic.decode()
+        packet_id = None
+        if qos:
+            packet_id = body[pos:pos + 2]
+            pos += 2
+        props = []
+        if session.version == 5:
+            props, pos = _decode_properties(body, pos)
+            for ident, value in props:
+                if ident == _PROP_TOPIC_ALIAS:
+                    alias, = struct.unpack("!H", value)
+                    if topic:
+                        session.aliases[alias] = topic
+                    else:
+                        topic = session.aliases[alias]
+                        self._aliased_count += 1
+        payload = body[pos:]
+        if qos == 1:
+            session.send(_packet(4, 0, packet_id))
+        elif qos == 2:
+            session.send(_packet(5, 0, packet_id))
+        self._published_count += 1
+        self._published_bytes += len(body) + 2
+        self._topic_counts[topic] += 1
+        if self._on_publish is not None:
+            self._on_publish(topic, payload, props)
+        self._route(topic, payload, props, flags & 1)
+
+    def _handle_subscribe(self, session, body):
+        packet_id = body[0:2]
+        pos = 2
+        if session.version == 5:
+            _, pos = _decode_properties(body, pos)
+        filters = []
+        while pos < len(body):
+            topic_filter, pos = _decode_string(body, pos)
+            pos += 1 # Options; everything is delivered at QoS 0
+            filters.append(topic_filter.decode())
+        session.subscriptions += filters
+        ack = packet_id + (b'\x00' if session.version == 5 else b'') + bytes(len(filters))
+        session.send(_packet(9, 0, ack))
+        for topic, (payload, props) in self._retained.items():
+            if any(topic_matches(f, topic) for f in filters):
+                session.deliver(topic, payload, props, retain=True)
+
+    def _handle_unsubscribe(self, session, body):
+        packet_id = body[0:2]
+        pos = 2
+        if session.version == 5:
+            _, pos = _decode_properties(body, pos)
+        count = 0
+        while pos < len(body):
+            topic_filter, pos = _decode_string(body, pos)
+            if topic_filter.decode() in session.subscriptions:
+                session.subscriptions.remove(topic_filter.decode())
+            count += 1
+        ack = packet_id + (b'\x00' + bytes(count) if session.version == 5 else b'')
+        session.send(_packet(11, 0, ack))
+
+    def get_stats(self):
+        return {
+            "clients": len(self._sessions),
+            "published": self._published_count,
+            "bytes": self._published_bytes,
+            "aliased": self._aliased_count,
+            "retained": len(self._retained)
+        }
+
+    def get_topic_counts(self):
+        return dict(self._topic_counts)
+
+async def _report(broker, interval, top):
+    last = broker.get_stats()
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        stats = broker.get_stats()
+        now = time.monotonic()
+        elapsed = now - last_time
+        print(f"clients: {stats['clients']}, msgs/s: {(stats['published'] - last['published']) / elapsed:.1f}, "
+              f"bytes/s: {(stats['bytes'] - last['bytes']) / elapsed:.0f}, total: {stats['published']}, "
+              f"aliased: {stats['aliased']}", flush=True)
+        if top:
+            for topic, count in sorted(broker.get_topic_counts().items(), key=lambda i: -i[1])[:top]:
+                print(f"  {count:8d} {topic}", flush=True)
+        last, last_time = stats, now
+
+async def _main(args):
+    broker = TestBroker(topic_alias_maximum=args.topic_alias_maximum)
+    server = await broker.start(args.host, args.port)
+    print(f"Test broker listening on {args.host}:{args.port}", flush=True)
+    async with server:
+        await _report(broker, args.report_interval, args.top)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='tools.testbroker',
+                    description='Minimal MQTT broker stand-in that counts received messages, for load testing',
+                    )
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="address to listen on (default is 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=1883, help="port to listen on (default is 1883)")
+    parser.add_argument('--topic-alias-maximum', type=int, default=16, metavar="N",
+                        help="topic aliases offered to MQTT 5 clients (default is 16)")
+    parser.add_argument('--report-interval', type=float, default=5, metavar="SECONDS", help="seconds between statistics reports (default is 5)")
+    parser.add_argument('--top', type=int, default=0, metavar="N", help="also report the N most published topics")
+    parser.add_argument('-v', '--verbose', action="count", default=0, help="more output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass